@@ -26,5 +26,6 @@ hsn.analyze_img()
 # Loading HistoNet
 hsn.load_histonet(params={'model_name': MODEL_NAME})
 
-# Batch-wise operation
-hsn.run_batch()
\ No newline at end of file
+# Batch-wise operation (closing HistoSegNetV1 once done)
+with hsn:
+    hsn.run_batch()
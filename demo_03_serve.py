@@ -0,0 +1,27 @@
+import hsn_v1
+from hsn_v1.server import SegmentationServer
+
+# User-defined Settings
+MODEL_NAME = 'histonet_X1.7_clrdecay_5'
+INPUT_SIZE = [224, 224]                 # [<int>, <int>] > 0
+HTT_MODE = 'both'                       # {'both', 'morph', 'func', 'glas'}
+BATCH_SIZE = 16                         # int > 0, maximum number of images segmented together
+RUN_LEVEL = 3                           # {1: HTT confidence scores, 2: Grad-CAMs, 3: Segmentation masks}
+VERBOSITY = 'NORMAL'                    # {'NORMAL', 'QUIET'}
+DOWNSAMPLE_FACTOR = 1
+SOCKET_PATH = '/tmp/hsn_v1.sock'        # Unix socket path, or None to serve on localhost HTTP at PORT
+PORT = 8000
+
+# Setup HistoSegNetV1 in memory (no input_name: no img/gt/tmp/out directories are used)
+hsn = hsn_v1.HistoSegNetV1(params={'input_name': None, 'input_size': INPUT_SIZE, 'input_mode': 'patch',
+                                   'down_fac': DOWNSAMPLE_FACTOR, 'batch_size': BATCH_SIZE, 'htt_mode': HTT_MODE,
+                                   'gt_mode': 'off', 'run_level': RUN_LEVEL, 'save_types': [0, 0, 0, 0],
+                                   'verbosity': VERBOSITY})
+
+# Loading HistoNet once for all requests
+hsn.load_histonet(params={'model_name': MODEL_NAME, 'compile': False})
+
+# Serve segmentation requests (e.g. from hsn_v1.server.segment_remote) until interrupted
+server = SegmentationServer(hsn, socket_path=SOCKET_PATH, port=PORT, max_batch_size=BATCH_SIZE)
+with hsn:
+    server.serve_forever()
@@ -0,0 +1,192 @@
+import numpy as np
+
+class SparseActivations:
+    """Class for storing per-image class activation maps sparsely, i.e. only the (image, class) planes present
+
+    Absent planes are implicitly all-zero and every operation treats them as such, so a SparseActivations object
+    behaves like the dense N x C x H x W array returned by to_dense().
+    """
+
+    def __init__(self, num_imgs, num_classes, size, dtype='float32'):
+        """
+        Parameters
+        ----------
+        num_imgs : int
+            The number of images
+        num_classes : int
+            The number of classes
+        size : list (size: 2)
+            The height and width of the activation maps
+        dtype : str or numpy dtype, optional
+            The data type of the activation maps
+        """
+
+        self.num_classes = num_classes
+        self.size = (int(size[0]), int(size[1]))
+        self.dtype = np.dtype(dtype)
+        # For each image, a dict mapping the class index to its H x W activation map
+        self.planes = [{} for _ in range(num_imgs)]
+
+    def __len__(self):
+        return len(self.planes)
+
+    @property
+    def shape(self):
+        """The shape of the equivalent dense array"""
+        return (len(self.planes), self.num_classes) + self.size
+
+    @property
+    def nbytes(self):
+        """The number of bytes used by the stored activation maps"""
+        return sum([x.nbytes for planes in self.planes for x in planes.values()])
+
+    @classmethod
+    def from_serial(cls, serial, image_inds, class_inds, num_imgs, num_classes, dtype=None):
+        """Create from serialized activation maps, e.g. the output of GradCAM.gen_gradcam
+
+        Parameters
+        ----------
+        serial : numpy 3D array (size: P x H x W), where P = number of (image, class) pairs
+            The activation maps, in serial form
+        image_inds : numpy 1D array (size: P)
+            The image index of each activation map
+        class_inds : numpy 1D array (size: P)
+            The class index of each activation map
+        num_imgs : int
+            The number of images
+        num_classes : int
+            The number of classes
+        dtype : str or numpy dtype or None, optional
+            The data type of the activation maps, or None to use that of serial
+
+        Returns
+        -------
+        activations : hsn_v1.activations.SparseActivations object
+            The sparse activation maps
+        """
+
+        dtype = serial.dtype if dtype is None else np.dtype(dtype)
+        activations = cls(num_imgs, num_classes, serial.shape[1:], dtype)
+        # If an (image, class) pair occurs more than once, the last one wins, as with dense assignment
+        for iter_serial, (image_ind, class_ind) in enumerate(zip(image_inds, class_inds)):
+            activations.planes[int(image_ind)][int(class_ind)] = serial[iter_serial].astype(dtype, copy=False)
+        return activations
+
+    @classmethod
+    def from_dense(cls, dense):
+        """Create from a dense N x C x H x W array, keeping only the planes with nonzero values"""
+
+        activations = cls(dense.shape[0], dense.shape[1], dense.shape[2:], dense.dtype)
+        is_present = np.any(np.any(dense, axis=-1), axis=-1)
+        for image_ind, class_ind in zip(*np.where(is_present)):
+            activations.planes[image_ind][int(class_ind)] = dense[image_ind, class_ind]
+        return activations
+
+    def to_dense(self, out=None):
+        """Materialize as a dense N x C x H x W array, optionally into a preallocated buffer"""
+
+        if out is None:
+            out = np.zeros(self.shape, dtype=self.dtype)
+        else:
+            if out.shape != self.shape:
+                raise Exception('Dense output buffer of size ' + str(out.shape) + ' does not match expected size ' +
+                                str(self.shape))
+            out.fill(0)
+        for image_ind, planes in enumerate(self.planes):
+            for class_ind, plane in planes.items():
+                out[image_ind, class_ind] = plane
+        return out
+
+    def copy(self):
+        """Copy the container (the activation maps themselves are never modified in place, so they are shared)"""
+
+        activations = SparseActivations(len(self.planes), self.num_classes, self.size, self.dtype)
+        activations.planes = [dict(planes) for planes in self.planes]
+        return activations
+
+    def class_inds(self, image_ind):
+        """Get the sorted indices of the classes stored for an image"""
+
+        return sorted(self.planes[image_ind].keys())
+
+    def get_plane(self, image_ind, class_ind):
+        """Get the activation map of a class for an image (all-zero if absent)"""
+
+        if class_ind in self.planes[image_ind]:
+            return self.planes[image_ind][class_ind]
+        return np.zeros(self.size, dtype=self.dtype)
+
+    def set_plane(self, image_ind, class_ind, plane):
+        """Set the activation map of a class for an image"""
+
+        if plane.shape != self.size:
+            raise Exception('Activation map of size ' + str(plane.shape) + ' does not match expected size ' +
+                            str(self.size))
+        self.planes[image_ind][int(class_ind)] = plane.astype(self.dtype, copy=False)
+
+    def select_classes(self, class_inds):
+        """Get the activation maps of a subset of classes, re-indexed in the order of class_inds"""
+
+        activations = SparseActivations(len(self.planes), len(class_inds), self.size, self.dtype)
+        for image_ind, planes in enumerate(self.planes):
+            for iter_class, class_ind in enumerate(class_inds):
+                if class_ind in planes:
+                    activations.planes[image_ind][iter_class] = planes[class_ind]
+        return activations
+
+    def max_over_classes(self, image_ind, class_inds=None):
+        """Get the pixel-wise maximum activation over (a subset of) the classes for an image
+
+        Parameters
+        ----------
+        image_ind : int
+            The index of the image
+        class_inds : list of int or None, optional
+            The classes to take the maximum over, or None for all classes
+
+        Returns
+        -------
+        max_plane : numpy 2D array (size: H x W)
+            The pixel-wise maximum activation, including the implicit zeros of absent classes
+        """
+
+        if class_inds is None:
+            class_inds = range(self.num_classes)
+        planes = self.planes[image_ind]
+        present = [planes[x] for x in class_inds if x in planes]
+        num_candidates = len(class_inds)
+        if len(present) == 0:
+            return np.zeros(self.size, dtype=self.dtype)
+        max_plane = np.max(np.stack(present), axis=0) if len(present) > 1 else present[0].copy()
+        if len(present) < num_candidates:
+            np.maximum(max_plane, 0, out=max_plane)
+        return max_plane
+
+    def argmax(self, exclude_classes=()):
+        """Get the pixel-wise maximum-confidence class for each image, as np.argmax(self.to_dense(), axis=1) would
+
+        Parameters
+        ----------
+        exclude_classes : list of int, optional
+            Classes never to be selected (as if their activations were -inf)
+
+        Returns
+        -------
+        maxconf : numpy 3D array (size: N x H x W)
+            The maximum-confidence class indices
+        """
+
+        maxconf = np.zeros((len(self.planes),) + self.size, dtype='int64')
+        allowed = [x for x in range(self.num_classes) if x not in exclude_classes]
+        for image_ind, planes in enumerate(self.planes):
+            candidates = [x for x in allowed if x in planes]
+            # All absent classes are zero, so only the lowest-indexed one can win ties among them
+            absent = [x for x in allowed if x not in planes]
+            if len(absent) > 0:
+                candidates = sorted(candidates + absent[:1])
+            if len(candidates) == 1:
+                maxconf[image_ind] = candidates[0]
+                continue
+            stacked = np.stack([self.get_plane(image_ind, x) for x in candidates])
+            maxconf[image_ind] = np.array(candidates)[np.argmax(stacked, axis=0)]
+        return maxconf
@@ -0,0 +1,166 @@
+import os
+import hashlib
+import numpy as np
+from .activations import SparseActivations
+
+class ArtifactCache:
+    """Class for caching the intermediate artifacts of each image on disk, so that later runs (e.g. at a higher
+    run_level, or CRF-only reruns) can start from a cached stage instead of the CNN
+
+    Artifacts are content-addressed: the key of an image is the hash of its file contents together with the settings
+    the artifacts depend on. Each (stage, HTT class, image) entry is a separate .npz file:
+        <cache_dir>/<stage>/<htt_class>/<key>.npz
+    with stages
+        'scores':       HistoNet confidence scores of the predicted classes of each patch
+        'gradcam':      raw per-class Grad-CAMs of each patch, at full precision
+        'cs_gradcam':   HTT-adjusted (class-specific) Grad-CAMs, at full precision
+    Patch and image indices are stored relative to the image, so entries can be combined into any batch.
+    """
+
+    stages = ['scores', 'gradcam', 'cs_gradcam']
+
+    def __init__(self, cache_dir, model_name, down_fac, input_size, reduced_decode=False, cam_interpolation='linear'):
+        """
+        Parameters
+        ----------
+        cache_dir : str
+            The directory to store the cached artifacts in
+        model_name : str
+            The name of the HistoNet model
+        down_fac : float
+            The downsampling factor of the input images
+        input_size : list (size: 2)
+            The height and width of the HistoNet input patches
+        reduced_decode : bool, optional
+            Whether images are decoded at reduced resolution
+        cam_interpolation : str, optional
+            The Grad-CAM upsampling interpolation
+        """
+
+        self.cache_dir = cache_dir
+        self.settings = '|'.join([str(model_name), str(float(down_fac)), str(list(input_size)), str(reduced_decode),
+                                  str(cam_interpolation)])
+        for stage in self.stages:
+            os.makedirs(os.path.join(cache_dir, stage), exist_ok=True)
+
+    def get_key(self, path):
+        """Get the cache key of an image file from its contents and the cache settings"""
+
+        hasher = hashlib.sha1(self.settings.encode())
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def get_path(self, stage, htt_class, key):
+        return os.path.join(self.cache_dir, stage, htt_class, key + '.npz')
+
+    def save_entry(self, stage, htt_class, key, **arrays):
+        """Write an entry atomically, so that concurrent or interrupted runs never see a partial entry"""
+
+        path = self.get_path(stage, htt_class, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.%d.tmp' % os.getpid()
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    def load_entry(self, stage, htt_class, key):
+        """Read an entry, or None if there is none"""
+
+        path = self.get_path(stage, htt_class, key)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as entry:
+            return dict(entry.items())
+
+    def has_entries(self, stage, htt_classes, keys):
+        """Check whether all images have an entry for all HTT classes at a stage"""
+
+        return all([os.path.exists(self.get_path(stage, x, key)) for x in htt_classes for key in keys])
+
+    def save_scores(self, keys, ranges, httclass_pred_image_inds, httclass_pred_class_inds, httclass_pred_scores,
+                    htt_classes):
+        """Cache the confidence scores of the predicted classes in a batch, split by image
+
+        Parameters
+        ----------
+        keys : list of str (size: B), where B = batch size
+            The cache keys of the images in the batch
+        ranges : list of tuple (size: B)
+            The start and end patch indices of each image in the batch
+        httclass_pred_image_inds : list (size: number of HTT classes) of numpy 1D array
+            The patch indices of the predicted classes of each HTT class
+        httclass_pred_class_inds : list (size: number of HTT classes) of numpy 1D array
+            The class indices of the predicted classes of each HTT class
+        httclass_pred_scores : list (size: number of HTT classes) of numpy 1D array
+            The confidence scores of the predicted classes of each HTT class
+        htt_classes : list of str
+            The HTT classes
+        """
+
+        for iter_httclass, htt_class in enumerate(htt_classes):
+            image_inds = np.asarray(httclass_pred_image_inds[iter_httclass], dtype='int64')
+            for key, (start, end) in zip(keys, ranges):
+                is_image = np.logical_and(image_inds >= start, image_inds < end)
+                self.save_entry('scores', htt_class, key, image_inds=image_inds[is_image] - start,
+                                class_inds=np.asarray(httclass_pred_class_inds[iter_httclass])[is_image],
+                                scores=np.asarray(httclass_pred_scores[iter_httclass])[is_image])
+
+    def load_scores(self, keys, ranges, htt_classes):
+        """Load the cached confidence scores of a batch (cf. save_scores), or None if any image has no entry"""
+
+        if not self.has_entries('scores', htt_classes, keys):
+            return None
+        httclass_pred_image_inds = []
+        httclass_pred_class_inds = []
+        httclass_pred_scores = []
+        for htt_class in htt_classes:
+            entries = [self.load_entry('scores', htt_class, key) for key in keys]
+            if any([x is None for x in entries]):
+                return None
+            httclass_pred_image_inds.append(np.concatenate([x['image_inds'] + start
+                                                            for x, (start, _) in zip(entries, ranges)]))
+            httclass_pred_class_inds.append(np.concatenate([x['class_inds'] for x in entries]))
+            httclass_pred_scores.append(np.concatenate([x['scores'] for x in entries]))
+        return httclass_pred_image_inds, httclass_pred_class_inds, httclass_pred_scores
+
+    def save_activations(self, stage, htt_class, keys, ranges, X):
+        """Cache the activation maps of a batch at full precision, split by image
+
+        Parameters
+        ----------
+        stage : str
+            The stage of the activation maps ('gradcam' or 'cs_gradcam')
+        htt_class : str
+            The HTT class
+        keys : list of str (size: B), where B = batch size
+            The cache keys of the images in the batch
+        ranges : list of tuple (size: B)
+            The start and end indices of the activation maps of each image in the batch
+        X : hsn_v1.activations.SparseActivations object
+            The activation maps of the batch
+        """
+
+        for key, (start, end) in zip(keys, ranges):
+            rows = [(i - start, x, X.planes[i][x]) for i in range(start, end) for x in X.class_inds(i)]
+            if len(rows) > 0:
+                planes = np.stack([x[2] for x in rows])
+            else:
+                planes = np.zeros((0,) + X.size, dtype=X.dtype)
+            self.save_entry(stage, htt_class, key, image_inds=np.array([x[0] for x in rows], dtype='int64'),
+                            class_inds=np.array([x[1] for x in rows], dtype='int64'), planes=planes,
+                            size=np.array(X.size), num_classes=np.array(X.num_classes))
+
+    def load_activations(self, stage, htt_class, keys, ranges, dtype=None):
+        """Load the cached activation maps of a batch (cf. save_activations), or None if any image has no entry"""
+
+        entries = [self.load_entry(stage, htt_class, key) for key in keys]
+        if len(entries) == 0 or any([x is None for x in entries]):
+            return None
+        dtype = entries[0]['planes'].dtype if dtype is None else dtype
+        X = SparseActivations(ranges[-1][1], int(entries[0]['num_classes']), entries[0]['size'], dtype)
+        for entry, (start, _) in zip(entries, ranges):
+            for image_ind, class_ind, plane in zip(entry['image_inds'], entry['class_inds'], entry['planes']):
+                X.set_plane(start + int(image_ind), class_ind, plane)
+        return X
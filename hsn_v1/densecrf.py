@@ -1,39 +1,409 @@
 import os
+import shutil
+import tempfile
 import numpy as np
+import cv2
 import pydensecrf.densecrf as dcrf
 from pydensecrf.utils import unary_from_softmax
 import matplotlib
 # matplotlib.use("TkAgg")
 import matplotlib.pyplot as plt
+from .activations import SparseActivations
+
+# Unary energy of the labels a pixel is clamped away from
+CLAMP_ENERGY = 1e4
+
+def crf_inference(probs, image, params):
+    """Run dense CRF inference on a single image, at full resolution or, if params['scale'] > 1, at multiple scales
+
+    Parameters
+    ----------
+    probs : numpy 3D array (size: C x H x W), where C = number of classes passing
+        The class probability maps of the image
+    image : numpy 3D array (size: H x W x 3)
+        The original input image
+    params : dict
+        The dense CRF parameters (see DenseCRF.get_params)
+
+    Returns
+    -------
+    Q : numpy 3D array (size: C x H x W)
+        The continuous class probability map from dense CRF
+    num_iters : int
+        The number of mean-field iterations run (0 if inference was skipped)
+    """
+
+    if probs.shape[0] <= 1:
+        # With a single class passing, the result is known without inference
+        return np.ones(probs.shape, dtype='float32'), 0
+    if params.get('scale', 1) > 1:
+        return crf_inference_multiscale(probs, image, params)
+    return crf_inference_full(probs, image, params)
+
+def crf_inference_full(probs, image, params, sxy_fac=1):
+    """Run dense CRF inference on a single image at the resolution given
+
+    Parameters
+    ----------
+    probs : numpy 3D array (size: C x H x W), where C = number of classes passing
+        The class probability maps of the image
+    image : numpy 3D array (size: H x W x 3)
+        The input image
+    params : dict
+        The dense CRF parameters (see DenseCRF.get_params)
+    sxy_fac : float, optional
+        The factor the image has been downsampled by, dividing the spatial standard deviations
+
+    Returns
+    -------
+    Q : numpy 3D array (size: C x H x W)
+        The continuous class probability map from dense CRF
+    num_iters : int
+        The number of mean-field iterations run
+    """
+
+    size = image.shape[:2]
+    # Unary energy
+    U = np.ascontiguousarray(unary_from_softmax(probs))
+    # Set up dense CRF 2D
+    d = dcrf.DenseCRF2D(size[1], size[0], probs.shape[0])
+    d.setUnaryEnergy(U)
+    # Penalize small, isolated segments
+    # (sxy are PosXStd, PosYStd)
+    d.addPairwiseGaussian(sxy=params['gauss_sxy'] / sxy_fac, compat=params['gauss_compat'])
+    # Incorporate local colour-dependent features
+    # (sxy are Bi_X_Std and Bi_Y_Std,
+    #  srgb are Bi_R_Std, Bi_G_Std, Bi_B_Std)
+    d.addPairwiseBilateral(sxy=params['bilat_sxy'] / sxy_fac, srgb=params['bilat_srgb'],
+                           rgbim=np.ascontiguousarray(image, dtype='uint8'), compat=params['bilat_compat'])
+    # Do inference
+    Q, num_iters = run_inference(d, params)
+    return Q.reshape((probs.shape[0], size[0], size[1])), num_iters
+
+def crf_inference_multiscale(probs, image, params):
+    """Run dense CRF inference on a downsampled copy of a single image and upsample the result, optionally refining
+    it at full resolution in a narrow band around the class boundaries
+
+    The band is refined from the original probabilities, with the pixels just inside the neighbouring regions clamped
+    to their coarse labels as context, so that band pixels are smoothed once, at full resolution only.
+
+    Parameters
+    ----------
+    probs : numpy 3D array (size: C x H x W), where C = number of classes passing
+        The class probability maps of the image
+    image : numpy 3D array (size: H x W x 3)
+        The original input image
+    params : dict
+        The dense CRF parameters (see DenseCRF.get_params), with the downsampling factor 'scale' and the half-width
+        'band' (in full-resolution pixels, 0 for none) of the boundary band to refine
+
+    Returns
+    -------
+    Q : numpy 3D array (size: C x H x W)
+        The continuous class probability map from dense CRF
+    num_iters : int
+        The number of mean-field iterations run at the coarse scale
+    """
+
+    scale = params['scale']
+    size = image.shape[:2]
+    small_size = (max(int(round(size[0] / scale)), 1), max(int(round(size[1] / scale)), 1))
+    # Downsample the probabilities and image, then run the CRF with the spatial standard deviations scaled to match
+    small_probs = np.stack([cv2.resize(x, (small_size[1], small_size[0]), interpolation=cv2.INTER_AREA)
+                            for x in probs.astype('float32', copy=False)])
+    small_image = cv2.resize(np.ascontiguousarray(image, dtype='uint8'), (small_size[1], small_size[0]),
+                             interpolation=cv2.INTER_AREA)
+    small_Q, num_iters = crf_inference_full(small_probs, small_image, params, sxy_fac=size[0] / small_size[0])
+    # Upsample Q back to full resolution
+    Q = np.stack([cv2.resize(x, (size[1], size[0]), interpolation=cv2.INTER_LINEAR)
+                  for x in small_Q.astype('float32', copy=False)])
+    Q /= np.maximum(np.sum(Q, axis=0, keepdims=True), 1e-12)
+
+    band = int(params.get('band', 0))
+    if band > 0 and Q.shape[0] > 1:
+        # Pixels within the band of a class boundary are those where the labels in their neighbourhood disagree
+        labels = np.argmax(Q, axis=0).astype('uint8')
+        kernel = np.ones((2 * band + 1, 2 * band + 1), dtype='uint8')
+        is_band = cv2.dilate(labels, kernel) != cv2.erode(labels, kernel)
+        if np.any(is_band):
+            # (the interior pixels within another half-width of the band)
+            is_context = np.logical_and(cv2.dilate(is_band.astype('uint8'), kernel) > 0, np.logical_not(is_band))
+            Q[:, is_band] = crf_inference_band(probs, labels, image, is_band, is_context, params)
+    return Q, num_iters
+
+def crf_inference_band(probs, labels, image, is_band, is_context, params):
+    """Run dense CRF inference at full resolution on only the pixels of a band (e.g. around class boundaries), with
+    context pixels clamped to given labels
+
+    Parameters
+    ----------
+    probs : numpy 3D array (size: C x H x W), where C = number of classes passing
+        The original class probability maps of the image
+    labels : numpy 2D array (size: H x W)
+        The class indices the context pixels are clamped to (e.g. the coarse CRF labels)
+    image : numpy 3D array (size: H x W x 3)
+        The original input image
+    is_band : numpy 2D array (size: H x W), dtype bool
+        The pixels of the band
+    is_context : numpy 2D array (size: H x W), dtype bool
+        The pixels clamped to their labels, interacting with the band pixels but not refined themselves
+    params : dict
+        The dense CRF parameters (see DenseCRF.get_params)
+
+    Returns
+    -------
+    Q : numpy 2D array (size: C x P), where P = number of band pixels
+        The continuous class probability map of the band pixels from dense CRF
+    """
+
+    band_y, band_x = np.nonzero(np.logical_or(is_band, is_context))
+    band_rgb = image[band_y, band_x].astype('float32')
+    U = unary_from_softmax(probs[:, band_y, band_x])
+    # Clamp the context pixels, with an energy no pairwise term can overcome for all labels but their own
+    is_clamped = is_context[band_y, band_x]
+    U[:, is_clamped] = CLAMP_ENERGY
+    U[labels[band_y, band_x][is_clamped], np.nonzero(is_clamped)[0]] = 0
+    d = dcrf.DenseCRF(len(band_y), probs.shape[0])
+    d.setUnaryEnergy(np.ascontiguousarray(U, dtype='float32'))
+    # Same Gaussian and bilateral kernels as dcrf.DenseCRF2D, restricted to the band and context pixels
+    gauss_feats = np.stack([band_x / params['gauss_sxy'], band_y / params['gauss_sxy']]).astype('float32')
+    d.addPairwiseEnergy(np.ascontiguousarray(gauss_feats), compat=params['gauss_compat'])
+    bilat_feats = np.concatenate([np.stack([band_x / params['bilat_sxy'], band_y / params['bilat_sxy']]),
+                                  band_rgb.T / params['bilat_srgb']]).astype('float32')
+    d.addPairwiseEnergy(np.ascontiguousarray(bilat_feats), compat=params['bilat_compat'])
+    Q = run_inference(d, params)[0].reshape((probs.shape[0], len(band_y)))
+    return Q[:, np.logical_not(is_clamped)]
+
+def run_inference(d, params):
+    """Run mean-field inference on a set-up dense CRF, either for a fixed number of iterations or, if params['tol']
+    > 0, step by step until the largest change in Q falls below params['tol'] (at most params['n_infer'] iterations)
+
+    Parameters
+    ----------
+    d : pydensecrf.densecrf.DenseCRF object
+        The dense CRF, with unary and pairwise energies set
+    params : dict
+        The dense CRF parameters (see DenseCRF.get_params)
+
+    Returns
+    -------
+    Q : numpy 2D array (size: C x P), where P = number of pixels
+        The continuous class probability map from dense CRF
+    num_iters : int
+        The number of mean-field iterations run
+    """
+
+    n_infer = int(params['n_infer'])
+    if params.get('tol', 0) <= 0 or n_infer < 1:
+        return np.array(d.inference(n_infer)), n_infer
+    Q, tmp1, tmp2 = d.startInference()
+    prev_Q = np.array(Q)
+    for num_iters in range(1, n_infer + 1):
+        d.stepInference(Q, tmp1, tmp2)
+        cur_Q = np.array(Q)
+        if np.max(np.abs(cur_Q - prev_Q)) < params['tol']:
+            break
+        prev_Q = cur_Q
+    return cur_Q, num_iters
+
+def get_tile_windows(size, tile_size, tile_overlap):
+    """Get the windows of overlapping tiles covering an image
+
+    Tiles start every tile_size - tile_overlap pixels; the last tile of a row or column is cut at the image edge or,
+    if less than tile_overlap pixels would remain beyond it, extended to the edge instead, so that no nearly duplicate
+    tile is run (tiles are thus at most tile_size + tile_overlap - 1 pixels wide).
+
+    Parameters
+    ----------
+    size : list (size: 2)
+        The height and width of the image
+    tile_size : int
+        The height and width of the tiles (0 for a single window covering the whole image)
+    tile_overlap : int
+        The overlap between neighbouring tiles, in pixels
+
+    Returns
+    -------
+    windows : list of tuple
+        The (top, bottom, left, right) bounds of each tile
+    """
+
+    def get_spans(length):
+        if tile_size <= 0 or length <= tile_size:
+            return [(0, length)]
+        spans = []
+        start = 0
+        while start + tile_size < length and length - (start + tile_size) >= tile_overlap:
+            spans.append((start, start + tile_size))
+            start += tile_size - tile_overlap
+        # (the last tile, cut at or extended to the edge)
+        return spans + [(start, length)]
+
+    windows = []
+    for top, bottom in get_spans(size[0]):
+        for left, right in get_spans(size[1]):
+            windows.append((top, bottom, left, right))
+    return windows
+
+def get_tile_weights(window, size, tile_overlap):
+    """Get the blending weights of a tile, ramping up linearly across its overlaps with neighbouring tiles
+
+    Parameters
+    ----------
+    window : tuple
+        The (top, bottom, left, right) bounds of the tile
+    size : list (size: 2)
+        The height and width of the image
+    tile_overlap : int
+        The overlap between neighbouring tiles, in pixels
+
+    Returns
+    -------
+    weights : numpy 2D array (size: h x w), where h x w = tile size
+        The blending weights of the tile
+    """
+
+    def get_ramp(start, end, length):
+        ramp = np.ones(end - start, dtype='float32')
+        num_ramp = min(tile_overlap, end - start)
+        if num_ramp == 0:
+            # Without overlap, tiles abut and each pixel is covered once
+            return ramp
+        ramp_up = np.arange(1, num_ramp + 1, dtype='float32') / (num_ramp + 1)
+        if start > 0:
+            ramp[:num_ramp] = np.minimum(ramp[:num_ramp], ramp_up)
+        if end < length:
+            ramp[-num_ramp:] = np.minimum(ramp[-num_ramp:], ramp_up[::-1])
+        return ramp
+
+    return np.outer(get_ramp(window[0], window[1], size[0]), get_ramp(window[2], window[3], size[1]))
+
+def crf_inference_shared(job):
+    """Run dense CRF inference on a single image (or tile of it) in a worker process, reading the inputs from and
+    writing the output to memory-mapped files shared with the parent process
+
+    Parameters
+    ----------
+    job : tuple
+        The shared directory, data type of the probability maps, number of passing planes in the batch, batch image
+        size, image index, index of the image's first passing plane, number of passing planes of the image, (top,
+        bottom, left, right) bounds of the tile, name of the tile's output file, and dense CRF parameters
+
+    Returns
+    -------
+    num_iters : int
+        The number of mean-field iterations run
+    """
+
+    shared_dir, dtype, num_planes, images_shape, image_ind, start, count, window, out_name, params = job
+    size = images_shape[1:3]
+    probs = np.memmap(os.path.join(shared_dir, 'probs.dat'), dtype=dtype, mode='r',
+                      shape=(num_planes, size[0], size[1]))
+    images = np.memmap(os.path.join(shared_dir, 'images.dat'), dtype='uint8', mode='r', shape=images_shape)
+    tile_shape = (count, window[1] - window[0], window[3] - window[2])
+    crf = np.memmap(os.path.join(shared_dir, out_name), dtype=dtype, mode='w+', shape=tile_shape)
+    crf[:], num_iters = crf_inference(np.array(probs[start:start + count, window[0]:window[1], window[2]:window[3]]),
+                                      np.array(images[image_ind, window[0]:window[1], window[2]:window[3]]), params)
+    crf.flush()
+    return num_iters
 
 class DenseCRF:
     """Class for implementing a dense CRF"""
 
-    def __init__(self):
+    def __init__(self, pool=None, tol=0, tile_size=0, tile_overlap=32, scale=None, band=None):
+        """
+        Parameters
+        ----------
+        pool : multiprocessing.pool.Pool object or None, optional
+            Persistent process pool to spread the images of a batch across, or None to process them serially
+        tol : float, optional
+            Stop mean-field inference early once the largest change in Q falls below this tolerance (0 to always run
+            n_infer iterations)
+        tile_size : int, optional
+            Run inference on overlapping tiles of about tile_size x tile_size pixels (cf. get_tile_windows), blending
+            them in the overlaps (0 for whole images); this bounds only the memory used by inference itself
+            (permutohedral lattices and mean-field buffers, for tiles of at most tile_size + tile_overlap - 1 pixels
+            wide), as the full-size input probabilities and blended output of each image are still allocated
+        tile_overlap : int, optional
+            The overlap between neighbouring tiles, in pixels
+        scale : float or None, optional
+            Multi-scale mode: the downsampling factor of the CRF inference (1 for full resolution), or None for the one
+            in the configuration file (cf. load_config)
+        band : int or None, optional
+            Multi-scale mode: the half-width of the band around class boundaries refined at full resolution (0 for
+            none), or None for the one in the configuration file
+        """
+
+        if type(tile_size) != int or tile_size < 0:
+            raise Exception('Dense CRF tile size ' + str(tile_size) + ' is either non-integer or less than 0')
+        if tile_size > 0 and (type(tile_overlap) != int or tile_overlap < 0 or tile_overlap >= tile_size):
+            raise Exception('Dense CRF tile overlap ' + str(tile_overlap) + ' is either non-integer, less than 0 or ' +
+                            'not less than the tile size ' + str(tile_size))
+        if scale is not None and (type(scale) not in [int, float] or scale < 1):
+            raise Exception('Dense CRF scale ' + str(scale) + ' is either non-numeric or less than 1')
+        if band is not None and (type(band) != int or band < 0):
+            raise Exception('Dense CRF band ' + str(band) + ' is either non-integer or less than 0')
+
         self.gauss_sxy = 3
         self.gauss_compat = 30
         self.bilat_sxy = 10
         self.bilat_srgb = 20
         self.bilat_compat = 50
         self.n_infer = 5
+        # Multi-scale mode: downsampling factor of the CRF inference (1 for full resolution) and half-width of the
+        # band around class boundaries refined at full resolution (0 for none)
+        self.scale = 1 if scale is None else scale
+        self.band = 0 if band is None else band
+        # (set explicitly, overriding the configuration file)
+        self.is_scale_set = scale is not None
+        self.is_band_set = band is not None
+        self.tol = tol
+        self.pool = pool
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        # Number of mean-field iterations run for each image of the last processed batch
+        self.num_iters = []
 
     def load_config(self, path):
-        """Load dense CRF configurations from file"""
+        """Load dense CRF configurations from file
+
+        The first row holds gauss_sxy, gauss_compat, bilat_sxy, bilat_srgb, bilat_compat, n_config and, optionally,
+        the multi-scale scale and band (unless given to the constructor).
+        """
 
         if os.path.exists(path):
             config = np.load(path)
             self.gauss_sxy, self.gauss_compat, self.bilat_sxy, self.bilat_srgb, self.bilat_compat, self.n_config = \
-            config[0]
+            config[0][:6]
+            if len(config[0]) >= 8:
+                scale, band = config[0][6:8]
+                if scale < 1 or band < 0:
+                    raise Exception('Dense CRF config file ' + path + ' has multi-scale scale ' + str(scale) +
+                                    ' less than 1 or band ' + str(band) + ' less than 0')
+                if not self.is_scale_set:
+                    self.scale = scale
+                if not self.is_band_set:
+                    self.band = band
         else:
             print('Warning: dense CRF config file ' + path + ' does not exist - using defaults')
 
+    def get_params(self):
+        """Get the dense CRF parameters as a (picklable) dict"""
+
+        return {'gauss_sxy': self.gauss_sxy, 'gauss_compat': self.gauss_compat, 'bilat_sxy': self.bilat_sxy,
+                'bilat_srgb': self.bilat_srgb, 'bilat_compat': self.bilat_compat, 'n_infer': self.n_infer,
+                'scale': self.scale, 'band': self.band, 'tol': self.tol}
+
     def process(self, probs, images):
         """
         Run dense CRF, given probability map and input image
 
+        Images with at most one class passing are not run through inference, and the number of mean-field iterations
+        run for each image is recorded in self.num_iters.
+
         Parameters
         ----------
-        probs : numpy 4D array
+        probs : numpy 4D array or hsn_v1.activations.SparseActivations object
             The class probability maps, in batch
         images : numpy 4D array
             The original input images, in batch
@@ -42,33 +412,168 @@ class DenseCRF:
         -------
         maxconf_crf : numpy 3D array
             The discrete class segmentation map from dense CRF, in batch
-        crf : numpy 4D array
+        crf : numpy 4D array or hsn_v1.activations.SparseActivations object (same type as probs)
             The continuous class probability map from dense CRF, in batch
         """
 
+        is_dense = not isinstance(probs, SparseActivations)
+        if is_dense:
+            probs = SparseActivations.from_dense(probs)
+
         # Set up variable sizes
-        num_input_images = probs.shape[0]
-        num_classes = probs.shape[1]
+        num_input_images = len(probs)
         size = images.shape[1:3]
-        crf = np.zeros((num_input_images, num_classes, size[0], size[1]))
+        crf = SparseActivations(num_input_images, probs.num_classes, size, probs.dtype)
+        httclass_pass_class_inds = [[x for x in probs.class_inds(i) if np.sum(probs.planes[i][x]) > 0]
+                                    for i in range(num_input_images)]
+        # (recorded locally first, as dense CRFs may be shared by concurrent batches, cf. segment_crf)
+        num_iters_list = [0] * num_input_images
+        # With a single class passing, the result is known without inference
+        infer_image_inds = [i for i in range(num_input_images) if len(httclass_pass_class_inds[i]) > 1]
+        Q_list = [np.ones((len(x), size[0], size[1]), dtype='float32') for x in httclass_pass_class_inds]
+        # Split large images into overlapping tiles (a single window covers each image otherwise)
+        windows = get_tile_windows(size, self.tile_size, self.tile_overlap)
+        jobs = [(x, window) for x in infer_image_inds for window in windows]
+        if len(windows) > 1:
+            tile_weights = [get_tile_weights(x, size, self.tile_overlap) for x in windows]
+            weight_sum = np.zeros(size, dtype='float32')
+            for iter_window, window in enumerate(windows):
+                weight_sum[window[0]:window[1], window[2]:window[3]] += tile_weights[iter_window]
+            for iter_input_image in infer_image_inds:
+                Q_list[iter_input_image] = np.zeros_like(Q_list[iter_input_image])
+
+        def add_tile(iter_job, Q_tile, num_iters):
+            # Blend each tile into its image as soon as it is done, so that only one tile result is held at a time
+            iter_input_image, window = jobs[iter_job]
+            if len(windows) == 1:
+                Q_list[iter_input_image] = Q_tile
+                num_iters_list[iter_input_image] = num_iters
+                return
+            Q_list[iter_input_image][:, window[0]:window[1], window[2]:window[3]] += \
+                tile_weights[iter_job % len(windows)] * Q_tile
+            num_iters_list[iter_input_image] = max(num_iters_list[iter_input_image], num_iters)
+
+        if self.pool is not None and len(jobs) > 1:
+            for iter_job, Q_tile, num_iters in self.process_parallel(probs, images, httclass_pass_class_inds, jobs):
+                add_tile(iter_job, Q_tile, num_iters)
+        else:
+            params = self.get_params()
+            for iter_job, (iter_input_image, window) in enumerate(jobs):
+                cur_probs = np.stack([probs.planes[iter_input_image][x][window[0]:window[1], window[2]:window[3]]
+                                      for x in httclass_pass_class_inds[iter_input_image]])
+                add_tile(iter_job, *crf_inference(
+                    cur_probs, images[iter_input_image, window[0]:window[1], window[2]:window[3]], params))
+        if len(windows) > 1:
+            for iter_input_image in infer_image_inds:
+                Q_list[iter_input_image] /= weight_sum
         for iter_input_image in range(num_input_images):
-            pass_class_inds = np.where(np.sum(np.sum(probs[iter_input_image], axis=1), axis=1) > 0)
-            # Set up dense CRF 2D
-            d = dcrf.DenseCRF2D(size[1], size[0], len(pass_class_inds[0]))
-            cur_probs = probs[iter_input_image, pass_class_inds[0]]
-            # Unary energy
-            U = np.ascontiguousarray(unary_from_softmax(cur_probs))
-            d.setUnaryEnergy(U)
-            # Penalize small, isolated segments
-            # (sxy are PosXStd, PosYStd)
-            d.addPairwiseGaussian(sxy=self.gauss_sxy, compat=self.gauss_compat)
-            # Incorporate local colour-dependent features
-            # (sxy are Bi_X_Std and Bi_Y_Std,
-            #  srgb are Bi_R_Std, Bi_G_Std, Bi_B_Std)
-            d.addPairwiseBilateral(sxy=self.bilat_sxy, srgb=self.bilat_srgb, rgbim=np.uint8(images[iter_input_image]),
-                                   compat=self.bilat_compat)
-            # Do inference
-            Q = d.inference(self.n_infer)
-            crf[iter_input_image, pass_class_inds] = np.array(Q).reshape((len(pass_class_inds[0]), size[0], size[1]))
-        maxconf_crf = np.argmax(crf, axis=1)
-        return maxconf_crf, crf
\ No newline at end of file
+            for iter_pass_class, pass_class_ind in enumerate(httclass_pass_class_inds[iter_input_image]):
+                crf.set_plane(iter_input_image, pass_class_ind, Q_list[iter_input_image][iter_pass_class])
+        self.num_iters = num_iters_list
+        maxconf_crf = crf.argmax()
+        if is_dense:
+            return maxconf_crf, crf.to_dense()
+        return maxconf_crf, crf
+
+    def process_parallel(self, probs, images, httclass_pass_class_inds, jobs):
+        """Run dense CRF inference on each of the given images (or tiles of them) in a worker process of self.pool
+
+        The probability maps, images and resulting tiles are shipped through memory-mapped files in shared memory
+        (/dev/shm, if available) instead of being pickled. The probability maps and images of the batch are shared in
+        full, while each tile result only lives until it is read back.
+
+        Parameters
+        ----------
+        probs : hsn_v1.activations.SparseActivations object
+            The class probability maps, in batch
+        images : numpy 4D array
+            The original input images, in batch
+        httclass_pass_class_inds : list of list of int
+            The indices of the classes passing for each image
+        jobs : list of tuple
+            The index of the image and (top, bottom, left, right) bounds of the tile to run inference on, for each job
+
+        Returns
+        -------
+        results : generator
+            The index of the job, continuous class probability maps of the passing classes in the tile and number of
+            mean-field iterations run, for each job in order, as soon as it is done
+        """
+
+        size = images.shape[1:3]
+        image_inds = sorted(set([x[0] for x in jobs]))
+        image_slots = dict([(x, i) for i, x in enumerate(image_inds)])
+        images_shape = (len(image_inds), size[0], size[1], 3)
+        counts = [len(httclass_pass_class_inds[x]) for x in image_inds]
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype('int64')
+        num_planes = int(sum(counts))
+        tile_shapes = [(counts[image_slots[x]], window[1] - window[0], window[3] - window[2]) for x, window in jobs]
+
+        shared_dir = tempfile.mkdtemp(prefix='hsn_crf_', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        try:
+            probs_shared = np.memmap(os.path.join(shared_dir, 'probs.dat'), dtype=probs.dtype, mode='w+',
+                                     shape=(num_planes, size[0], size[1]))
+            images_shared = np.memmap(os.path.join(shared_dir, 'images.dat'), dtype='uint8', mode='w+',
+                                      shape=images_shape)
+            for iter_slot, iter_input_image in enumerate(image_inds):
+                for iter_pass_class, pass_class_ind in enumerate(httclass_pass_class_inds[iter_input_image]):
+                    probs_shared[starts[iter_slot] + iter_pass_class] = probs.planes[iter_input_image][pass_class_ind]
+                images_shared[iter_slot] = images[iter_input_image]
+            probs_shared.flush()
+            images_shared.flush()
+
+            params = self.get_params()
+            shared_jobs = [(shared_dir, probs.dtype.name, num_planes, images_shape, image_slots[x],
+                            int(starts[image_slots[x]]), counts[image_slots[x]], window, 'crf_%d.dat' % iter_job,
+                            params)
+                           for iter_job, (x, window) in enumerate(jobs)]
+            # Each tile has its own output file, removed once read, so that finished tiles do not pile up
+            for i, num_iters in enumerate(self.pool.imap(crf_inference_shared, shared_jobs)):
+                out_path = os.path.join(shared_dir, 'crf_%d.dat' % i)
+                Q_tile = np.array(np.memmap(out_path, dtype=probs.dtype, mode='r', shape=tile_shapes[i]))
+                os.remove(out_path)
+                yield i, Q_tile, num_iters
+            del probs_shared, images_shared
+        finally:
+            shutil.rmtree(shared_dir, ignore_errors=True)
+
+class DenseCRFEngine:
+    """Class for holding the dense CRFs of all HTT classes for a whole run, with their configurations loaded once"""
+
+    def __init__(self, config_dir, htt_classes, pool=None, tol=0, tile_size=0, tile_overlap=32, scale=None, band=None):
+        """
+        Parameters
+        ----------
+        config_dir : str
+            File path to the directory holding the <htt_class>_optimal_pcc.npy configuration files
+        htt_classes : list of str
+            The HTT classes to be segmented
+        pool : multiprocessing.pool.Pool object or None, optional
+            Persistent process pool to spread the images of a batch across, or None to process them serially
+        tol : float, optional
+            Stop mean-field inference early once the largest change in Q falls below this tolerance (0 to always run
+            n_infer iterations)
+        tile_size : int, optional
+            Run inference on overlapping tiles of about tile_size x tile_size pixels (0 for whole images, cf.
+            DenseCRF)
+        tile_overlap : int, optional
+            The overlap between neighbouring tiles, in pixels
+        scale : float or None, optional
+            The multi-scale downsampling factor of all dense CRFs, or None for those of their configuration files
+        band : int or None, optional
+            The multi-scale boundary band half-width of all dense CRFs, or None for those of their configuration files
+        """
+
+        self.crfs = {}
+        for htt_class in htt_classes:
+            self.crfs[htt_class] = DenseCRF(pool=pool, tol=tol, tile_size=tile_size, tile_overlap=tile_overlap,
+                                            scale=scale, band=band)
+            self.crfs[htt_class].load_config(os.path.join(config_dir, htt_class + '_optimal_pcc.npy'))
+
+    def __getitem__(self, htt_class):
+        return self.crfs[htt_class]
+
+    def process(self, htt_class, probs, images):
+        """Run the dense CRF of an HTT class (see DenseCRF.process)"""
+
+        return self.crfs[htt_class].process(probs, images)
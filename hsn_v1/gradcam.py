@@ -1,3 +1,4 @@
+import keras
 import keras.backend as K
 import tensorflow as tf
 import numpy as np
@@ -5,6 +6,7 @@ import cv2
 from scipy.ndimage import gaussian_filter
 import scipy
 import matplotlib.pyplot as plt
+from .activations import SparseActivations
 
 class GradCAM:
     """Class for Grad-CAM and HTT modifications"""
@@ -17,8 +19,23 @@ class GradCAM:
         self.cnn_model = params['cnn_model']
         self.final_layer = params['final_layer']
         self.tmp_dir = params['tmp_dir']
+        self.dtype = np.dtype(params.get('dtype', 'float32'))
+        self.analytic_cam = params.get('analytic_cam', True)
+        interpolations = {'nearest': cv2.INTER_NEAREST, 'linear': cv2.INTER_LINEAR, 'cubic': cv2.INTER_CUBIC,
+                          'area': cv2.INTER_AREA}
+        if params.get('interpolation', 'linear') not in interpolations:
+            raise Exception('Grad-CAM interpolation ' + str(params['interpolation']) + ' is not in ' +
+                            str(list(interpolations.keys())))
+        self.interpolation = interpolations[params.get('interpolation', 'linear')]
+        # Compiled gradient functions, keyed by (model, layer name), reused across batches
+        self.gradient_functions = {}
+        # Dense weights of global-pool + dense heads (or None for other heads), keyed by (model, layer name)
+        self.head_weights = {}
+        # Last computed intensity-derived background maps, as (images, background_max, background maps)
+        self.background_cache = None
 
-    def gen_gradcam(self, pred_image_inds, pred_class_inds, pred_scores, input_images_norm, atlas, valid_classes):
+    def gen_gradcam(self, pred_image_inds, pred_class_inds, pred_scores, input_images_norm, atlas, valid_classes,
+                    features=None):
         """Generate Grad-CAM
 
         Parameters
@@ -35,6 +52,9 @@ class GradCAM:
             The Atlas of Digital Pathology object
         valid_classes : list
             The segmentation classes valid for the current problem
+        features : numpy 4D array (size: B x h x w x F) or None, optional
+            The final layer feature maps of the input images from the classification forward pass, or None to
+            recompute them
 
         Returns
         -------
@@ -45,33 +65,87 @@ class GradCAM:
         # Find number of HTTs across all images that passed their thresholds
         num_pass_threshold = len(pred_image_inds)
 
-        gradcam = np.zeros((num_pass_threshold, self.size[0], self.size[1]))
+        gradcam = np.zeros((num_pass_threshold, self.size[0], self.size[1]), dtype=self.dtype)
         num_batches = (num_pass_threshold + self.batch_size - 1) // self.batch_size
-        pred_scores_3d = np.expand_dims(np.expand_dims(pred_scores, axis=1), axis=1)
+        pred_scores_3d = np.expand_dims(np.expand_dims(pred_scores, axis=1), axis=1).astype(self.dtype)
         pred_class_inds_full = atlas.convert_class_inds(pred_class_inds, valid_classes, atlas.level5)
 
         # For each batch, obtain Grad-CAM, then multiply by confidence score
         for iter_batch in range(num_batches):
             start = iter_batch * self.batch_size
             end = min((iter_batch + 1) * self.batch_size, num_pass_threshold)
-            cur_gradcam_batch = self.grad_cam_batch(self.cnn_model, input_images_norm[pred_image_inds[start:end]],
-                                                    pred_class_inds_full[start:end], self.final_layer)
-            gradcam[start:end] = cur_gradcam_batch * pred_scores_3d[start:end]
+            if features is None:
+                self.grad_cam_batch(self.cnn_model, input_images_norm[pred_image_inds[start:end]],
+                                    pred_class_inds_full[start:end], self.final_layer, out=gradcam[start:end])
+            else:
+                self.grad_cam_batch(self.cnn_model, None, pred_class_inds_full[start:end], self.final_layer,
+                                    features=features[pred_image_inds[start:end]], out=gradcam[start:end])
+            gradcam[start:end] *= pred_scores_3d[start:end]
         return gradcam
 
-    def grad_cam_batch(self, input_model, images, classes, layer_name):
+    def gen_gradcam_httclasses(self, httclass_pred_image_inds, httclass_pred_class_inds, httclass_pred_scores,
+                               input_images_norm, atlas, httclass_valid_classes, features=None):
+        """Generate Grad-CAM for several HTT classes at once, so that predictions of the same image are processed
+        together regardless of their HTT class
+
+        Parameters
+        ----------
+        httclass_pred_image_inds : list (size: T) of numpy 1D array, where T = number of HTT classes
+            The indices of the images, for each HTT class
+        httclass_pred_class_inds : list (size: T) of numpy 1D array, where T = number of HTT classes
+            The indices of the predicted classes (among the HTT class's valid classes), for each HTT class
+        httclass_pred_scores : list (size: T) of numpy 1D array, where T = number of HTT classes
+            The scores of the predicted classes, for each HTT class
+        input_images_norm : numpy 4D array (size: B x H x W x 3)
+            The normalized input images
+        atlas : hsn_v1.adp.Atlas object
+            The Atlas of Digital Pathology object
+        httclass_valid_classes : list (size: T) of list, where T = number of HTT classes
+            The segmentation classes valid for each HTT class
+        features : numpy 4D array (size: B x h x w x F) or None, optional
+            The final layer feature maps of the input images, shared by all HTT classes, or None to recompute them
+
+        Returns
+        -------
+        httclass_gradcam : list (size: T) of numpy 3D array (size: num_pass_threshold x H x W)
+            The Grad-CAM continuous values for predicted images/classes of the current batch, for each HTT class
+        """
+
+        # Merge the predictions of all HTT classes, in ADP level 5 class indices, and sort them by image
+        pred_image_inds = np.concatenate(httclass_pred_image_inds).astype('int64')
+        pred_class_inds_full = np.concatenate([np.asarray(atlas.convert_class_inds(x, valid_classes, atlas.level5),
+                                                          dtype='int64')
+                                               for x, valid_classes in zip(httclass_pred_class_inds,
+                                                                           httclass_valid_classes)])
+        pred_scores = np.concatenate(httclass_pred_scores)
+        order = np.argsort(pred_image_inds, kind='stable')
+
+        gradcam = np.empty((len(pred_image_inds), self.size[0], self.size[1]), dtype=self.dtype)
+        gradcam[order] = self.gen_gradcam(pred_image_inds[order], pred_class_inds_full[order], pred_scores[order],
+                                          input_images_norm, atlas, atlas.level5, features=features)
+
+        # Split back by HTT class
+        split_inds = np.cumsum([len(x) for x in httclass_pred_image_inds])[:-1]
+        return np.split(gradcam, split_inds)
+
+    def grad_cam_batch(self, input_model, images, classes, layer_name, features=None, out=None):
         """Generate Grad-CAM for a single batch of images
 
         Parameters
         ----------
         input_model : keras.engine.sequential.Sequential object
             The input model to run Grad-CAM on
-        images : numpy 4D array (size: B x H x W x 3)
-            The normalized input images in the current batch
+        images : numpy 4D array (size: B x H x W x 3) or None
+            The normalized input images in the current batch (unused if features are provided)
         classes : numpy 1D array
             The indices of the predicted classes in the current batch
         layer_name : str
             The name of the model layer to run Grad-CAM on
+        features : numpy 4D array (size: B x h x w x F) or None, optional
+            The precomputed layer_name feature maps of the images; if provided, only the layers after layer_name are
+            run to get the gradients
+        out : numpy 3D array (size: B x H x W) or None, optional
+            Preallocated buffer to write the Grad-CAM into, or None to allocate a new one
 
         Returns
         -------
@@ -79,30 +153,133 @@ class GradCAM:
             The generated Grad-CAM for the current batch
         """
 
-        y_c = tf.gather_nd(input_model.layers[-2].output, np.dstack([range(images.shape[0]), classes])[0])
-        conv_output = input_model.get_layer(layer_name).output
+        classes = np.asarray(classes, dtype='int32')
+        head_weights = None
+        if features is not None and self.analytic_cam:
+            head_weights = self.get_head_weights(input_model, layer_name)
+        if head_weights is not None:
+            # The gradients of a global-pool + dense head are the dense weights up to a positive scale, which the
+            # per-image normalization below cancels out, so no backpropagation is needed
+            output = features
+            weights = head_weights[:, classes].T
+        else:
+            if features is None:
+                gradient_function = self.get_gradient_function(input_model, layer_name)
+                output, grads_val = gradient_function([images, classes])
+            else:
+                gradient_function = self.get_gradient_function(input_model, layer_name, from_features=True)
+                output = features
+                grads_val = gradient_function([features, classes])[0]
+            weights = np.mean(grads_val, axis=(1, 2))
+        cams = np.einsum('ijkl,il->ijk', output, weights)
 
-        def normalize(x):
-            # utility function to normalize a tensor by its L2 norm
-            return x / (K.sqrt(K.mean(K.square(x))) + 1e-5)
+        return self.upsample_cams(cams.astype(self.dtype, copy=False), out=out)
 
-        grads = normalize(K.gradients(y_c, conv_output))[0]
-        gradient_function = K.function([input_model.layers[0].input], [conv_output, grads])
+    def upsample_cams(self, cams, out=None):
+        """Upsample a stack of CAMs to the input size, apply ReLU and normalize each CAM by its maximum, in batch
 
-        output, grads_val = gradient_function([images, 0])
-        weights = np.mean(grads_val, axis=(1, 2))
-        cams = np.einsum('ijkl,il->ijk', output, weights)
+        Parameters
+        ----------
+        cams : numpy 3D array (size: B x h x w)
+            The CAMs at the resolution of the Grad-CAM layer
+        out : numpy 3D array (size: B x H x W) or None, optional
+            Preallocated buffer to write the normalized CAMs into, or None to allocate a new one
+
+        Returns
+        -------
+        heatmaps : numpy 3D array (size: B x H x W)
+            The upsampled, rectified and normalized CAMs
+        """
+
+        if out is None:
+            out = np.empty((cams.shape[0], self.size[0], self.size[1]), dtype=self.dtype)
+        # Resize the CAMs as channels of a single image, in chunks small enough for cv2.resize to accept
+        max_channels = 128
+        for start in range(0, cams.shape[0], max_channels):
+            end = min(start + max_channels, cams.shape[0])
+            resized = cv2.resize(np.ascontiguousarray(np.transpose(cams[start:end], (1, 2, 0))),
+                                 (self.size[1], self.size[0]), interpolation=self.interpolation)
+            out[start:end] = np.transpose(resized.reshape((self.size[0], self.size[1], end - start)), (2, 0, 1))
+        np.maximum(out, 0, out=out)
+        cam_max = np.max(out.reshape((out.shape[0], -1)), axis=1) if out.shape[0] > 0 else np.zeros(0)
+        out /= np.maximum(cam_max, 1e-7).astype(out.dtype)[:, None, None]
+        return out
+
+    def get_head_weights(self, input_model, layer_name):
+        """Get the dense weights of the model head if it consists only of global average pooling followed by a dense
+        layer (and its activation) after the Grad-CAM layer
+
+        Parameters
+        ----------
+        input_model : keras.engine.sequential.Sequential object
+            The input model to run Grad-CAM on
+        layer_name : str
+            The name of the model layer to run Grad-CAM on
+
+        Returns
+        -------
+        head_weights : numpy 2D array (size: F x K), where F = number of feature maps, K = number of classes, or None
+            The dense weights, or None if the model head has any other structure
+        """
 
-        new_cams = np.empty((images.shape[0], images.shape[1], images.shape[2]))
-        heatmaps = np.empty((images.shape[0], images.shape[1], images.shape[2]))
-        for i in range(cams.shape[0]):
-            new_cams[i] = cv2.resize(cams[i], (self.size[0], self.size[1]))
-            new_cams[i] = np.maximum(new_cams[i], 0)
-            heatmaps[i] = new_cams[i] / np.maximum(np.max(new_cams[i]), 1e-7)
+        key = (id(input_model), layer_name)
+        if key not in self.head_weights:
+            layer_names = [x.name for x in input_model.layers]
+            head = [x for x in input_model.layers[layer_names.index(layer_name) + 1:]
+                    if type(x) != keras.layers.core.Dropout]
+            head_weights = None
+            # The Grad-CAM score is the output of the second-last layer, so it must be the linear dense output
+            if len(head) == 3 and type(head[0]) == keras.layers.pooling.GlobalAveragePooling2D and \
+                    type(head[1]) == keras.layers.core.Dense and type(head[2]) == keras.layers.core.Activation and \
+                    head[1] is input_model.layers[-2] and head[1].get_config()['activation'] == 'linear':
+                head_weights = head[1].get_weights()[0]
+            self.head_weights[key] = (input_model, head_weights)
+        return self.head_weights[key][1]
 
-        return heatmaps
+    def get_gradient_function(self, input_model, layer_name, from_features=False):
+        """Get the function returning the layer activations and normalized class score gradients, compiling it only
+        on first use for a given model and layer so that the graph does not grow with every batch
 
-    def expand_image_wise(self, gradcam_serial, pred_image_inds, pred_class_inds, valid_classes):
+        Parameters
+        ----------
+        input_model : keras.engine.sequential.Sequential object
+            The input model to run Grad-CAM on
+        layer_name : str
+            The name of the model layer to run Grad-CAM on
+        from_features : bool, optional
+            True to feed the layer activations directly (skipping the layers before layer_name), False to feed images
+
+        Returns
+        -------
+        gradient_function : keras.backend.Function object
+            Function mapping [images, class indices] to [layer activations, normalized gradients], or
+            [layer activations, class indices] to [normalized gradients] if from_features is True
+        """
+
+        key = (id(input_model), layer_name, from_features)
+        if key not in self.gradient_functions:
+            # Class indices are fed in as an input tensor instead of being baked into the graph
+            class_inds = K.placeholder(shape=(None,), dtype='int32')
+            scores = input_model.layers[-2].output
+            y_c = tf.gather_nd(scores, tf.stack([tf.range(tf.shape(scores)[0]), class_inds], axis=1))
+            conv_output = input_model.get_layer(layer_name).output
+
+            def normalize(x):
+                # utility function to normalize a tensor by its L2 norm
+                return x / (K.sqrt(K.mean(K.square(x))) + 1e-5)
+
+            grads = normalize(K.gradients(y_c, conv_output))[0]
+            if from_features:
+                # The layer output tensor is fed directly, so only the layers after it are run
+                gradient_function = K.function([conv_output, class_inds], [grads])
+            else:
+                gradient_function = K.function([input_model.layers[0].input, class_inds], [conv_output, grads])
+            # Keep a reference to the model so that its id cannot be reused while the function is cached
+            self.gradient_functions[key] = (input_model, gradient_function)
+        return self.gradient_functions[key][1]
+
+    def expand_image_wise(self, gradcam_serial, pred_image_inds, pred_class_inds, valid_classes, out=None,
+                          sparse=False):
         """Expand the serialized Grad-CAM into 4D array, i.e. insert arrays of zeroes for unpredicted classes
 
         Parameters
@@ -115,20 +292,35 @@ class GradCAM:
             The indices of the predicted classes in the current batch, in serial form
         valid_classes : list
             The segmentation classes valid for the current problem
+        out : numpy 4D array (size: self.num_imgs x C x H x W) or None, optional
+            Preallocated buffer to write the expanded Grad-CAM into (overwritten), or None to allocate a new one
+        sparse : bool, optional
+            True to return only the predicted (image, class) planes as a SparseActivations object (out is ignored)
 
         Returns
         -------
-        gradcam_image_wise : numpy 4D array (size: self.num_imgs x C x H x W), where C = number of classes
+        gradcam_image_wise : numpy 4D array (size: self.num_imgs x C x H x W), where C = number of classes, or
+                             hsn_v1.activations.SparseActivations object
             The serialized Grad-CAM for the current batch
         """
 
-        gradcam_image_wise = np.zeros((self.num_imgs, len(valid_classes), self.size[0], self.size[1]))
-        for iter_input_file in range(self.num_imgs):
-            # Convert serial indices to valid out indices
-            cur_serial_inds = [i for i, x in enumerate(pred_image_inds) if x == iter_input_file]
-            cur_class_inds = pred_class_inds[cur_serial_inds]
-            if len(cur_class_inds) > 0:
-                gradcam_image_wise[iter_input_file, cur_class_inds] = gradcam_serial[cur_serial_inds]
+        if sparse:
+            return SparseActivations.from_serial(gradcam_serial, pred_image_inds, pred_class_inds, self.num_imgs,
+                                                 len(valid_classes), dtype=self.dtype)
+
+        shape = (self.num_imgs, len(valid_classes), self.size[0], self.size[1])
+        if out is None:
+            gradcam_image_wise = np.zeros(shape, dtype=self.dtype)
+        else:
+            if out.shape != shape:
+                raise Exception('Grad-CAM output buffer of size ' + str(out.shape) + ' does not match expected size ' +
+                                str(shape))
+            gradcam_image_wise = out
+            gradcam_image_wise.fill(0)
+        # Scatter the serial Grad-CAMs into their (image, class) planes in a single fancy-indexed assignment
+        if len(pred_image_inds) > 0:
+            gradcam_image_wise[np.asarray(pred_image_inds, dtype='int64'),
+                               np.asarray(pred_class_inds, dtype='int64')] = gradcam_serial
         return gradcam_image_wise
 
     def modify_by_htt(self, gradcam, images, atlas, htt_class, gradcam_adipose=None):
@@ -136,23 +328,32 @@ class GradCAM:
 
         Parameters
         ----------
-        gradcam : numpy 4D array (size: self.batch_size x C x W x H), where C = number of classes
-            The serialized Grad-CAM for the current batch
+        gradcam : numpy 4D array (size: self.batch_size x C x W x H), where C = number of classes, or
+                  hsn_v1.activations.SparseActivations object
+            The serialized Grad-CAM for the current batch (a SparseActivations object is modified in place)
         images : numpy 3D array (size: self.batch_size x W x H x 3)
             The input images for the current batch
         atlas : hsn_v1.adp.Atlas object
             The Atlas of Digital Pathology object
         htt_class : str
             The type of segmentation set to solve
-        gradcam_adipose : numpy 4D array (size: self.num_imgs x C x H x W), where C = number of classes,
-                          or None, optional
+        gradcam_adipose : numpy 4D array (size: self.num_imgs x C x H x W), where C = number of classes, or
+                          hsn_v1.activations.SparseActivations object, or None, optional
             Adipose class Grad-CAM (if segmenting functional types) or None (if not segmenting functional types)
 
         Returns
         -------
-        gradcam : numpy 4D array (size: self.batch_size x C x W x H), where C = number of classes
+        gradcam : numpy 4D array (size: self.batch_size x C x W x H), where C = number of classes, or
+                  hsn_v1.activations.SparseActivations object
             The modified Grad-CAM for the current batch, with non-foreground class activations appended
         """
+
+        is_dense = not isinstance(gradcam, SparseActivations)
+        if is_dense:
+            gradcam = SparseActivations.from_dense(gradcam)
+        if gradcam_adipose is not None and not isinstance(gradcam_adipose, SparseActivations):
+            gradcam_adipose = SparseActivations.from_dense(gradcam_adipose)
+
         if htt_class == 'morph':
             background_max = 0.75
             background_exception_classes = ['A.W', 'A.B', 'A.M']
@@ -170,40 +371,75 @@ class GradCAM:
             classes = atlas.glas_valid_classes
             other_ind = classes.index('Other')
             # Get other tissue class prediction
-            other_moh = np.max(gradcam, axis=1)
-            other_gradcam = np.expand_dims(other_tissue_mult * (1 - other_moh), axis=1)
-            other_gradcam = np.max(other_gradcam, axis=1)
-            other_gradcam = np.clip(other_gradcam, 0, 1)
-            gradcam[:, other_ind] = other_gradcam
+            for iter_input_image in range(len(gradcam)):
+                other_moh = gradcam.max_over_classes(iter_input_image)
+                other_gradcam = np.clip(other_tissue_mult * (1 - other_moh), 0, 1)
+                gradcam.set_plane(iter_input_image, other_ind, other_gradcam)
 
         if htt_class in ['morph', 'func']:
             background_ind = classes.index('Background')
 
             # Get background class prediction
-            sigmoid_input = 4 * (np.mean(images, axis=-1) - 240)
-            background_gradcam = background_max * scipy.special.expit(sigmoid_input)
+            background_gradcam = self.get_background(images, background_max)
             background_exception_cur_inds = [i for i, x in enumerate(classes) if x in background_exception_classes]
-            for iter_input_image in range(background_gradcam.shape[0]):
-                background_gradcam[iter_input_image] = gaussian_filter(background_gradcam[iter_input_image], sigma=2)
-            background_gradcam -= np.max(gradcam[:, background_exception_cur_inds], axis=1)
-            background_gradcam = np.clip(background_gradcam, 0, 1)
-            gradcam[:, background_ind] = background_gradcam
+            for iter_input_image in range(len(gradcam)):
+                cur_background_gradcam = background_gradcam[iter_input_image] - \
+                                         gradcam.max_over_classes(iter_input_image, background_exception_cur_inds)
+                gradcam.set_plane(iter_input_image, background_ind, np.clip(cur_background_gradcam, 0, 1))
 
-            # Get other tissue class prediction
-            if htt_class == 'func':
-                other_moh = np.max(gradcam, axis=1)
-                other_gradcam = np.expand_dims(other_tissue_mult * (1 - other_moh), axis=1)
-                other_gradcam = np.max(np.concatenate((other_gradcam, gradcam_adipose), axis=1), axis=1)
-                other_gradcam = np.clip(other_gradcam, 0, 1)
-                gradcam[:, other_ind] = other_gradcam
+                # Get other tissue class prediction
+                if htt_class == 'func':
+                    other_moh = gradcam.max_over_classes(iter_input_image)
+                    other_gradcam = np.maximum(other_tissue_mult * (1 - other_moh),
+                                               gradcam_adipose.max_over_classes(iter_input_image))
+                    gradcam.set_plane(iter_input_image, other_ind, np.clip(other_gradcam, 0, 1))
+
+        if is_dense:
+            return gradcam.to_dense()
         return gradcam
 
+    def get_background(self, images, background_max):
+        """Estimate the background class activations from the image intensities, in batch
+
+        The result is cached for the last batch of images, so that the morphological and functional passes over the
+        same images only compute it once.
+
+        Parameters
+        ----------
+        images : numpy 4D array (size: B x H x W x 3)
+            The input images for the current batch
+        background_max : float
+            The maximum background activation
+
+        Returns
+        -------
+        background_gradcam : numpy 3D array (size: B x H x W)
+            The background class activations, before subtracting the background exception classes (read-only)
+        """
+
+        if self.background_cache is not None and self.background_cache[0] is images and \
+                self.background_cache[1] == background_max:
+            return self.background_cache[2]
+        sigmoid_input = 4 * (np.mean(images, axis=-1, dtype=self.dtype) - 240)
+        background_gradcam = background_max * scipy.special.expit(sigmoid_input)
+        # Smooth every image of the stack at once (no smoothing across images)
+        background_gradcam = gaussian_filter(background_gradcam, sigma=(0, 2, 2))
+        background_gradcam.setflags(write=False)
+        self.background_cache = (images, background_max, background_gradcam)
+        return background_gradcam
+
     def get_cs_gradcam(self, gradcam, atlas, htt_class):
         """Performs class subtraction operation to modified Grad-CAM
 
+        Classes are subtracted sequentially and in place: each class activation (except for the 'Other' class in
+        functional and GlaS segmentation) has the pixel-wise maximum of all other class activations subtracted from
+        it, where the classes before it have already been subtracted. The subtracted (unclipped) activations are
+        written back to gradcam, since the functional pass reads the morphological adipose activations from it.
+
         Parameters
         ----------
-        gradcam : numpy 4D array (size: self.batch_size x C x W x H), where C = number of classes
+        gradcam : numpy 4D array (size: self.batch_size x C x W x H), where C = number of classes, or
+                  hsn_v1.activations.SparseActivations object
             The modified Grad-CAM for the current batch, with non-foreground class activations appended
         atlas : hsn_v1.adp.Atlas object
             The Atlas of Digital Pathology object
@@ -212,20 +448,66 @@ class GradCAM:
 
         Returns
         -------
-        cs_gradcam : numpy 4D array (size: self.batch_size x C x W x H), where C = number of classes
+        cs_gradcam : numpy 4D array (size: self.batch_size x C x W x H), where C = number of classes, or
+                     hsn_v1.activations.SparseActivations object
             The class-subtracted Grad-CAM for the current batch
         """
 
+        dense_gradcam = None
+        if not isinstance(gradcam, SparseActivations):
+            dense_gradcam = gradcam
+            gradcam = SparseActivations.from_dense(gradcam)
+
+        other_ind = None
         if htt_class == 'func':
             classes = atlas.func_valid_classes
             other_ind = classes.index('Other')
         elif htt_class == 'glas':
             classes = atlas.glas_valid_classes
             other_ind = classes.index('Other')
-        class_inds = range(gradcam.shape[1])
-        cs_gradcam = gradcam
-        for iter_class in range(gradcam.shape[1]):
-            if not (htt_class in ['func', 'glas'] and iter_class == other_ind):
-                cs_gradcam[:, iter_class] -= np.max(gradcam[:, np.delete(class_inds, iter_class)], axis=1)
-        cs_gradcam = np.clip(cs_gradcam, 0, 1)
-        return cs_gradcam
\ No newline at end of file
+        cs_gradcam = SparseActivations(len(gradcam), gradcam.num_classes, gradcam.size, gradcam.dtype)
+        for iter_input_image in range(len(gradcam)):
+            # Without any activation, every subtraction gives zero
+            class_inds = gradcam.class_inds(iter_input_image)
+            if len(class_inds) == 0:
+                continue
+            planes = gradcam.planes[iter_input_image]
+
+            # Pixel-wise maximum over the present classes from each present class onwards, before subtraction
+            suffix_max = {}
+            cur_max = None
+            for iter_class in reversed(class_inds):
+                cur_max = planes[iter_class] if cur_max is None else np.maximum(cur_max, planes[iter_class])
+                suffix_max[iter_class] = cur_max
+            # Pixel-wise maximum over the classes already subtracted
+            prefix_max = None
+            for iter_class in range(gradcam.num_classes):
+                is_present = iter_class in planes
+                if is_present:
+                    cur_gradcam = planes[iter_class]
+                else:
+                    cur_gradcam = np.zeros(gradcam.size, dtype=gradcam.dtype)
+                if iter_class != other_ind:
+                    # Maximum over all other classes: those before are already subtracted, those after are not (and
+                    # contribute zero if any of them is absent)
+                    later_inds = [x for x in class_inds if x > iter_class]
+                    others_max = [] if prefix_max is None else [prefix_max]
+                    if len(later_inds) > 0:
+                        others_max.append(suffix_max[later_inds[0]])
+                    if len(later_inds) < gradcam.num_classes - 1 - iter_class:
+                        others_max.append(np.zeros(gradcam.size, dtype=gradcam.dtype))
+                    cur_gradcam = cur_gradcam - np.max(np.stack(others_max), axis=0)
+                prefix_max = cur_gradcam if prefix_max is None else np.maximum(prefix_max, cur_gradcam)
+
+                # Absent classes only become present if their subtracted activations are positive anywhere
+                if is_present or np.any(cur_gradcam > 0):
+                    gradcam.set_plane(iter_input_image, iter_class, cur_gradcam)
+                if dense_gradcam is not None:
+                    dense_gradcam[iter_input_image, iter_class] = cur_gradcam
+                cur_cs_gradcam = np.clip(cur_gradcam, 0, 1)
+                if np.any(cur_cs_gradcam):
+                    cs_gradcam.set_plane(iter_input_image, iter_class, cur_cs_gradcam)
+
+        if dense_gradcam is not None:
+            return cs_gradcam.to_dense()
+        return cs_gradcam
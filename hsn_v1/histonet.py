@@ -1,6 +1,8 @@
 import os
 import keras
+import keras.backend as K
 import numpy as np
+import tensorflow as tf
 from tensorflow.keras.models import model_from_json
 from tensorflow.keras import optimizers
 import scipy
@@ -22,9 +24,22 @@ class HistoNet:
         self.relevant_inds = params['relevant_inds']
         self.input_name = params['input_name']
         self.class_names = params['class_names']
+        # Number of threads of the TensorFlow session (0 to let TensorFlow decide)
+        self.num_threads = params.get('num_threads', 0)
 
-    def build_model(self, pretrained=True):
-        """Load model architecture, weights from file and compile the model"""
+        # Compiled fused forward functions, keyed by feature layer name
+        self.forward_functions = {}
+
+    def build_model(self, pretrained=True, compile=True):
+        """Load model architecture, weights from file and compile the model (only needed for training)"""
+
+        # Restrict the session to the thread budget, e.g. of a shard worker process
+        if self.num_threads > 0:
+            config = tf.ConfigProto(intra_op_parallelism_threads=self.num_threads,
+                                    inter_op_parallelism_threads=min(self.num_threads, 2))
+            session = tf.Session(config=config)
+            K.set_session(session)
+            tf.keras.backend.set_session(session)
 
         # Load architecture from json
         model_json_path = os.path.join(self.model_dir, self.model_name + '.json')
@@ -40,30 +55,32 @@ class HistoNet:
             self.model.load_weights(model_h5_path)
 
         # Evaluate model
-        opt = optimizers.SGD(lr=0.1, decay=1e-6, momentum=0.9, nesterov=True)
-        self.model.compile(loss='binary_crossentropy', optimizer=opt, metrics=['binary_accuracy'])
+        if compile:
+            opt = optimizers.SGD(lr=0.1, decay=1e-6, momentum=0.9, nesterov=True)
+            self.model.compile(loss='binary_crossentropy', optimizer=opt, metrics=['binary_accuracy'])
 
     def normalize_image(self, X, is_glas=False):
         """Normalize the input images
 
         Parameters
         ----------
-        X : numpy 3D array (size: W x H x 3)
-            The input image, before normalizing
+        X : numpy 3D or 4D array (size: [B x] W x H x 3)
+            The input image(s), before normalizing
         is_glas : bool, optional
             True if segmenting GlaS images, False otherwise
 
         Returns
         -------
-        Y : numpy 3D array (size: W x H x 3)
-            The input image, after normalizing
+        Y : numpy 3D or 4D array (size: [B x] W x H x 3), dtype float32
+            The input image(s), after normalizing
         """
 
+        X = np.asarray(X, dtype='float32')
         if is_glas:
             # Clip values between 0 and 255
             X = np.clip(X, 0, 255)
         # Zero-mean, unit-variance normalization
-        Y = (X - self.train_mean) / (self.train_std + 1e-7)
+        Y = (X - np.float32(self.train_mean)) / np.float32(self.train_std + 1e-7)
         return Y
 
     def train_glas(self, X, y):
@@ -90,7 +107,39 @@ class HistoNet:
         tmp = scipy.io.loadmat(thresh_path)
         self.thresholds = tmp.get('optimalScoreThresh')
 
-    def predict(self, input_images, is_glas=False):
+    def predict_with_features(self, input_images, layer_name):
+        """Run a single forward pass returning both the confidence scores and the feature maps of a given layer
+
+        Parameters
+        ----------
+        input_images : numpy array (size: N x W x H x 3)
+            Normalized input images
+        layer_name : str
+            The name of the model layer whose feature maps are returned (e.g. the Grad-CAM layer)
+
+        Returns
+        -------
+        predicted_scores : numpy 2D array (size: N x K), where K = number of classes
+            The confidence scores of all classes
+        features : numpy 4D array (size: N x h x w x F), where F = number of feature maps
+            The feature maps of the given layer
+        """
+
+        if layer_name not in self.forward_functions:
+            layer_output = self.model.get_layer(layer_name).output
+            self.forward_functions[layer_name] = K.function([self.model.layers[0].input],
+                                                            [self.model.output, layer_output])
+        forward_function = self.forward_functions[layer_name]
+
+        predicted_scores = []
+        features = []
+        for start in range(0, input_images.shape[0], self.batch_size):
+            cur_scores, cur_features = forward_function([input_images[start:start + self.batch_size]])
+            predicted_scores.append(cur_scores)
+            features.append(cur_features)
+        return np.concatenate(predicted_scores, axis=0), np.concatenate(features, axis=0)
+
+    def predict(self, input_images, is_glas=False, predicted_scores=None):
         """Predict classification CNN confidence scores on input images
 
         Parameters
@@ -99,6 +148,9 @@ class HistoNet:
             Input images, single batch
         is_glas : bool, optional
             True if segmenting GlaS images, False otherwise
+        predicted_scores : numpy 2D array (size: self.batch_size x K) or None, optional
+            Confidence scores already computed for the input images (e.g. by predict_with_features), or None to run
+            the model
         Returns
         -------
         pass_threshold_image_inds : numpy 1D array (size: num_pass_threshold)
@@ -108,7 +160,8 @@ class HistoNet:
         pass_threshold_scores : numpy 1D array (size: num_pass_threshold)
             The scores of the predicted classes
         """
-        predicted_scores = self.model.predict(input_images, batch_size=self.batch_size)
+        if predicted_scores is None:
+            predicted_scores = self.model.predict(input_images, batch_size=self.batch_size)
         is_pass_threshold = np.greater_equal(predicted_scores, self.thresholds)
         if is_glas:
             exocrine_class_ind = self.class_names.index('G.O')
@@ -178,11 +231,17 @@ class HistoNet:
         return httclass_pred_image_inds, httclass_pred_class_inds, httclass_pred_scores
 
     def find_final_layer(self):
-        """Find the layer index of the last activation layer before the flatten layer"""
+        """Find the layer index of the last activation layer before the flatten layer or, for a global average pooling
+        head, of the last layer feeding the pooling layer"""
         is_after_flatten = False
+        is_after_pooling = False
         for iter_layer, layer in reversed(list(enumerate(self.model.layers))):
             if type(layer) == keras.layers.core.Flatten:
                 is_after_flatten = True
             if is_after_flatten and type(layer) == keras.layers.core.Activation:
                 return layer.name
+            if is_after_pooling and type(layer) != keras.layers.core.Dropout:
+                return layer.name
+            if not is_after_flatten and type(layer) == keras.layers.pooling.GlobalAveragePooling2D:
+                is_after_pooling = True
         raise Exception('Could not find the final layer in provided HistoNet')
\ No newline at end of file
@@ -9,21 +9,61 @@ import numpy.matlib
 import matplotlib.pyplot as plt
 import time
 import math
+import multiprocessing
+import pickle
+import hashlib
+import collections
+import queue
+import traceback
 
 from .adp import Atlas
 from .utilities import *
 from .histonet import HistoNet
 from .gradcam import GradCAM
-from .densecrf import DenseCRF
+from .densecrf import DenseCRFEngine
+from .activations import SparseActivations
+from .prefetch import BatchPrefetcher
+from .pipeline import StagePipeline
+from .writer import ImageWriter
+from .store import H5OutputStore
+from .cache import ArtifactCache
 from tqdm import tqdm
 
 OVERLAY_R = 0.75
 
+def run_shard(job, results):
+    """Segment a shard of the input images in a worker process (cf. HistoSegNetV1.run_sharded)
+
+    Parameters
+    ----------
+    job : tuple
+        The HistoSegNetV1 parameters (with shard_id set), HistoNet parameters (with num_threads set), whether HistoNet
+        is pretrained, and filenames of the images in the shard
+    results : multiprocessing.Queue
+        The queue to put the shard index, evaluation state (cf. HistoSegNetV1.get_eval_state) and error (None on
+        success) in
+    """
+
+    params, histonet_params, pretrained, input_files = job
+    try:
+        cv2.setNumThreads(histonet_params['num_threads'])
+        with HistoSegNetV1(params) as hsn:
+            hsn.input_files_all = input_files
+            hsn.load_histonet(histonet_params, pretrained)
+            hsn.run_batch()
+        results.put((params['shard_id'], hsn.get_eval_state(), None))
+    except Exception:
+        results.put((params['shard_id'], None, traceback.format_exc()))
+
 class HistoSegNetV1:
     """A wrapper class for the entire HistoSegNet"""
 
     def __init__(self, params):
-        self.input_name = params['input_name']
+        self.params = dict(params)
+        # Without an input name, images can only be segmented in memory (cf. segment_arrays), and the img, gt, tmp
+        # and out directories are not used
+        self.in_memory = params['input_name'] is None
+        self.input_name = '' if self.in_memory else params['input_name']
         self.input_size = params['input_size']
         self.input_mode = params['input_mode']
         self.down_fac = params['down_fac']
@@ -33,6 +73,29 @@ class HistoSegNetV1:
         self.run_level = params['run_level']
         self.save_types = params['save_types']
         self.verbosity = params['verbosity']
+        self.prefetch_depth = params.get('prefetch_depth', 2)
+        self.num_loaders = params.get('num_loaders', 2)
+        self.reduced_decode = params.get('reduced_decode', False)
+        self.act_dtype = params.get('act_dtype', 'float32')
+        self.fused_forward = params.get('fused_forward', True)
+        self.cam_interpolation = params.get('cam_interpolation', 'linear')
+        self.crf_workers = params.get('crf_workers', 1)
+        self.crf_tol = params.get('crf_tol', 0)
+        self.crf_tile_size = params.get('crf_tile_size', 0)
+        self.crf_tile_overlap = params.get('crf_tile_overlap', 32)
+        self.crf_scale = params.get('crf_scale', None)
+        self.crf_band = params.get('crf_band', None)
+        self.pipelined = params.get('pipelined', False)
+        self.crf_threads = params.get('crf_threads', 1)
+        self.num_writers = params.get('num_writers', 4)
+        self.writer_backlog = params.get('writer_backlog', 64)
+        self.output_backend = params.get('output_backend', 'png')
+        self.resume = params.get('resume', False)
+        self.cache_artifacts = params.get('cache_artifacts', False)
+        self.num_shards = params.get('num_shards', 1)
+        self.shard_threads = params.get('shard_threads', 0)
+        # Index of the shard segmented by this instance, if running in a shard worker process (cf. run_sharded)
+        self.shard_id = params.get('shard_id', None)
 
         if len(self.input_size) != 2:
             raise Exception('User-defined variable input_size must be a list of length 2!')
@@ -56,21 +119,110 @@ class HistoSegNetV1:
             raise Exception('User-defined variable save_level ' + self.save_level + ' not of length 4')
         if self.verbosity not in ['NORMAL', 'QUIET']:
             raise Exception('User-defined variable verbosity ' + self.verbosity + ' is not in {\'NORMAL\', \'QUIET\'}')
+        if type(self.prefetch_depth) != int or self.prefetch_depth < 0:
+            raise Exception('User-defined variable prefetch_depth ' + str(self.prefetch_depth) +
+                            ' is either non-integer or less than 0')
+        if type(self.num_loaders) != int or self.num_loaders < 1:
+            raise Exception('User-defined variable num_loaders ' + str(self.num_loaders) +
+                            ' is either non-integer or less than 1')
+        if type(self.reduced_decode) != bool:
+            raise Exception('User-defined variable reduced_decode ' + str(self.reduced_decode) + ' is not a bool')
+        if self.act_dtype not in ['float32', 'float64']:
+            raise Exception('User-defined variable act_dtype ' + str(self.act_dtype) +
+                            ' is not in {\'float32\', \'float64\'}')
+        if type(self.fused_forward) != bool:
+            raise Exception('User-defined variable fused_forward ' + str(self.fused_forward) + ' is not a bool')
+        if self.cam_interpolation not in ['nearest', 'linear', 'cubic', 'area']:
+            raise Exception('User-defined variable cam_interpolation ' + str(self.cam_interpolation) +
+                            ' is not in {\'nearest\', \'linear\', \'cubic\', \'area\'}')
+        if type(self.crf_workers) != int or self.crf_workers < 1:
+            raise Exception('User-defined variable crf_workers ' + str(self.crf_workers) +
+                            ' is either non-integer or less than 1')
+        if type(self.crf_tol) not in [int, float] or self.crf_tol < 0:
+            raise Exception('User-defined variable crf_tol ' + str(self.crf_tol) + ' is either non-numeric or less than 0')
+        if type(self.crf_tile_size) != int or self.crf_tile_size < 0:
+            raise Exception('User-defined variable crf_tile_size ' + str(self.crf_tile_size) +
+                            ' is either non-integer or less than 0')
+        if type(self.crf_tile_overlap) != int or self.crf_tile_overlap < 0 or \
+                (self.crf_tile_size > 0 and self.crf_tile_overlap >= self.crf_tile_size):
+            raise Exception('User-defined variable crf_tile_overlap ' + str(self.crf_tile_overlap) +
+                            ' is either non-integer, less than 0 or not less than crf_tile_size')
+        if self.crf_scale is not None and (type(self.crf_scale) not in [int, float] or self.crf_scale < 1):
+            raise Exception('User-defined variable crf_scale ' + str(self.crf_scale) +
+                            ' is either non-numeric or less than 1')
+        if self.crf_band is not None and (type(self.crf_band) != int or self.crf_band < 0):
+            raise Exception('User-defined variable crf_band ' + str(self.crf_band) +
+                            ' is either non-integer or less than 0')
+        if type(self.pipelined) != bool:
+            raise Exception('User-defined variable pipelined ' + str(self.pipelined) + ' is not a bool')
+        if type(self.crf_threads) != int or self.crf_threads < 1:
+            raise Exception('User-defined variable crf_threads ' + str(self.crf_threads) +
+                            ' is either non-integer or less than 1')
+        if type(self.num_writers) != int or self.num_writers < 0:
+            raise Exception('User-defined variable num_writers ' + str(self.num_writers) +
+                            ' is either non-integer or less than 0')
+        if type(self.writer_backlog) != int or self.writer_backlog < 1:
+            raise Exception('User-defined variable writer_backlog ' + str(self.writer_backlog) +
+                            ' is either non-integer or less than 1')
+        if self.output_backend not in ['png', 'h5']:
+            raise Exception('User-defined variable output_backend ' + str(self.output_backend) +
+                            ' is not in {\'png\', \'h5\'}')
+        if type(self.resume) != bool:
+            raise Exception('User-defined variable resume ' + str(self.resume) + ' is not a bool')
+        if type(self.cache_artifacts) != bool:
+            raise Exception('User-defined variable cache_artifacts ' + str(self.cache_artifacts) + ' is not a bool')
+        if type(self.num_shards) != int or self.num_shards < 1:
+            raise Exception('User-defined variable num_shards ' + str(self.num_shards) +
+                            ' is either non-integer or less than 1')
+        if type(self.shard_threads) != int or self.shard_threads < 0:
+            raise Exception('User-defined variable shard_threads ' + str(self.shard_threads) +
+                            ' is either non-integer or less than 0')
+        if self.in_memory and (self.gt_mode == 'on' or self.resume or self.cache_artifacts or self.num_shards > 1 or
+                               self.output_backend == 'h5'):
+            raise Exception('User-defined variables gt_mode, resume, cache_artifacts, num_shards and output_backend '
+                            'must be left at their defaults without an input_name')
+
+        # With reduced-resolution decoding, images are read at 1/decode_fac of their native resolution (never
+        # materialized at native resolution for JPEGs and uncompressed BMPs such as GlaS, cf. read_image) and the whole
+        # pipeline operates at that resolution, with patches downsampled by the remaining factor
+        self.decode_fac = get_reduce_fac(self.down_fac) if self.reduced_decode else 1
+        self.patch_down_fac = self.down_fac / self.decode_fac
 
         # Define folder paths
         cur_path = os.path.abspath(os.path.curdir)
         self.data_dir = os.path.join(cur_path, 'data')
         self.gt_dir = os.path.join(cur_path, 'gt')
         self.img_dir = os.path.join(cur_path, 'img')
-        self.tmp_dir = os.path.join(cur_path, 'tmp', self.input_name)
-        self.out_dir = os.path.join(cur_path, 'out', self.input_name)
-        input_dir = os.path.join(self.img_dir, self.input_name)
-        if not os.path.exists(input_dir):
-            raise Exception('Could not find user-defined input directory ' + input_dir)
-
-        # Create folders if they don't exist
-        mkdir_if_nexist(self.tmp_dir)
-        mkdir_if_nexist(self.out_dir)
+        if self.in_memory:
+            self.tmp_dir = None
+            self.out_dir = None
+        else:
+            self.tmp_dir = os.path.join(cur_path, 'tmp', self.input_name)
+            self.out_dir = os.path.join(cur_path, 'out', self.input_name)
+            input_dir = os.path.join(self.img_dir, self.input_name)
+            if not os.path.exists(input_dir):
+                raise Exception('Could not find user-defined input directory ' + input_dir)
+
+            # Create folders if they don't exist
+            mkdir_if_nexist(self.tmp_dir)
+            mkdir_if_nexist(self.out_dir)
+
+        # Output images are encoded and written in the background (and their directories created once); nothing is
+        # written while write_outputs is off (cf. segment_arrays)
+        self.write_outputs = True
+        self.is_closed = False
+        self.writer = ImageWriter(num_workers=self.num_writers, max_backlog=self.writer_backlog)
+        # With the h5 output backend, confidence scores, Grad-CAMs and segmentation masks go to a single HDF5 file
+        # instead of one image file each
+        # (HDF5 files cannot be written by several processes, so each shard writes its own, merged into the main one
+        # by run_sharded)
+        self.store = None
+        if self.output_backend == 'h5' and self.shard_id is not None:
+            self.store = H5OutputStore(os.path.join(self.out_dir, 'outputs_shard%d.h5' % self.shard_id))
+        elif self.output_backend == 'h5':
+            self.store = H5OutputStore(os.path.join(self.out_dir, 'outputs.h5'))
+        # Cache of intermediate artifacts (set up once the model is known, in load_histonet)
+        self.cache = None
 
         # Read in pre-defined ADP taxonomy
         self.atlas = Atlas()
@@ -162,9 +314,26 @@ class HistoSegNetV1:
                 self.gt_counts['Adjust'].append(np.zeros((len(self.atlas.func_valid_classes))))
                 self.gt_counts['CRF'].append(np.zeros((len(self.atlas.func_valid_classes))))
 
+        # Persistent process pool for dense CRF, spread over the images of each batch (started once all parameters and
+        # directories are validated, and before HistoNet is loaded, so that the forked workers do not inherit the
+        # model; with sharding, each shard has its own; shut down by close)
+        self.crf_pool = None
+        if self.crf_workers > 1 and self.num_shards == 1:
+            self.crf_pool = multiprocessing.Pool(self.crf_workers)
+
+        # Set up the dense CRFs of all HTT classes once for the whole run
+        # (with crf_tile_size > 0, large images such as stitched glas_full scans are processed in overlapping tiles)
+        # (with crf_scale > 1, inference runs at reduced resolution, refined in a band of crf_band pixels around class
+        # boundaries; None for the settings of the configuration files)
+        self.crf_engine = DenseCRFEngine(self.data_dir, self.htt_classes, pool=self.crf_pool, tol=self.crf_tol,
+                                         tile_size=self.crf_tile_size, tile_overlap=self.crf_tile_overlap,
+                                         scale=self.crf_scale, band=self.crf_band)
+
     def find_img(self):
         """Find images from input directory"""
 
+        if self.in_memory:
+            raise Exception('Without an input_name, images can only be segmented in memory, with segment_arrays')
         if self.verbosity == 'NORMAL':
             print('Finding images', end='')
             start_time = time.time()
@@ -214,6 +383,8 @@ class HistoSegNetV1:
 
         # Save user-defined settings
         self.model_name = params['model_name']
+        self.histonet_params = dict(params)
+        self.pretrained = pretrained
 
         # Validate user-defined settings
         model_threshold_path = os.path.join(self.data_dir, self.model_name + '.mat')
@@ -224,37 +395,119 @@ class HistoSegNetV1:
         #     raise Exception('The files corresopnding to user-defined model ' + self.model_name + ' do not exist in ' +
         #                     self.data_dir)
 
+        # Cache HistoNet scores, raw Grad-CAMs and HTT-adjusted Grad-CAMs, so that later runs can start from them
+        if self.cache_artifacts:
+            self.cache = ArtifactCache(os.path.join(self.tmp_dir, 'cache'), self.model_name, self.down_fac,
+                                       self.input_size, reduced_decode=self.reduced_decode,
+                                       cam_interpolation=self.cam_interpolation)
+
+        # With sharding, each shard worker process loads its own HistoNet instead
+        if self.num_shards > 1:
+            return
+
         if self.verbosity == 'NORMAL':
             print('Loading HistoNet', end='')
             start_time = time.time()
         # Load HistoNet
         self.hn = HistoNet(params={'model_dir': self.data_dir, 'model_name': self.model_name,
                                    'batch_size': self.batch_size, 'relevant_inds': self.atlas.level3_valid_inds,
-                                   'input_name': self.input_name, 'class_names': self.atlas.level5})
-        self.hn.build_model(pretrained)
+                                   'input_name': self.input_name, 'class_names': self.atlas.level5,
+                                   'num_threads': params.get('num_threads', 0)})
+        # (inference-only uses, such as the segmentation server, can skip compiling the training optimizer)
+        self.hn.build_model(pretrained, compile=params.get('compile', True))
 
         # Load HistoNet HTT score thresholds
         self.hn.load_thresholds(self.data_dir, self.model_name)
+
+        # Set up Grad-CAM once for the lifetime of the loaded HistoNet
+        self.gc = GradCAM(params={'htt_mode': self.htt_mode, 'size': self.input_size, 'num_imgs': None,
+                                  'batch_size': self.batch_size, 'cnn_model': self.hn.model,
+                                  'final_layer': self.hn.find_final_layer(), 'tmp_dir': self.tmp_dir,
+                                  'dtype': self.act_dtype, 'interpolation': self.cam_interpolation})
         if self.verbosity == 'NORMAL':
             print(' (%s seconds)' % (time.time() - start_time))
 
+    def close(self):
+        """Shut down the dense CRF process pool, the HDF5 output store and the output image writer, once all queued
+        outputs are written
+
+        To be called once done with the HistoSegNetV1 (e.g. after run_batch and overlap_and_segment), or left to a with
+        statement; no more images can be segmented afterwards.
+        """
+
+        if self.is_closed:
+            return
+        self.is_closed = True
+        if self.crf_pool is not None:
+            self.crf_pool.terminate()
+            self.crf_pool.join()
+            self.crf_pool = None
+            for htt_class in self.htt_classes:
+                self.crf_engine[htt_class].pool = None
+        if self.store is not None:
+            self.store.close()
+        # (last, as it raises the first error writing any image)
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def check_open(self):
+        """Raise an exception if the HistoSegNetV1 was closed (cf. close)"""
+
+        if self.is_closed:
+            raise Exception('HistoSegNetV1 was closed and can no longer segment images')
+
     def run_batch(self):
-        """Run HistoSegNet in batch mode"""
+        """Run HistoSegNet on all batches of self.input_files_all"""
 
+        self.check_open()
+        if self.in_memory:
+            raise Exception('Without an input_name, images can only be segmented in memory, with segment_arrays')
         num_batches = (len(self.input_files_all) + self.batch_size - 1) // self.batch_size
+        input_files_batches = [self.input_files_all[i * self.batch_size:(i + 1) * self.batch_size]
+                               for i in range(num_batches)]
+        if self.num_shards > 1:
+            self.run_sharded(input_files_batches)
+            return
+        self.num_completed_batches = 0
+        first_batch = 0
+        if self.resume:
+            # Skip the batches completed by a previous run, restoring its metric accumulators
+            self.run_settings = self.get_run_settings()
+            self.num_completed_batches = self.load_checkpoint()
+            first_batch = min(self.num_completed_batches, num_batches)
+            if self.verbosity == 'NORMAL' and first_batch > 0:
+                print('Resuming from batch #' + str(first_batch + 1) + ' of ' + str(num_batches))
+            input_files_batches = input_files_batches[first_batch:]
+            num_batches = len(input_files_batches)
+        if self.pipelined:
+            self.run_batch_pipelined(input_files_batches, first_batch=first_batch)
+            self.writer.flush()
+            if self.store is not None:
+                self.store.flush()
+            self.save_glas_confscores()
+            return
+        if self.prefetch_depth > 0:
+            # Decode, crop and normalize upcoming batches in the background while the current batch is segmented
+            loaded_batches = iter(BatchPrefetcher(self.read_batch, input_files_batches, depth=self.prefetch_depth,
+                                                  num_workers=self.num_loaders))
+        else:
+            loaded_batches = (self.read_batch(x) for x in input_files_batches)
         for iter_batch in tqdm(range(num_batches)):
             if self.verbosity == 'NORMAL':
                 print('\tBatch #' + str(iter_batch + 1) + ' of ' + str(num_batches))
                 batch_start_time = time.time()
 
-            # a. Load image(s)expand_image_wise
+            # a. Load image(s)
             if self.verbosity == 'NORMAL':
                 print('\t\tLoading images', end='')
                 start_time = time.time()
-            start = iter_batch * self.batch_size
-            end = min((iter_batch + 1) * self.batch_size, len(self.input_files_all))
-            self.input_files_batch = self.input_files_all[start:end]
-            self.load_norm_imgs()
+            self.input_files_batch = input_files_batches[iter_batch]
+            self.set_batch(next(loaded_batches))
             if self.verbosity == 'NORMAL':
                 print(' (%s seconds)' % (time.time() - start_time))
 
@@ -270,7 +523,7 @@ class HistoSegNetV1:
             if self.verbosity == 'NORMAL':
                 print('\t\tSegmenting images')
                 start_time = time.time()
-            self.segment_img()
+            self.segment_img(flush=False)
             if self.verbosity == 'NORMAL':
                 print('\t\t(%s seconds)' % (time.time() - start_time))
 
@@ -279,21 +532,271 @@ class HistoSegNetV1:
                 if self.verbosity == 'NORMAL':
                     print('\t\tEvaluating segmentation quality', end='')
                     start_time = time.time()
-                self.eval_segmentation(self.intersect_counts['GradCAM'], self.union_counts['GradCAM'],
-                                       self.confusion_matrix['GradCAM'], self.gt_counts['GradCAM'],
-                                       httclass_pred_segmasks=self.ablative_segmasks['GradCAM'], tag_name='GradCAM')
-                self.eval_segmentation(self.intersect_counts['Adjust'], self.union_counts['Adjust'],
-                                       self.confusion_matrix['Adjust'], self.gt_counts['Adjust'],
-                                       httclass_pred_segmasks=self.ablative_segmasks['Adjust'], tag_name='Adjust')
-                self.eval_segmentation(self.intersect_counts['CRF'], self.union_counts['CRF'],
-                                       self.confusion_matrix['CRF'], self.gt_counts['CRF'],
-                                       httclass_pred_segmasks=self.ablative_segmasks['CRF'], tag_name='CRF')
+                self.eval_batch(self.ablative_segmasks, self.httclass_gt_segmasks)
                 if self.verbosity == 'NORMAL':
                     print(' (%s seconds)' % (time.time() - start_time))
 
+            if self.resume:
+                self.save_checkpoint(first_batch + iter_batch)
+
             if self.verbosity == 'NORMAL':
                 print('\t(%s seconds)' % (time.time() - batch_start_time))
-        if self.htt_mode == 'glas' and len(self.glas_confscores) > 0:
+        # Wait for all output images to be written
+        self.writer.flush()
+        if self.store is not None:
+            self.store.flush()
+        self.save_glas_confscores()
+
+    def run_batch_pipelined(self, input_files_batches, first_batch=0):
+        """Run HistoSegNet in batch mode, with loading, segmentation and evaluation of different batches overlapping
+
+        Batches flow through a pipeline of stages separated by bounded queues: loading (self.num_loaders threads),
+        segmentation up to dense CRF (a single thread, as HistoNet and the per-batch state are shared), dense CRF
+        post-processing (self.crf_threads threads, each spreading its images over the CRF process pool, if any) and
+        evaluation (a single thread, accumulating in batch order). The outputs are the same as those of the serial
+        loop.
+
+        Parameters
+        ----------
+        input_files_batches : list of list of str
+            The filenames of the images in each batch
+        first_batch : int, optional
+            The index of the first batch in the whole run (with resuming, the number of batches already completed)
+        """
+
+        def load_stage(indexed):
+            iter_batch, input_files_batch = indexed
+            batch = self.read_batch(input_files_batch)
+            return iter_batch, input_files_batch, batch, self.read_gt(input_files_batch, batch['orig_sizes'])
+
+        def segment_stage(loaded):
+            iter_batch, self.input_files_batch, batch, gt = loaded
+            self.set_batch(batch)
+            self.set_gt(gt)
+            return iter_batch, self.segment_htt(), gt['gt_segmasks']
+
+        def crf_stage(segmented):
+            iter_batch, job, gt_segmasks = segmented
+            self.segment_crf(job)
+            return iter_batch, job['ablative_segmasks'], gt_segmasks
+
+        def eval_stage(segmented):
+            # (a single worker, which the pipeline stops on the first failure, so batches are evaluated and
+            # checkpointed in order and never after a failed batch)
+            iter_batch, ablative_segmasks, gt_segmasks = segmented
+            if self.gt_mode == 'on' and self.run_level == 3:
+                self.eval_batch(ablative_segmasks, gt_segmasks)
+            if self.resume:
+                self.save_checkpoint(iter_batch)
+
+        pipeline = StagePipeline([('load', load_stage, self.num_loaders), ('segment', segment_stage, 1),
+                                  ('crf', crf_stage, self.crf_threads), ('eval', eval_stage, 1)],
+                                 queue_size=max(self.prefetch_depth, 1))
+        for _ in tqdm(pipeline.run(list(enumerate(input_files_batches, first_batch))), total=len(input_files_batches)):
+            pass
+        if self.verbosity == 'NORMAL':
+            print('Pipeline stage utilization:\n' + pipeline.report_utilization())
+
+    def eval_batch(self, ablative_segmasks, httclass_gt_segmasks):
+        """Accumulate and export the segmentation quality of a batch at each ablative stage
+
+        Parameters
+        ----------
+        ablative_segmasks : dict
+            The predicted segmentation masks of each HTT class, keyed by ablative stage ('GradCAM', 'Adjust', 'CRF')
+        httclass_gt_segmasks : numpy array
+            The ground-truth segmentation masks of each HTT class
+        """
+
+        for tag_name in ['GradCAM', 'Adjust', 'CRF']:
+            # (shard workers only accumulate, the merged metrics are exported by the main process)
+            if self.shard_id is not None:
+                self.accumulate_segmentation(self.intersect_counts[tag_name], self.union_counts[tag_name],
+                                             self.confusion_matrix[tag_name], self.gt_counts[tag_name],
+                                             ablative_segmasks[tag_name], httclass_gt_segmasks)
+                continue
+            self.eval_segmentation(self.intersect_counts[tag_name], self.union_counts[tag_name],
+                                   self.confusion_matrix[tag_name], self.gt_counts[tag_name],
+                                   httclass_pred_segmasks=ablative_segmasks[tag_name], tag_name=tag_name,
+                                   httclass_gt_segmasks=httclass_gt_segmasks)
+
+    def run_sharded(self, input_files_batches):
+        """Run HistoSegNet in batch mode, with the batches partitioned across self.num_shards worker processes
+
+        Each worker segments a contiguous range of batches with its own HistoNet and thread budget, writing its
+        outputs as the single-process run would, and sends back its evaluation state, which is merged into the same
+        metric CSVs. With the h5 output backend, the HDF5 files of the shards are merged into the main one (for
+        overlap_and_segment). Workers are spawned, not forked, so they do not inherit the TensorFlow state of this
+        process; scripts running shards must therefore guard their entry point with if __name__ == '__main__'.
+
+        Parameters
+        ----------
+        input_files_batches : list of list of str
+            The filenames of the images in each batch
+        """
+
+        if self.shard_threads > 0:
+            num_threads = self.shard_threads
+        else:
+            num_threads = max(multiprocessing.cpu_count() // self.num_shards, 1)
+        # Workers are not daemonic, so they can have their own CRF process pools
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        workers = {}
+        for shard_id, batch_inds in enumerate(np.array_split(np.arange(len(input_files_batches)), self.num_shards)):
+            if len(batch_inds) == 0:
+                continue
+            input_files = [x for i in batch_inds for x in input_files_batches[i]]
+            job = (dict(self.params, num_shards=1, shard_id=shard_id),
+                   dict(self.histonet_params, num_threads=num_threads), self.pretrained, input_files)
+            workers[shard_id] = context.Process(target=run_shard, args=(job, results))
+            workers[shard_id].start()
+        if self.verbosity == 'NORMAL':
+            print('Running ' + str(len(workers)) + ' shards with ' + str(num_threads) + ' threads each')
+
+        states = {}
+        try:
+            while len(states) < len(workers):
+                try:
+                    shard_id, state, error = results.get(timeout=1)
+                except queue.Empty:
+                    for shard_id, worker in workers.items():
+                        if shard_id not in states and worker.exitcode not in [None, 0]:
+                            raise Exception('Shard #' + str(shard_id) + ' exited with code ' + str(worker.exitcode))
+                    continue
+                if error is not None:
+                    raise Exception('Shard #' + str(shard_id) + ' failed:\n' + error)
+                states[shard_id] = state
+        finally:
+            for worker in workers.values():
+                if len(states) < len(workers):
+                    worker.terminate()
+                worker.join()
+
+        # Merge in shard order, so that per-image results stay in the order of the input files
+        for shard_id in sorted(states.keys()):
+            self.merge_eval_state(states[shard_id])
+            shard_store_path = os.path.join(self.out_dir, 'outputs_shard%d.h5' % shard_id)
+            if self.store is not None and os.path.exists(shard_store_path):
+                self.store.merge(shard_store_path)
+                os.remove(shard_store_path)
+        if self.store is not None:
+            self.store.flush()
+        if self.gt_mode == 'on' and self.run_level == 3:
+            for tag_name in ['GradCAM', 'Adjust', 'CRF']:
+                self.export_segmentation_metrics(self.intersect_counts[tag_name], self.union_counts[tag_name],
+                                                 self.confusion_matrix[tag_name], self.gt_counts[tag_name],
+                                                 tag_name=tag_name)
+        self.save_glas_confscores()
+
+    def get_eval_state(self):
+        """Get the evaluation state (metric accumulators and GlaS confidence scores) accumulated so far
+
+        Returns
+        -------
+        state : dict
+            The intersection, union, GT counts and confusion matrices of each ablative stage and HTT class (if
+            gt_mode is on) and the GlaS confidence scores of each image (if htt_mode is glas)
+        """
+
+        state = {}
+        if self.gt_mode == 'on':
+            state['intersect_counts'] = self.intersect_counts
+            state['union_counts'] = self.union_counts
+            state['confusion_matrix'] = self.confusion_matrix
+            state['gt_counts'] = self.gt_counts
+        if self.htt_mode == 'glas':
+            state['glas_confscores'] = self.glas_confscores
+        return state
+
+    def merge_eval_state(self, state):
+        """Merge an evaluation state (cf. get_eval_state) of other images into the current one
+
+        The counts and confusion matrices are summed, and the GlaS confidence scores appended.
+        """
+
+        if self.gt_mode == 'on':
+            for name in ['intersect_counts', 'union_counts', 'confusion_matrix', 'gt_counts']:
+                counts = getattr(self, name)
+                for tag_name in counts.keys():
+                    for iter_httclass in range(len(counts[tag_name])):
+                        counts[tag_name][iter_httclass] += state[name][tag_name][iter_httclass]
+        if self.htt_mode == 'glas':
+            self.glas_confscores += list(state['glas_confscores'])
+
+    def get_checkpoint_path(self):
+        """Get the file path of the run checkpoint manifest (one per shard, with sharding)"""
+
+        if self.shard_id is not None:
+            return os.path.join(self.tmp_dir, 'checkpoint_shard%d.pkl' % self.shard_id)
+        return os.path.join(self.tmp_dir, 'checkpoint.pkl')
+
+    def get_run_settings(self):
+        """Get the settings a checkpoint is only valid for, including the input files (as a hash, since batches are
+        checkpointed by count) and the dense CRF parameters of each HTT class (with their multi-scale configuration)
+        """
+
+        input_files_hash = hashlib.sha1('\n'.join(self.input_files_all).encode()).hexdigest()
+        crf_params = dict([(x, dict([(y, float(z)) for y, z in self.crf_engine[x].get_params().items()]))
+                           for x in self.htt_classes])
+        return {'model_name': self.model_name, 'input_size': list(self.input_size), 'input_mode': self.input_mode,
+                'down_fac': self.down_fac, 'reduced_decode': self.reduced_decode, 'batch_size': self.batch_size,
+                'htt_mode': self.htt_mode, 'gt_mode': self.gt_mode, 'run_level': self.run_level,
+                'save_types': list(self.save_types), 'output_backend': self.output_backend,
+                'input_files': input_files_hash, 'crf_tol': self.crf_tol, 'crf_tile_size': self.crf_tile_size,
+                'crf_tile_overlap': self.crf_tile_overlap, 'crf_params': crf_params}
+
+    def save_checkpoint(self, iter_batch):
+        """Record a batch as completed in the run checkpoint manifest, along with the metric accumulators
+
+        The outputs of the batch are written out first, and the manifest is replaced atomically, so that a run
+        killed at any point resumes from a consistent state. A batch is only checkpointed once every earlier batch
+        is, so the manifest only holds their count (and stays the same size as the run goes on).
+
+        Parameters
+        ----------
+        iter_batch : int
+            The index of the completed batch in the whole run
+        """
+
+        if iter_batch != self.num_completed_batches:
+            raise Exception('Batch #' + str(iter_batch + 1) + ' cannot be checkpointed before batch #' +
+                            str(self.num_completed_batches + 1))
+        self.writer.flush()
+        if self.store is not None:
+            self.store.flush()
+        self.num_completed_batches += 1
+        checkpoint = {'settings': self.run_settings, 'num_completed_batches': self.num_completed_batches,
+                      'eval_state': self.get_eval_state()}
+        checkpoint_path = self.get_checkpoint_path()
+        with open(checkpoint_path + '.tmp', 'wb') as f:
+            pickle.dump(checkpoint, f)
+        os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+    def load_checkpoint(self):
+        """Restore the metric accumulators from the run checkpoint manifest, if valid for the current settings
+
+        Returns
+        -------
+        num_completed_batches : int
+            The number of batches completed by the checkpointed run (0 if there is none)
+        """
+
+        checkpoint_path = self.get_checkpoint_path()
+        if not os.path.exists(checkpoint_path):
+            return 0
+        with open(checkpoint_path, 'rb') as f:
+            checkpoint = pickle.load(f)
+        if checkpoint['settings'] != self.run_settings or 'num_completed_batches' not in checkpoint:
+            print('Warning: run checkpoint ' + checkpoint_path + ' was made with different settings - starting over')
+            return 0
+        self.merge_eval_state(checkpoint['eval_state'])
+        return checkpoint['num_completed_batches']
+
+    def save_glas_confscores(self):
+        """Export the mean GlaS exocrine confidence score of each image"""
+
+        if self.htt_mode == 'glas' and len(self.glas_confscores) > 0 and self.shard_id is None:
             items = []
             for iter_image, file in enumerate(self.input_files_all):
                 items.append((file, [self.glas_confscores[iter_image]]))
@@ -304,121 +807,304 @@ class HistoSegNetV1:
     def load_norm_imgs(self):
         """Read image files from filepaths and normalize them"""
 
+        self.set_batch(self.read_batch(self.input_files_batch))
+
+    def read_batch(self, input_files_batch):
+        """Read a batch of image files, crop them into patches and normalize them
+
+        This does not modify the object state, so it can safely be run in a background thread.
+
+        Parameters
+        ----------
+        input_files_batch : list of str
+            The filenames of the images in the batch
+
+        Returns
+        -------
+        batch : dict
+            The original images ('orig_images'), padded original images ('orig_images_cropped'), original sizes
+            ('orig_sizes'), native sizes before reduced-resolution decoding ('full_sizes'), number of crops per image
+            ('num_crops'), cropped patches ('input_images'), normalized cropped patches ('input_images_norm') and
+            artifact cache keys ('image_keys', None without cache) of the batch
+        """
+
         input_dir = os.path.join(self.img_dir, self.input_name)
         # Load raw images
-        self.orig_images = [None] * len(self.input_files_batch)
-        self.orig_images_cropped = [None] * len(self.input_files_batch)
-        self.orig_sizes = [None] * len(self.input_files_batch)
-        self.crop_offsets = [None] * len(self.input_files_batch)
-        self.num_crops = [None] * len(self.input_files_batch)
-        for iter_input_file, input_file in enumerate(self.input_files_batch):
+        orig_images = [None] * len(input_files_batch)
+        full_sizes = [None] * len(input_files_batch)
+        for iter_input_file, input_file in enumerate(input_files_batch):
             input_path = os.path.join(input_dir, input_file)
-            self.orig_images[iter_input_file] = read_image(input_path)
-            self.orig_sizes[iter_input_file] = self.orig_images[iter_input_file].shape[:2]
-            downsampled_size = [round(x / self.down_fac) for x in self.orig_sizes[iter_input_file]]
+            orig_images[iter_input_file] = read_image(input_path, self.decode_fac)
+            if self.decode_fac > 1:
+                full_sizes[iter_input_file] = read_image_size(input_path)
+            else:
+                full_sizes[iter_input_file] = orig_images[iter_input_file].shape[:2]
+
+        image_keys = None
+        if self.cache is not None:
+            image_keys = [self.cache.get_key(os.path.join(input_dir, x)) for x in input_files_batch]
+
+        return self.prepare_batch(orig_images, full_sizes, image_keys)
+
+    def prepare_batch(self, orig_images, full_sizes, image_keys=None):
+        """Crop a batch of decoded images into patches and normalize them (cf. read_batch)
+
+        Parameters
+        ----------
+        orig_images : list of numpy 3D array (size: H x W x 3)
+            The decoded images in the batch, in RGB format
+        full_sizes : list of tuple (size: 2)
+            The native sizes of the images in the batch, before reduced-resolution decoding
+        image_keys : list of str or None, optional
+            The artifact cache keys of the images in the batch, or None without cache
+
+        Returns
+        -------
+        batch : dict
+            The batch, as returned by read_batch
+        """
+
+        orig_images_cropped = [None] * len(orig_images)
+        orig_sizes = [None] * len(orig_images)
+        num_crops = [None] * len(orig_images)
+        for iter_input_file in range(len(orig_images)):
+            orig_sizes[iter_input_file] = orig_images[iter_input_file].shape[:2]
+            downsampled_size = [round(x / self.patch_down_fac) for x in orig_sizes[iter_input_file]]
 
             # If downsampled image is smaller than the patch size, then mirror pad first, then downsample
             if downsampled_size[0] < self.input_size[0] or downsampled_size[1] < self.input_size[1]:
                 pad_vert = math.ceil(
-                    max(self.input_size[0] * self.down_fac - self.orig_sizes[iter_input_file][0], 0) / 2)
+                    max(self.input_size[0] * self.patch_down_fac - orig_sizes[iter_input_file][0], 0) / 2)
                 pad_horz = math.ceil(
-                    max(self.input_size[1] * self.down_fac - self.orig_sizes[iter_input_file][1], 0) / 2)
-                downsampled_size[0] = round((self.orig_sizes[iter_input_file][0] + 2 * pad_vert) / self.down_fac)
-                downsampled_size[1] = round((self.orig_sizes[iter_input_file][1] + 2 * pad_horz) / self.down_fac)
-            self.num_crops[iter_input_file] = [math.ceil(downsampled_size[i] / self.input_size[i]) for i in range(2)]
-        self.orig_images = np.array(self.orig_images)
-
-        num_patches = sum([np.prod(np.array(x)) for x in self.num_crops])
-        self.input_images = np.zeros((num_patches, self.input_size[0], self.input_size[1], 3))
+                    max(self.input_size[1] * self.patch_down_fac - orig_sizes[iter_input_file][1], 0) / 2)
+                downsampled_size[0] = round((orig_sizes[iter_input_file][0] + 2 * pad_vert) / self.patch_down_fac)
+                downsampled_size[1] = round((orig_sizes[iter_input_file][1] + 2 * pad_horz) / self.patch_down_fac)
+            num_crops[iter_input_file] = [math.ceil(downsampled_size[i] / self.input_size[i]) for i in range(2)]
+        orig_images = np.array(orig_images)
+
+        num_patches = sum([np.prod(np.array(x)) for x in num_crops])
+        # Pixels stay uint8 until normalization
+        input_images = np.zeros((num_patches, self.input_size[0], self.input_size[1], 3), dtype='uint8')
         start = 0
-        for iter_input_file in range(len(self.input_files_batch)):
-            end = start + np.prod(np.array(self.num_crops[iter_input_file]))
-            self.input_images[start:end], self.orig_images_cropped[iter_input_file] = crop_into_patches(
-                self.orig_images[iter_input_file], self.down_fac, self.input_size)
-            start += np.prod(np.array(self.num_crops[iter_input_file]))
+        for iter_input_file in range(len(orig_images)):
+            end = start + np.prod(np.array(num_crops[iter_input_file]))
+            input_images[start:end], orig_images_cropped[iter_input_file] = crop_into_patches(
+                orig_images[iter_input_file], self.patch_down_fac, self.input_size)
+            start += np.prod(np.array(num_crops[iter_input_file]))
 
         # Normalize images
-        self.input_images_norm = np.zeros_like(self.input_images)
-        for iter_input_image, input_image in enumerate(self.input_images):
-            self.input_images_norm[iter_input_image] = self.hn.normalize_image(input_image, self.htt_mode == 'glas')
+        input_images_norm = self.hn.normalize_image(input_images, self.htt_mode == 'glas')
+
+        return {'orig_images': orig_images, 'orig_images_cropped': orig_images_cropped, 'orig_sizes': orig_sizes,
+                'full_sizes': full_sizes, 'num_crops': num_crops, 'input_images': input_images,
+                'input_images_norm': input_images_norm, 'image_keys': image_keys}
+
+    def set_batch(self, batch):
+        """Make a batch loaded by read_batch the current batch"""
+
+        self.orig_images = batch['orig_images']
+        self.orig_images_cropped = batch['orig_images_cropped']
+        self.orig_sizes = batch['orig_sizes']
+        self.full_sizes = batch['full_sizes']
+        self.num_crops = batch['num_crops']
+        self.input_images = batch['input_images']
+        self.input_images_norm = batch['input_images_norm']
+        self.image_keys = batch['image_keys']
 
     def load_gt(self):
         """Load ground-truth annotation images from file and generate legends for debugging"""
 
-        self.httclass_gt_segmasks = []
-        self.httclass_gt_class_inds = [None] * len(self.htt_classes)
+        self.set_gt(self.read_gt(self.input_files_batch, self.orig_sizes))
+
+    def read_gt(self, input_files_batch, orig_sizes):
+        """Read the ground-truth annotation images of a batch and generate legends for debugging
+
+        This does not modify the object state, so it can safely be run in a background thread.
+
+        Parameters
+        ----------
+        input_files_batch : list of str
+            The filenames of the images in the batch
+        orig_sizes : list of tuple
+            The original sizes of the images in the batch
+
+        Returns
+        -------
+        gt : dict
+            The ground-truth segmentation masks ('gt_segmasks'), class indices ('gt_class_inds') and legends
+            ('gt_legends') of each HTT class
+        """
+
+        httclass_gt_segmasks = []
+        httclass_gt_class_inds = [None] * len(self.htt_classes)
         if self.gt_mode == 'on':
-            self.httclass_gt_legends = [None] * len(self.htt_classes)
+            httclass_gt_legends = [None] * len(self.htt_classes)
         elif self.gt_mode == 'off':
-            self.httclass_gt_legends = [[None] * len(self.input_files_batch)] * len(self.htt_classes)
+            httclass_gt_legends = [[None] * len(input_files_batch)] * len(self.htt_classes)
         for iter_httclass, htt_class in enumerate(self.htt_classes):
             gt_segmasks = []
             # Load gt segmentation images
             if self.gt_mode == 'on':
-                for iter_input_file, input_file in enumerate(self.input_files_batch):
+                for iter_input_file, input_file in enumerate(input_files_batch):
                     gt_segmask_path = os.path.join(self.httclass_gt_dirs[iter_httclass], input_file)
-                    gt_segmasks.append(read_segmask(gt_segmask_path, size=self.orig_sizes[iter_input_file]))
+                    gt_segmasks.append(read_segmask(gt_segmask_path, size=orig_sizes[iter_input_file]))
                 # Load gt class labels
-                self.httclass_gt_class_inds[iter_httclass] = segmask_to_class_inds(gt_segmasks,
-                                                                       self.httclass_valid_colours[iter_httclass])
+                httclass_gt_class_inds[iter_httclass] = segmask_to_class_inds(gt_segmasks,
+                                                                  self.httclass_valid_colours[iter_httclass])
                 # Load gt legend
-                self.httclass_gt_legends[iter_httclass] = get_legends(self.httclass_gt_class_inds[iter_httclass],
-                                                                      self.orig_sizes[0],
-                                                                      self.httclass_valid_classes[iter_httclass],
-                                                                      self.httclass_valid_colours[iter_httclass])
+                httclass_gt_legends[iter_httclass] = get_legends(httclass_gt_class_inds[iter_httclass],
+                                                                 orig_sizes[0],
+                                                                 self.httclass_valid_classes[iter_httclass],
+                                                                 self.httclass_valid_colours[iter_httclass])
             elif self.gt_mode == 'off':
-                for iter_input_file in range(len(self.input_files_batch)):
-                    gt_segmasks.append(np.zeros((self.orig_sizes[iter_input_file][0],
-                                                 self.orig_sizes[iter_input_file][1], 3)))
-                    self.httclass_gt_legends[iter_httclass][iter_input_file] = np.zeros(
-                        (self.orig_sizes[iter_input_file][0],
-                         self.orig_sizes[iter_input_file][1], 3))
-            self.httclass_gt_segmasks.append(gt_segmasks)
-        self.httclass_gt_segmasks = np.array(self.httclass_gt_segmasks)
-        self.httclass_gt_legends = np.array(self.httclass_gt_legends)
-
-    def segment_img(self):
-        """Segment a given batch of images"""
+                for iter_input_file in range(len(input_files_batch)):
+                    gt_segmasks.append(np.zeros((orig_sizes[iter_input_file][0],
+                                                 orig_sizes[iter_input_file][1], 3), dtype='uint8'))
+                    httclass_gt_legends[iter_httclass][iter_input_file] = np.zeros(
+                        (orig_sizes[iter_input_file][0],
+                         orig_sizes[iter_input_file][1], 3))
+            httclass_gt_segmasks.append(gt_segmasks)
+        return {'gt_segmasks': np.array(httclass_gt_segmasks), 'gt_class_inds': httclass_gt_class_inds,
+                'gt_legends': np.array(httclass_gt_legends)}
+
+    def set_gt(self, gt):
+        """Make ground-truth data loaded by read_gt that of the current batch"""
+
+        self.httclass_gt_segmasks = gt['gt_segmasks']
+        self.httclass_gt_class_inds = gt['gt_class_inds']
+        self.httclass_gt_legends = gt['gt_legends']
+
+    def segment_img(self, flush=True):
+        """Segment a given batch of images
+
+        Besides being written out (if write_outputs is on), the confidence scores, Grad-CAMs and segmentation masks of
+        each HTT class are kept in self.outputs (cf. segment_arrays).
+
+        Parameters
+        ----------
+        flush : bool, optional
+            Whether to wait for the outputs to be written out (raising the first error writing any of them), as when
+            segmenting batches one by one (e.g. in the demo notebooks); run_batch flushes only at checkpoints and at
+            the end of the run
+        """
+
+        self.check_open()
+        self.segment_crf(self.segment_htt())
+        if flush:
+            self.writer.flush()
+            if self.store is not None:
+                self.store.flush()
+
+    def segment_htt(self):
+        """Segment a given batch of images up to dense CRF post-processing: classification CNN, Grad-CAM and
+        inter-HTT adjustments (cf. segment_img)
+
+        Returns
+        -------
+        job : dict
+            The batch state and HTT-adjusted Grad-CAMs of each HTT class to be post-processed, for segment_crf
+        """
+
+        save_types = self.save_types if self.write_outputs else [0, 0, 0, 0]
+        # (batches given as arrays have no cache keys)
+        cache = self.cache if self.image_keys is not None else None
+        self.outputs = {}
+
+        # Start from the latest stage cached for all images in the batch, if any
+        # (start and end patch indices of each image, and of each image's (stitched) Grad-CAMs)
+        patch_ends = np.cumsum([np.prod(np.array(x)) for x in self.num_crops])
+        patch_ranges = [(int(x - np.prod(np.array(y))), int(x)) for x, y in zip(patch_ends, self.num_crops)]
+        if 'glas_full' in self.input_name:
+            image_ranges = [(i, i + 1) for i in range(len(self.input_files_batch))]
+        else:
+            image_ranges = patch_ranges
+        cached_scores, httclass_cached_gradcam = None, None
+        if cache is not None:
+            cached_scores = cache.load_scores(self.image_keys, patch_ranges, self.htt_classes)
+            if cached_scores is not None and self.run_level > 1:
+                httclass_cached_gradcam = [cache.load_activations('gradcam', x, self.image_keys, patch_ranges,
+                                                                  self.act_dtype) for x in self.htt_classes]
+                if any([x is None for x in httclass_cached_gradcam]):
+                    httclass_cached_gradcam = None
 
         # 1. Patch-level Classification CNN
-        # Obtain confidence scores
-        if self.verbosity == 'NORMAL':
-            print('\t\t\tApplying HistoNet', end='')
-            start_time = time.time()
-        pred_image_inds, pred_class_inds, pred_scores = self.hn.predict(self.input_images_norm, self.htt_mode == 'glas')
-        if self.verbosity == 'NORMAL':
-            print(' (%s seconds)' % (time.time() - start_time))
+        if cached_scores is not None and (self.run_level == 1 or httclass_cached_gradcam is not None):
+            if self.verbosity == 'NORMAL':
+                print('\t\t\tLoaded HistoNet scores from cache')
+            httclass_pred_image_inds, httclass_pred_class_inds, httclass_pred_scores = cached_scores
+        else:
+            # Obtain confidence scores
+            if self.verbosity == 'NORMAL':
+                print('\t\t\tApplying HistoNet', end='')
+                start_time = time.time()
+            if self.fused_forward and self.run_level > 1:
+                # A single forward pass yields both the confidence scores and the Grad-CAM layer feature maps
+                predicted_scores, features = self.hn.predict_with_features(self.input_images_norm, self.gc.final_layer)
+            else:
+                # Unfused: the confidence scores come from their own forward pass, and Grad-CAM runs the model on the
+                # input images again
+                predicted_scores, features = None, None
+            pred_image_inds, pred_class_inds, pred_scores = self.hn.predict(self.input_images_norm,
+                                                                            self.htt_mode == 'glas',
+                                                                            predicted_scores=predicted_scores)
+            if self.verbosity == 'NORMAL':
+                print(' (%s seconds)' % (time.time() - start_time))
 
-        # Split by HTT class
-        if self.verbosity == 'NORMAL':
-            print('\t\t\tSplitting by HTT class', end='')
-            start_time = time.time()
-        httclass_pred_image_inds, httclass_pred_class_inds, httclass_pred_scores = self.hn.split_by_htt_class(
-            pred_image_inds, pred_class_inds, pred_scores, self.htt_mode, self.atlas)
-        if self.verbosity == 'NORMAL':
-            print(' (%s seconds)' % (time.time() - start_time))
+            # Split by HTT class
+            if self.verbosity == 'NORMAL':
+                print('\t\t\tSplitting by HTT class', end='')
+                start_time = time.time()
+            httclass_pred_image_inds, httclass_pred_class_inds, httclass_pred_scores = self.hn.split_by_htt_class(
+                pred_image_inds, pred_class_inds, pred_scores, self.htt_mode, self.atlas)
+            if self.verbosity == 'NORMAL':
+                print(' (%s seconds)' % (time.time() - start_time))
+
+            if cache is not None:
+                cache.save_scores(self.image_keys, patch_ranges, httclass_pred_image_inds,
+                                  httclass_pred_class_inds, httclass_pred_scores, self.htt_classes)
 
         # 2. Patch-level Segmentation (Grad-CAM)
-        final_layer = self.hn.find_final_layer()
-        gc = GradCAM(params={'htt_mode': self.htt_mode, 'size': self.input_size,
-                             'num_imgs': self.input_images_norm.shape[0], 'batch_size': len(self.input_files_batch),
-                             'cnn_model': self.hn.model, 'final_layer': final_layer, 'tmp_dir': self.tmp_dir})
+        # (the GradCAM object lives as long as HistoNet, so its compiled gradient functions are reused across batches)
+        gc = self.gc
+        gc.num_imgs = self.input_images_norm.shape[0]
+        gc.batch_size = len(self.input_files_batch)
         httclass_gradcam_image_wise = []
+        crf_httclasses = []
         self.ablative_segmasks = {}
         self.ablative_segmasks['GradCAM'] = []
         self.ablative_segmasks['Adjust'] = []
         self.ablative_segmasks['CRF'] = []
 
+        # Generate serial Grad-CAM for all HTT classes at once, grouped by image
+        if self.run_level > 1 and httclass_cached_gradcam is None:
+            if self.verbosity == 'NORMAL':
+                print('\t\t\tGenerating Grad-CAM', end='')
+                start_time = time.time()
+            httclass_gradcam_serial = gc.gen_gradcam_httclasses(httclass_pred_image_inds, httclass_pred_class_inds,
+                                                                httclass_pred_scores, self.input_images_norm,
+                                                                self.atlas, self.httclass_valid_classes,
+                                                                features=features)
+            if self.verbosity == 'NORMAL':
+                print(' (%s seconds)' % (time.time() - start_time))
+
         for iter_httclass in range(len(self.htt_classes)):
             htt_class = self.htt_classes[iter_httclass]
-            if self.save_types[0]:
-                if htt_class != 'glas':
+            self.outputs[htt_class] = {'scores': {'image_inds': httclass_pred_image_inds[iter_httclass],
+                                                  'class_inds': httclass_pred_class_inds[iter_httclass],
+                                                  'scores': httclass_pred_scores[iter_httclass]},
+                                       'masks': {}}
+            if save_types[0]:
+                if htt_class != 'glas' and self.store is not None:
+                    self.store.add_scores(httclass_pred_image_inds[iter_httclass],
+                                          httclass_pred_class_inds[iter_httclass],
+                                          httclass_pred_scores[iter_httclass], self.input_files_batch, htt_class)
+                elif htt_class != 'glas':
                     out_patchconf_dir = os.path.join(self.out_dir, htt_class, 'patchconfidence')
-                    mkdir_if_nexist(out_patchconf_dir)
                     save_patchconfidence(httclass_pred_image_inds[iter_httclass],
                                          httclass_pred_class_inds[iter_httclass],
                                          httclass_pred_scores[iter_httclass], self.input_size, out_patchconf_dir,
-                                         self.input_files_batch, self.httclass_valid_classes[iter_httclass])
+                                         self.input_files_batch, self.httclass_valid_classes[iter_httclass],
+                                         writer=self.writer)
                 elif htt_class == 'glas':
                     exocrine_class_ind = self.atlas.glas_valid_classes.index('G.O')
                     exocrine_scores = httclass_pred_scores[iter_httclass][
@@ -426,83 +1112,106 @@ class HistoSegNetV1:
                     if len(exocrine_scores) < self.input_images.shape[0]:
                         raise Exception('Number of detected GlaS exocrine scores ' + str(len(exocrine_scores)) +
                                         ' less than number of crops in image' + str(self.input_images.shape[0]) + '!')
-                    self.glas_confscores.append(np.mean(exocrine_scores))
+                    if self.write_outputs:
+                        self.glas_confscores.append(np.mean(exocrine_scores))
             if self.run_level == 1:
                 continue
 
-            # Generate serial Grad-CAM
-            if self.verbosity == 'NORMAL':
-                print('\t\t\t[' + htt_class + '] Generating Grad-CAM', end='')
-                start_time = time.time()
-            gradcam_serial = gc.gen_gradcam(httclass_pred_image_inds[iter_httclass],
-                                            httclass_pred_class_inds[iter_httclass],
-                                            httclass_pred_scores[iter_httclass],
-                                            self.input_images_norm, self.atlas,
-                                            self.httclass_valid_classes[iter_httclass])
-            if self.verbosity == 'NORMAL':
-                print(' (%s seconds)' % (time.time() - start_time))
-
             # Expand Grad-CAM for each image
             if self.verbosity == 'NORMAL':
                 print('\t\t\t[' + htt_class + '] Expanding Grad-CAM', end='')
                 start_time = time.time()
-            gradcam_image_wise = gc.expand_image_wise(gradcam_serial, httclass_pred_image_inds[iter_httclass],
-                                                      httclass_pred_class_inds[iter_httclass],
-                                                      self.httclass_valid_classes[iter_httclass])
+            if httclass_cached_gradcam is not None:
+                gradcam_image_wise = httclass_cached_gradcam[iter_httclass]
+            else:
+                # (only the predicted (image, class) planes are stored)
+                gradcam_image_wise = gc.expand_image_wise(httclass_gradcam_serial[iter_httclass],
+                                                          httclass_pred_image_inds[iter_httclass],
+                                                          httclass_pred_class_inds[iter_httclass],
+                                                          self.httclass_valid_classes[iter_httclass], sparse=True)
+                if cache is not None:
+                    cache.save_activations('gradcam', htt_class, self.image_keys, patch_ranges, gradcam_image_wise)
             if self.verbosity == 'NORMAL':
                 print(' (%s seconds)' % (time.time() - start_time))
             httclass_gradcam_image_wise.append(gradcam_image_wise)
 
             # Stitch Grad-CAMs if in glas mode
             if 'glas_full' in self.input_name:
-                gradcam_image_wise = stitch_patch_activations(gradcam_image_wise, self.down_fac, self.orig_sizes[0])
-            gradcam_tmp = np.array(gradcam_image_wise)
+                gradcam_image_wise = SparseActivations.from_dense(
+                    stitch_patch_activations(gradcam_image_wise.to_dense(), self.patch_down_fac, self.orig_sizes[0]))
+            # Exclude non-foreground classes, which have no Grad-CAM
             if htt_class == 'morph':
-                gradcam_tmp[:, 0] = -np.inf
+                exclude_classes = [0]
             elif htt_class == 'func':
-                gradcam_tmp[:, :2] = -np.inf
-            self.ablative_segmasks['GradCAM'].append(maxconf_class_as_colour(np.argmax(gradcam_tmp, axis=1),
-                                    self.httclass_valid_colours[iter_httclass], self.orig_sizes[0]))
-            if self.save_types[2]:
+                exclude_classes = [0, 1]
+            else:
+                exclude_classes = []
+            gradcam_maxconf = gradcam_image_wise.argmax(exclude_classes=exclude_classes)
+            # (copied, since the HTT adjustments below modify gradcam_image_wise in place)
+            self.outputs[htt_class]['gradcam'] = gradcam_image_wise.copy()
+            self.outputs[htt_class]['masks']['GradCAM'] = gradcam_maxconf
+            self.ablative_segmasks['GradCAM'].append(maxconf_class_as_colour(
+                gradcam_maxconf, self.httclass_valid_colours[iter_httclass], self.orig_sizes[0]))
+            if save_types[2] and self.store is not None:
+                self.store.add_masks(gradcam_maxconf, self.input_files_batch, htt_class, 'GradCAM')
+            elif save_types[2]:
                 ablative_patch_dir = os.path.join(self.out_dir, htt_class, 'ablative_GradCAM')
-                mkdir_if_nexist(ablative_patch_dir)
-                save_pred_segmasks(self.ablative_segmasks['GradCAM'][iter_httclass], ablative_patch_dir, self.input_files_batch)
+                save_pred_segmasks(self.ablative_segmasks['GradCAM'][iter_httclass], ablative_patch_dir, self.input_files_batch,
+                                   writer=self.writer)
             if self.verbosity == 'NORMAL':
                 print(' (%s seconds)' % (time.time() - start_time))
 
             # 3. Inter-HTT Adjustments
-            # Obtain non-foreground class activations
-            if self.verbosity == 'NORMAL':
-                print('\t\t\t[' + htt_class + '] Modifying Grad-CAM by HTT', end='')
-                start_time = time.time()
+            cs_gradcam = None
+            # (only if cached for every HTT class, since the functional pass reads the subtracted morphological
+            #  Grad-CAMs)
+            if httclass_cached_gradcam is not None and cache.has_entries('cs_gradcam', self.htt_classes,
+                                                                          self.image_keys):
+                cs_gradcam = cache.load_activations('cs_gradcam', htt_class, self.image_keys, image_ranges,
+                                                    self.act_dtype)
+            if cs_gradcam is None:
+                # Obtain non-foreground class activations
+                if self.verbosity == 'NORMAL':
+                    print('\t\t\t[' + htt_class + '] Modifying Grad-CAM by HTT', end='')
+                    start_time = time.time()
 
-            if htt_class == 'func':
-                adipose_inds = [i for i, x in enumerate(self.atlas.morph_valid_classes) if x in ['A.W', 'A.B', 'A.M']]
-                gradcam_adipose = httclass_gradcam_image_wise[iter_httclass - 1][:, adipose_inds]
-                gradcam_mod = gc.modify_by_htt(gradcam_image_wise, self.orig_images, self.atlas, htt_class,
-                                                      gradcam_adipose=gradcam_adipose)
-            else:
-                gradcam_mod = gc.modify_by_htt(gradcam_image_wise, self.orig_images, self.atlas, htt_class)
-            if self.verbosity == 'NORMAL':
-                print(' (%s seconds)' % (time.time() - start_time))
+                if htt_class == 'func':
+                    adipose_inds = [i for i, x in enumerate(self.atlas.morph_valid_classes)
+                                    if x in ['A.W', 'A.B', 'A.M']]
+                    gradcam_adipose = httclass_gradcam_image_wise[iter_httclass - 1].select_classes(adipose_inds)
+                    gradcam_mod = gc.modify_by_htt(gradcam_image_wise, self.orig_images, self.atlas, htt_class,
+                                                   gradcam_adipose=gradcam_adipose)
+                else:
+                    gradcam_mod = gc.modify_by_htt(gradcam_image_wise, self.orig_images, self.atlas, htt_class)
+                if self.verbosity == 'NORMAL':
+                    print(' (%s seconds)' % (time.time() - start_time))
 
             # Get Class-Specific Grad-CAM
             if self.verbosity == 'NORMAL':
                 print('\t\t\t[' + htt_class + '] Getting Class-Specific Grad-CAM', end='')
                 start_time = time.time()
-            cs_gradcam = gc.get_cs_gradcam(gradcam_mod, self.atlas, htt_class)
-            self.ablative_segmasks['Adjust'].append(maxconf_class_as_colour(np.argmax(cs_gradcam, axis=1),
+            if cs_gradcam is None:
+                cs_gradcam = gc.get_cs_gradcam(gradcam_mod, self.atlas, htt_class)
+                if cache is not None:
+                    cache.save_activations('cs_gradcam', htt_class, self.image_keys, image_ranges, cs_gradcam)
+            cs_gradcam_pre_argmax = cs_gradcam.argmax()
+            self.outputs[htt_class]['cs_gradcam'] = cs_gradcam
+            self.outputs[htt_class]['masks']['Adjust'] = cs_gradcam_pre_argmax
+            self.ablative_segmasks['Adjust'].append(maxconf_class_as_colour(cs_gradcam_pre_argmax,
                                                                              self.httclass_valid_colours[iter_httclass],
                                                                              self.orig_sizes[0]))
-            if self.save_types[1]:
+            if save_types[1] and self.store is not None:
+                self.store.add_gradcam(cs_gradcam, self.input_files_batch, htt_class)
+            elif save_types[1]:
                 out_cs_gradcam_dir = os.path.join(self.out_dir, htt_class, 'gradcam')
-                mkdir_if_nexist(out_cs_gradcam_dir)
                 save_cs_gradcam(cs_gradcam, out_cs_gradcam_dir, self.input_files_batch,
-                                self.httclass_valid_classes[iter_httclass])
-            if self.save_types[2]:
+                                self.httclass_valid_classes[iter_httclass], writer=self.writer)
+            if save_types[2] and self.store is not None:
+                self.store.add_masks(cs_gradcam_pre_argmax, self.input_files_batch, htt_class, 'Adjust')
+            elif save_types[2]:
                 ablative_patch_dir = os.path.join(self.out_dir, htt_class, 'ablative_Adjust')
-                mkdir_if_nexist(ablative_patch_dir)
-                save_pred_segmasks(self.ablative_segmasks['Adjust'][iter_httclass], ablative_patch_dir, self.input_files_batch)
+                save_pred_segmasks(self.ablative_segmasks['Adjust'][iter_httclass], ablative_patch_dir, self.input_files_batch,
+                                   writer=self.writer)
             if self.verbosity == 'NORMAL':
                 print(' (%s seconds)' % (time.time() - start_time))
             if self.run_level == 2 or 'overlap' in self.input_name:
@@ -520,68 +1229,188 @@ class HistoSegNetV1:
             if self.verbosity == 'NORMAL':
                 print(' (%s seconds)' % (time.time() - start_time))
 
-            # 4. Segmentation Post-Processing (dense CRF)
-            dcrf = DenseCRF()
-            dcrf_config_path = os.path.join(self.data_dir, htt_class + '_optimal_pcc.npy')
-            dcrf.load_config(dcrf_config_path)
+            # 4. Segmentation Post-Processing (dense CRF), see segment_crf
+            crf_httclasses.append((iter_httclass, cs_gradcam, cs_gradcam_pre_argmax, pred_legends))
+
+        # Everything the dense CRF stage needs, so that it can run while the next batch is being segmented
+        return {'input_files_batch': self.input_files_batch, 'orig_images': self.orig_images,
+                'orig_sizes': self.orig_sizes, 'full_sizes': self.full_sizes, 'save_types': save_types,
+                'write_outputs': self.write_outputs, 'outputs': self.outputs,
+                'ablative_segmasks': self.ablative_segmasks,
+                'gt_segmasks': self.httclass_gt_segmasks if save_types[3] else None,
+                'gt_legends': self.httclass_gt_legends if save_types[3] else None, 'httclasses': crf_httclasses}
+
+    def segment_crf(self, job):
+        """Apply dense CRF post-processing to a batch segmented by segment_htt, adding the 'CRF' segmentation masks
+        to its outputs and ablative segmentation masks
+
+        The batch is described entirely by job, not by the current batch state, so this can run concurrently with
+        segment_htt on the next batch.
+
+        Parameters
+        ----------
+        job : dict
+            The batch returned by segment_htt
+        """
+
+        input_files_batch = job['input_files_batch']
+        orig_images = job['orig_images']
+        orig_sizes = job['orig_sizes']
+        save_types = job['save_types']
+        for iter_httclass, cs_gradcam, cs_gradcam_pre_argmax, pred_legends in job['httclasses']:
+            htt_class = self.htt_classes[iter_httclass]
+            dcrf = self.crf_engine[htt_class]
 
             if self.verbosity == 'NORMAL':
                 print('\t\t\t[' + htt_class + '] Performing post-processing', end='')
                 start_time = time.time()
-            cs_gradcam_post_maxconf, _ = dcrf.process(cs_gradcam, self.orig_images)
+            cs_gradcam_post_maxconf, _ = dcrf.process(cs_gradcam, orig_images)
+            job['outputs'][htt_class]['masks']['CRF'] = cs_gradcam_post_maxconf
             if self.verbosity == 'NORMAL':
-                print(' (%s seconds)' % (time.time() - start_time))
+                print(' (%s seconds, %s mean-field iterations per image)' % (time.time() - start_time,
+                                                                              np.mean(dcrf.num_iters)))
 
             cs_gradcam_post_discrete = maxconf_class_as_colour(cs_gradcam_post_maxconf,
                                                                self.httclass_valid_colours[iter_httclass],
-                                                               self.orig_sizes[0])
-            self.ablative_segmasks['CRF'].append(cs_gradcam_post_discrete)
-            if self.save_types[2]:
+                                                               orig_sizes[0])
+            job['ablative_segmasks']['CRF'].append(cs_gradcam_post_discrete)
+            if save_types[2] and self.store is not None:
+                # (the 'patch', 'overlay' and 'ablative_CRF' images can all be derived from the stored CRF masks)
+                self.store.add_masks(cs_gradcam_post_maxconf, input_files_batch, htt_class, 'CRF')
+            elif save_types[2]:
                 out_patch_dir = os.path.join(self.out_dir, htt_class, 'patch')
-                mkdir_if_nexist(out_patch_dir)
-                save_pred_segmasks(cs_gradcam_post_discrete, out_patch_dir, self.input_files_batch)
+                save_pred_segmasks(cs_gradcam_post_discrete, out_patch_dir, input_files_batch, writer=self.writer)
                 overlay_patch_dir = os.path.join(self.out_dir, htt_class, 'overlay')
-                mkdir_if_nexist(overlay_patch_dir)
-                save_pred_segmasks(OVERLAY_R * cs_gradcam_post_discrete + (1-OVERLAY_R) * self.orig_images,
-                                   overlay_patch_dir, self.input_files_batch)
+                save_pred_segmasks(OVERLAY_R * cs_gradcam_post_discrete + (1-OVERLAY_R) * orig_images,
+                                   overlay_patch_dir, input_files_batch, writer=self.writer)
                 ablative_patch_dir = os.path.join(self.out_dir, htt_class, 'ablative_CRF')
-                mkdir_if_nexist(ablative_patch_dir)
-                save_pred_segmasks(self.ablative_segmasks['CRF'][iter_httclass], ablative_patch_dir, self.input_files_batch)
+                save_pred_segmasks(cs_gradcam_post_discrete, ablative_patch_dir, input_files_batch, writer=self.writer)
 
-            if self.save_types[3]:
+            if save_types[3]:
                 if self.verbosity == 'NORMAL':
                     print('\t\t\t[' + htt_class + '] Exporting segmentation summary images', end='')
                     start_time = time.time()
-                cs_gradcam_pre_argmax = np.argmax(cs_gradcam, axis=1)
                 cs_gradcam_pre_discrete = maxconf_class_as_colour(cs_gradcam_pre_argmax,
                                                                   self.httclass_valid_colours[iter_httclass],
-                                                                  self.orig_sizes[0])
+                                                                  orig_sizes[0])
                 cs_gradcam_pre_continuous = gradcam_as_continuous(cs_gradcam,
                                                                   self.httclass_valid_colours[iter_httclass],
-                                                                  self.orig_sizes[0])
-                export_summary_image(self.input_files_batch, self.orig_images, self.out_dir,
-                                     self.httclass_gt_legends[iter_httclass], pred_legends,
-                                     self.httclass_gt_segmasks[iter_httclass], cs_gradcam_post_discrete,
-                                     cs_gradcam_pre_discrete, cs_gradcam_pre_continuous, htt_class)
+                                                                  orig_sizes[0])
+                export_summary_image(input_files_batch, orig_images, self.out_dir,
+                                     job['gt_legends'][iter_httclass], pred_legends,
+                                     job['gt_segmasks'][iter_httclass], cs_gradcam_post_discrete,
+                                     cs_gradcam_pre_discrete, cs_gradcam_pre_continuous, htt_class, writer=self.writer)
                 if self.verbosity == 'NORMAL':
                     print(' (%s seconds)' % (time.time() - start_time))
-            if htt_class == 'glas':
-                save_glas_bmps(self.input_files_batch, cs_gradcam_post_maxconf, self.out_dir, htt_class,
-                               self.orig_sizes[0])
+            if htt_class == 'glas' and job['write_outputs']:
+                save_glas_bmps(input_files_batch, cs_gradcam_post_maxconf, self.out_dir, htt_class,
+                               job['full_sizes'][0], writer=self.writer)
+
+    def segment_arrays(self, images, htt_mode=None, run_level=None):
+        """Segment a batch of images held in memory, returning the outputs instead of reading or writing any files
+
+        Parameters
+        ----------
+        images : numpy 4D array (size: B x H x W x 3), dtype uint8, where B = batch size
+            The images, in RGB format, at their native resolution
+        htt_mode : str or None, optional
+            The type of segmentation set to solve, which must be the one HistoSegNetV1 was set up with (None for it)
+        run_level : int or None, optional
+            The run level {1: HTT confidence scores, 2: Grad-CAMs, 3: Segmentation masks} (None for the one
+            HistoSegNetV1 was set up with)
+
+        Returns
+        -------
+        outputs : dict
+            The outputs of each HTT class, keyed by HTT class, with the confidence scores of the predicted classes
+            ('scores', a dict of the patch indices 'image_inds', class indices 'class_inds' and confidence scores
+            'scores'), raw Grad-CAMs ('gradcam', run_level >= 2), HTT-adjusted Grad-CAMs ('cs_gradcam', run_level >=
+            2), both hsn_v1.activations.SparseActivations objects, and class index segmentation masks ('masks', a dict
+            keyed by segmentation stage 'GradCAM', 'Adjust' (run_level >= 2) and 'CRF' (run_level 3))
+        """
+
+        self.check_open()
+        images = np.asarray(images)
+        if images.ndim != 4 or images.shape[-1] != 3 or images.dtype != np.uint8:
+            raise Exception('Images of size ' + str(images.shape) + ' and type ' + str(images.dtype) +
+                            ' are not a uint8 B x H x W x 3 batch')
+        if htt_mode not in [None, self.htt_mode]:
+            raise Exception('Variable htt_mode ' + str(htt_mode) + ' does not match the one HistoSegNetV1 was set up '
+                            'with, ' + self.htt_mode)
+        if run_level not in [None, 1, 2, 3]:
+            raise Exception('Variable run_level ' + str(run_level) + ' is not in [1, 2, 3]')
+
+        full_sizes = [x.shape[:2] for x in images]
+        if self.decode_fac > 1:
+            # Match the resolution the pipeline operates at with reduced-resolution decoding
+            images = np.array([cv2.resize(x, (round(x.shape[1] / self.decode_fac), round(x.shape[0] / self.decode_fac)),
+                                          interpolation=cv2.INTER_AREA) for x in images])
+        setup_run_level = self.run_level
+        self.run_level = setup_run_level if run_level is None else run_level
+        self.write_outputs = False
+        try:
+            self.input_files_batch = ['array_' + str(i) for i in range(images.shape[0])]
+            self.set_batch(self.prepare_batch(images, full_sizes))
+            self.segment_img(flush=False)
+        finally:
+            self.run_level = setup_run_level
+            self.write_outputs = True
+        return self.outputs
 
     def overlap_and_segment(self):
         """Overlap neighbouring patches and apply dense CRF post-processing"""
 
+        self.check_open()
+
+        def read_cached_gradcam(file):
+            # Full-precision HTT-adjusted Grad-CAMs of a patch from the artifact cache, keyed by class index, or None
+            # if not cached (the last few patches read are kept, as neighbouring patches are read repeatedly)
+            if self.cache is None:
+                return None
+            if file not in cached_gradcams:
+                entry = None
+                if file in input_files:
+                    path = os.path.join(self.img_dir, self.input_name, input_files[file])
+                    entry = self.cache.load_entry('cs_gradcam', htt_class, self.cache.get_key(path))
+                if len(cached_gradcams) >= 32:
+                    cached_gradcams.popitem(last=False)
+                cached_gradcams[file] = None if entry is None else dict(zip([int(x) for x in entry['class_inds']],
+                                                                            entry['planes']))
+            return cached_gradcams[file]
+
         def find_patch_htts(file, dir):
+            cached_gradcam = read_cached_gradcam(file)
+            if cached_gradcam is not None:
+                return [classes[x] for x in sorted(cached_gradcam.keys())]
+            if self.store is not None:
+                if file not in input_files:
+                    return []
+                return [classes[x] for x in self.store.get_gradcam_classes(input_files[file], htt_class)]
             files = [x for x in os.listdir(dir) if file in x]
             return [x.split('_h')[-1].split('.png')[0] for x in files]
 
         def rotate(l, n):
             return l[n:] + l[:n]
 
-        def read_gradcam(file):
-            return cv2.imread(file, cv2.IMREAD_GRAYSCALE).astype('float64') / 255
-
+        def read_gradcam(file, dir, htt):
+            # Grad-CAMs are read back at full precision from the artifact cache or the HDF5 output store, or quantized
+            # from the PNG files
+            cached_gradcam = read_cached_gradcam(file)
+            if cached_gradcam is not None:
+                gradcam = cached_gradcam.get(classes.index(htt))
+                return None if gradcam is None else gradcam.astype(self.act_dtype)
+            if self.store is not None:
+                if file not in input_files:
+                    return None
+                gradcam = self.store.read_gradcam(input_files[file], htt_class, classes.index(htt))
+                return None if gradcam is None else gradcam.astype(self.act_dtype)
+            path = os.path.join(dir, file + '_h' + htt + '.png')
+            if not os.path.exists(path):
+                return None
+            return cv2.imread(path, cv2.IMREAD_GRAYSCALE).astype(self.act_dtype) / 255
+
+        # Input filenames (with their extension) by patch name, as stored in the artifact cache and output store
+        input_files = dict([(os.path.splitext(x)[0], x) for x in self.input_files_all])
         self.orig_patch_size = [1088, 1088]
         self.overlap_ratio = 0.25
         sz = self.input_size
@@ -591,14 +1420,13 @@ class HistoSegNetV1:
 
         for iter_httclass in range(len(self.htt_classes)):
             htt_class = self.htt_classes[iter_httclass]
+            classes = self.httclass_valid_classes[iter_httclass]
+            cached_gradcams = collections.OrderedDict()
             gradcam_dir = os.path.join(self.out_dir, htt_class, 'gradcam')
             if self.save_types[1]:
                 overlap_gradcam_dir = os.path.join(self.out_dir, htt_class, 'gradcam_overlap')
-                mkdir_if_nexist(overlap_gradcam_dir)
 
-            dcrf = DenseCRF()
-            dcrf_config_path = os.path.join(self.data_dir, htt_class + '_optimal_pcc.npy')
-            dcrf.load_config(dcrf_config_path)
+            dcrf = self.crf_engine[htt_class]
             for iter_file, input_file in enumerate(self.input_files_all):
                 # print('Overlap: ' + input_file)
                 cur_patch_path = os.path.join(self.img_dir, self.input_name, input_file)
@@ -606,7 +1434,8 @@ class HistoSegNetV1:
 
                 patch_name = os.path.splitext(input_file)[0]
                 pyramid_id = patch_name.split('_i')[0]
-                overlap_gradcam_imagewise = np.zeros((len(self.httclass_valid_classes[iter_httclass]), sz[0], sz[1]))
+                overlap_gradcam_imagewise = np.zeros((len(self.httclass_valid_classes[iter_httclass]), sz[0], sz[1]),
+                                                     dtype=self.act_dtype)
 
                 # Get location of top-left pixel
                 cur_i = int(patch_name.split('_i')[-1].split('_')[0])
@@ -637,20 +1466,18 @@ class HistoSegNetV1:
 
                 # Go through each class
                 for htt in union_htts:
-                    cur_htt_gradcam_path = os.path.join(gradcam_dir, patch_name + '_h' + htt + '.png')
                     # - Initialize overlapped Grad-CAM patch with current patch's Grad-CAM
                     if htt in cur_patch_htts:
-                        overlap_gradcam = read_gradcam(cur_htt_gradcam_path)
+                        overlap_gradcam = read_gradcam(patch_name, gradcam_dir, htt)
                     # - Create new overlapped Grad-CAM patch if not already detected
                     else:
-                        overlap_gradcam = np.zeros((self.input_size[0], self.input_size[1]))
+                        overlap_gradcam = np.zeros((self.input_size[0], self.input_size[1]), dtype=self.act_dtype)
                     # - Create counter patch
-                    counter_patch = np.ones((self.input_size[0], self.input_size[1]))
+                    counter_patch = np.ones((self.input_size[0], self.input_size[1]), dtype=self.act_dtype)
                     # Go through each neighbour
                     for iter_neigh, neighbour_patch_name in enumerate(neighbour_patch_names):
-                        neigh_htt_gradcam_path = os.path.join(gradcam_dir, neighbour_patch_name + '_h' + htt + '.png')
-                        if os.path.exists(neigh_htt_gradcam_path):
-                            neigh_htt_gradcam = read_gradcam(neigh_htt_gradcam_path)
+                        neigh_htt_gradcam = read_gradcam(neighbour_patch_name, gradcam_dir, htt)
+                        if neigh_htt_gradcam is not None:
                             overlap_gradcam[cur_start_i[iter_neigh]:cur_end_i[iter_neigh],
                             cur_start_j[iter_neigh]:cur_end_j[iter_neigh]] += \
                                 neigh_htt_gradcam[neigh_start_i[iter_neigh]:neigh_end_i[iter_neigh],
@@ -661,9 +1488,12 @@ class HistoSegNetV1:
                     overlap_gradcam /= counter_patch
                     overlap_gradcam_imagewise[self.httclass_valid_classes[iter_httclass].index(htt)] = overlap_gradcam
 
-                    if self.save_types[1]:
+                    if self.save_types[1] and self.store is None:
                         overlap_gradcam_path = os.path.join(overlap_gradcam_dir, patch_name + '_h' + htt + '.png')
-                        cv2.imwrite(overlap_gradcam_path, overlap_gradcam)
+                        write_image(overlap_gradcam_path, overlap_gradcam, self.writer)
+                if self.save_types[1] and self.store is not None:
+                    self.store.add_gradcam(np.expand_dims(overlap_gradcam_imagewise, axis=0), [input_file], htt_class,
+                                           tag='gradcam_overlap')
                 if self.run_level == 2:
                     continue
 
@@ -673,23 +1503,32 @@ class HistoSegNetV1:
 
                 cs_gradcam_post_discrete = maxconf_class_as_colour(overlap_gradcam_post_maxconf,
                                                                    self.httclass_valid_colours[iter_httclass], sz)
-                if self.save_types[2]:
+                if self.save_types[2] and self.store is not None:
+                    self.store.add_masks(overlap_gradcam_post_maxconf, [input_file], htt_class, 'CRF')
+                elif self.save_types[2]:
                     out_patch_dir = os.path.join(self.out_dir, htt_class, 'patch')
-                    mkdir_if_nexist(out_patch_dir)
-                    save_pred_segmasks(cs_gradcam_post_discrete, out_patch_dir, [input_file])
-
-    def eval_segmentation(self, intersect_cnts, union_cnts, confusion_mat, gt_cnts, httclass_pred_segmasks, tag_name=''):
+                    save_pred_segmasks(cs_gradcam_post_discrete, out_patch_dir, [input_file], writer=self.writer)
+        # Wait for all output images to be written
+        self.writer.flush()
+        if self.store is not None:
+            self.store.flush()
+
+    def eval_segmentation(self, intersect_cnts, union_cnts, confusion_mat, gt_cnts, httclass_pred_segmasks, tag_name='',
+                          httclass_gt_segmasks=None):
         """Evaluate the segmentation quality through IoU, fIoU, mIoU"""
-        items = []
-        httclass_iou = []
-        httclass_fiou = []
-        httclass_miou = []
-        httclass_mean_dice = []
-        httclass_dice = []
 
-        for iter_httclass in range(len(self.httclass_gt_segmasks)):
+        self.accumulate_segmentation(intersect_cnts, union_cnts, confusion_mat, gt_cnts, httclass_pred_segmasks,
+                                     httclass_gt_segmasks)
+        return self.export_segmentation_metrics(intersect_cnts, union_cnts, confusion_mat, gt_cnts, tag_name=tag_name)
+
+    def accumulate_segmentation(self, intersect_cnts, union_cnts, confusion_mat, gt_cnts, httclass_pred_segmasks,
+                                httclass_gt_segmasks=None):
+        """Add the GT, intersection, union counts and confusion matrix of a batch to the accumulated ones"""
+        if httclass_gt_segmasks is None:
+            httclass_gt_segmasks = self.httclass_gt_segmasks
+
+        for iter_httclass in range(len(httclass_gt_segmasks)):
             colours = self.httclass_valid_colours[iter_httclass]
-            loginvfreq = self.httclass_loginvfreq[iter_httclass]
             intersect_count = intersect_cnts[iter_httclass]
             union_count = union_cnts[iter_httclass]
             confusion_matrix = confusion_mat[iter_httclass]
@@ -701,11 +1540,28 @@ class HistoSegNetV1:
                 pred_idx_segmasks[np.all(httclass_pred_segmasks[iter_httclass] == colours[iter_class], axis=-1)] = iter_class
             for iter_class in range(colours.shape[0]):
                 pred_segmask_cur = np.all(httclass_pred_segmasks[iter_httclass] == colours[iter_class], axis=-1)
-                gt_segmask_cur = np.all(self.httclass_gt_segmasks[iter_httclass] == colours[iter_class], axis=-1)
+                gt_segmask_cur = np.all(httclass_gt_segmasks[iter_httclass] == colours[iter_class], axis=-1)
                 confusion_matrix[iter_class, :] += np.bincount(pred_idx_segmasks[gt_segmask_cur], minlength=len(self.httclass_valid_classes[iter_httclass]))
                 intersect_count[iter_class] += np.sum(np.bitwise_and(pred_segmask_cur, gt_segmask_cur))
                 union_count[iter_class] += np.sum(np.bitwise_or(pred_segmask_cur, gt_segmask_cur))
                 gt_counts[iter_class] += np.sum(gt_segmask_cur)
+
+    def export_segmentation_metrics(self, intersect_cnts, union_cnts, confusion_mat, gt_cnts, tag_name=''):
+        """Export the IoU, fIoU, mIoU and dice metrics and confusion matrices of the accumulated counts"""
+        items = []
+        httclass_iou = []
+        httclass_fiou = []
+        httclass_miou = []
+        httclass_mean_dice = []
+        httclass_dice = []
+
+        for iter_httclass in range(len(self.htt_classes)):
+            loginvfreq = self.httclass_loginvfreq[iter_httclass]
+            intersect_count = intersect_cnts[iter_httclass]
+            union_count = union_cnts[iter_httclass]
+            confusion_matrix = confusion_mat[iter_httclass]
+            gt_counts = gt_cnts[iter_httclass]
+
             # Find fiou and miou
             iou = intersect_count / (union_count + 1e-12)
             httclass_iou.append(iou)
@@ -0,0 +1,194 @@
+import threading
+import time
+import traceback
+
+class OrderedQueue:
+    """Class for a bounded queue handing out items in order of their index, whatever order they are put in"""
+
+    def __init__(self, num_items, capacity):
+        """
+        Parameters
+        ----------
+        num_items : int
+            The total number of items that will pass through the queue
+        capacity : int
+            The maximum number of items held, counted from the next item to be handed out
+        """
+
+        self.num_items = num_items
+        self.capacity = capacity
+        self.items = {}
+        self.next_get = 0
+        self.cond = threading.Condition()
+
+    def put(self, index, item):
+        """Put the item of a given index, blocking while it is too far ahead of the next item to be handed out"""
+
+        with self.cond:
+            # The next item to be handed out is always within the window, so it can never be blocked
+            while index >= self.next_get + self.capacity:
+                self.cond.wait()
+            self.items[index] = item
+            self.cond.notify_all()
+
+    def get(self):
+        """Get the next (index, item) in order, blocking until it is available, or None once all items are out"""
+
+        with self.cond:
+            while self.next_get < self.num_items and self.next_get not in self.items:
+                self.cond.wait()
+            if self.next_get >= self.num_items:
+                return None
+            index = self.next_get
+            item = self.items.pop(index)
+            self.next_get += 1
+            self.cond.notify_all()
+            return index, item
+
+class StageFailure:
+    """Class for passing an exception raised by a stage down the pipeline in place of its output"""
+
+    def __init__(self, stage_name, index, exception, traceback_text):
+        self.stage_name = stage_name
+        self.index = index
+        self.exception = exception
+        self.traceback_text = traceback_text
+
+class StagePipeline:
+    """Class for running items (e.g. batches) through a sequence of stages concurrently
+
+    Each stage has its own worker threads and is separated from the next by a bounded queue, so that different items
+    occupy different stages at the same time. Every stage receives its items in order, so a stage with a single worker
+    sees exactly the sequence of calls the serial loop would make.
+
+    The pipeline is aborted on the first failure: no stage starts any further item, the remaining items are passed
+    through as the failure and run raises it once the workers have stopped. A single-worker stage therefore only runs
+    an item once every earlier item has passed through it.
+    """
+
+    def __init__(self, stages, queue_size=2):
+        """
+        Parameters
+        ----------
+        stages : list of tuple
+            The name, function (called as fn(item), returning the item passed to the next stage) and number of worker
+            threads of each stage, in order
+        queue_size : int, optional
+            The maximum number of items waiting between two stages
+        """
+
+        if type(queue_size) != int or queue_size < 1:
+            raise Exception('Pipeline queue size must be an integer of at least 1')
+        for name, _, num_workers in stages:
+            if type(num_workers) != int or num_workers < 1:
+                raise Exception('Number of workers of pipeline stage ' + name + ' must be an integer of at least 1')
+        self.stages = stages
+        self.queue_size = queue_size
+        self.busy_times = dict([(x[0], 0.0) for x in stages])
+        self.wall_time = 0.0
+        self.lock = threading.Lock()
+        self.abort = threading.Event()
+        self.failure = None
+
+    def run_worker(self, stage_name, fn, in_queue, out_queue):
+        """Process items of a stage until its input queue is exhausted, passing items through once aborted"""
+
+        while True:
+            got = in_queue.get()
+            if got is None:
+                return
+            index, item = got
+            if isinstance(item, StageFailure) or self.abort.is_set():
+                out_queue.put(index, self.failure)
+                continue
+            start_time = time.time()
+            try:
+                result = fn(item)
+            except Exception as e:
+                result = StageFailure(stage_name, index, e, traceback.format_exc())
+                with self.lock:
+                    if self.failure is None:
+                        self.failure = result
+                    self.abort.set()
+            with self.lock:
+                self.busy_times[stage_name] += time.time() - start_time
+            out_queue.put(index, result)
+
+    def run(self, items):
+        """Run items through the stages, yielding the outputs of the last stage in order
+
+        Parameters
+        ----------
+        items : list
+            The items fed to the first stage
+
+        Returns
+        -------
+        outputs : generator
+            The outputs of the last stage, in the order of items
+        """
+
+        items = list(items)
+        self.abort.clear()
+        self.failure = None
+        queues = [OrderedQueue(len(items), self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = []
+        for iter_stage, (name, fn, num_workers) in enumerate(self.stages):
+            for _ in range(num_workers):
+                thread = threading.Thread(target=self.run_worker,
+                                          args=(name, fn, queues[iter_stage], queues[iter_stage + 1]))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        def feed():
+            for index, item in enumerate(items):
+                queues[0].put(index, item)
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+
+        start_time = time.time()
+        try:
+            while True:
+                got = queues[-1].get()
+                if got is None:
+                    break
+                if isinstance(got[1], StageFailure):
+                    failure = self.failure
+                    raise Exception('Pipeline stage ' + failure.stage_name + ' failed on item #' + str(failure.index) +
+                                    ':\n' + failure.traceback_text) from failure.exception
+                yield got[1]
+        finally:
+            # Stop the workers (also when the caller stops early), draining the items still in flight
+            self.abort.set()
+            while queues[-1].get() is not None:
+                pass
+            feeder.join()
+            for thread in threads:
+                thread.join()
+            self.wall_time += time.time() - start_time
+
+    def get_utilization(self):
+        """Get the fraction of the wall-clock time each stage's workers spent busy
+
+        Returns
+        -------
+        utilization : dict
+            The utilization (between 0 and 1) of each stage, keyed by stage name
+        """
+
+        utilization = {}
+        for name, _, num_workers in self.stages:
+            utilization[name] = self.busy_times[name] / (self.wall_time * num_workers + 1e-12)
+        return utilization
+
+    def report_utilization(self):
+        """Get a printable report of the per-stage utilization"""
+
+        utilization = self.get_utilization()
+        lines = []
+        for name, _, num_workers in self.stages:
+            lines.append('%s (%d workers): %.1f%% busy, %.2f seconds' % (name, num_workers, 100 * utilization[name],
+                                                                        self.busy_times[name]))
+        return '\n'.join(lines)
@@ -0,0 +1,53 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+class BatchPrefetcher:
+    """Class for loading upcoming batches in the background while the current batch is being segmented"""
+
+    def __init__(self, load_fn, batches, depth=2, num_workers=2):
+        """
+        Parameters
+        ----------
+        load_fn : function
+            The function loading a single batch, called as load_fn(batch) in a worker thread
+        batches : list
+            The batches to be loaded, in order (e.g. list of lists of input filenames)
+        depth : int, optional
+            The maximum number of batches loaded ahead of the batch currently being consumed
+        num_workers : int, optional
+            The number of worker threads decoding batches concurrently
+        """
+
+        if type(depth) != int or depth < 1:
+            raise Exception('Prefetch depth must be an integer of at least 1')
+        if type(num_workers) != int or num_workers < 1:
+            raise Exception('Number of prefetch workers must be an integer of at least 1')
+        self.load_fn = load_fn
+        self.batches = list(batches)
+        self.depth = depth
+        self.num_workers = num_workers
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        """Yield the loaded batches in order, keeping up to self.depth batches in flight"""
+
+        executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        pending = deque()
+        next_batch = 0
+        try:
+            while next_batch < len(self.batches) and len(pending) < self.depth:
+                pending.append(executor.submit(self.load_fn, self.batches[next_batch]))
+                next_batch += 1
+            while len(pending) > 0:
+                # Block until the oldest batch is ready, then top up the queue before handing it over
+                loaded = pending.popleft().result()
+                if next_batch < len(self.batches):
+                    pending.append(executor.submit(self.load_fn, self.batches[next_batch]))
+                    next_batch += 1
+                yield loaded
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
@@ -0,0 +1,379 @@
+import io
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+import traceback
+import http.client
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+from .activations import SparseActivations
+
+def encode_outputs(outputs):
+    """Serialize the outputs of HistoSegNetV1.segment_arrays into .npz bytes
+
+    Each array is stored under '<htt_class>/<output>/<name>', with Grad-CAMs stored sparsely as the 'image_inds',
+    'class_inds' and 'planes' of their nonzero (image, class) pairs.
+    """
+
+    arrays = {}
+    for htt_class, httclass_outputs in outputs.items():
+        for name, values in httclass_outputs['scores'].items():
+            arrays[htt_class + '/scores/' + name] = np.asarray(values)
+        for tag in ['gradcam', 'cs_gradcam']:
+            if tag not in httclass_outputs:
+                continue
+            X = httclass_outputs[tag]
+            rows = [(i, x, X.planes[i][x]) for i in range(len(X)) for x in X.class_inds(i)]
+            prefix = htt_class + '/' + tag + '/'
+            arrays[prefix + 'image_inds'] = np.array([x[0] for x in rows], dtype='int64')
+            arrays[prefix + 'class_inds'] = np.array([x[1] for x in rows], dtype='int64')
+            arrays[prefix + 'planes'] = np.stack([x[2] for x in rows]) if len(rows) > 0 else \
+                np.zeros((0,) + X.size, dtype=X.dtype)
+            arrays[prefix + 'shape'] = np.array(X.shape)
+        for stage, maxconf in httclass_outputs['masks'].items():
+            arrays[htt_class + '/masks/' + stage] = np.asarray(maxconf, dtype='uint8')
+    f = io.BytesIO()
+    np.savez(f, **arrays)
+    return f.getvalue()
+
+def decode_outputs(data):
+    """Deserialize outputs encoded by encode_outputs into the structure returned by HistoSegNetV1.segment_arrays"""
+
+    outputs = {}
+    with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+        for key in arrays.files:
+            htt_class, tag, name = key.split('/')
+            outputs.setdefault(htt_class, {'scores': {}, 'masks': {}})
+            if tag in ['scores', 'masks']:
+                outputs[htt_class][tag][name] = arrays[key]
+            else:
+                outputs[htt_class].setdefault(tag, {})[name] = arrays[key]
+    for httclass_outputs in outputs.values():
+        for tag in ['gradcam', 'cs_gradcam']:
+            if tag not in httclass_outputs:
+                continue
+            sparse = httclass_outputs[tag]
+            shape = sparse['shape']
+            X = SparseActivations(int(shape[0]), int(shape[1]), shape[2:], sparse['planes'].dtype)
+            for image_ind, class_ind, plane in zip(sparse['image_inds'], sparse['class_inds'], sparse['planes']):
+                X.set_plane(int(image_ind), class_ind, plane)
+            httclass_outputs[tag] = X
+    return outputs
+
+def split_outputs(outputs, start, end):
+    """Get the outputs of HistoSegNetV1.segment_arrays for a range of patches, with indices relative to the range"""
+
+    split = {}
+    for htt_class, httclass_outputs in outputs.items():
+        scores = httclass_outputs['scores']
+        image_inds = np.asarray(scores['image_inds'])
+        is_range = np.logical_and(image_inds >= start, image_inds < end)
+        split[htt_class] = {'scores': {'image_inds': image_inds[is_range] - start,
+                                       'class_inds': np.asarray(scores['class_inds'])[is_range],
+                                       'scores': np.asarray(scores['scores'])[is_range]},
+                            'masks': dict([(x, y[start:end]) for x, y in httclass_outputs['masks'].items()])}
+        for tag in ['gradcam', 'cs_gradcam']:
+            if tag in httclass_outputs:
+                X = httclass_outputs[tag]
+                split_X = SparseActivations(end - start, X.num_classes, X.size, X.dtype)
+                split_X.planes = X.planes[start:end]
+                split[htt_class][tag] = split_X
+    return split
+
+class SegmentationRequest:
+    """Class for a batch of images waiting to be segmented by a SegmentationServer"""
+
+    def __init__(self, images, run_level):
+        self.images = images
+        self.run_level = run_level
+        self.outputs = None
+        self.error = None
+        self.status = None
+        self.done = threading.Event()
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class SegmentationHandler(BaseHTTPRequestHandler):
+    """Class for handling the HTTP requests of a SegmentationServer
+
+    GET /health returns the server settings as JSON. POST /segment[?run_level=<int>] takes a uint8 B x H x W x 3 RGB
+    batch in .npy format and returns the outputs in .npz format (cf. encode_outputs).
+    """
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/health':
+            self.send_text(404, 'Unknown path ' + self.path)
+            return
+        self.send_body(200, 'application/json', json.dumps(self.server.segmentation_server.get_info()).encode())
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/segment':
+            self.send_text(404, 'Unknown path ' + self.path)
+            return
+        try:
+            query = parse_qs(url.query)
+            run_level = int(query['run_level'][0]) if 'run_level' in query else None
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            images = np.load(io.BytesIO(body), allow_pickle=False)
+        except Exception as e:
+            self.send_text(400, 'Could not parse request: ' + repr(e))
+            return
+        request = self.server.segmentation_server.submit(images, run_level)
+        if request.error is not None:
+            self.send_text(request.status, request.error)
+            return
+        self.send_body(200, 'application/octet-stream', encode_outputs(request.outputs))
+
+    def send_text(self, code, text):
+        self.send_body(code, 'text/plain', text.encode())
+
+    def send_body(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # (Unix socket clients have no address)
+        return str(self.client_address[0]) if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.segmentation_server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class SegmentationServer:
+    """Class for serving segmentation requests from a warm HistoSegNetV1 (with HistoNet and the dense CRFs loaded once)
+    over a local Unix socket or localhost HTTP
+
+    Requests from concurrent clients are batched together (up to max_batch_size images of the same size and run
+    level, waiting at most max_wait seconds for more) and segmented with HistoSegNetV1.segment_arrays in the thread
+    running serve_forever, which must be the one HistoNet was loaded in.
+    """
+
+    def __init__(self, hsn, socket_path=None, host='127.0.0.1', port=8000, max_batch_size=None, max_wait=0.01,
+                 verbose=False):
+        """
+        Parameters
+        ----------
+        hsn : hsn_v1.HistoSegNetV1 object
+            The HistoSegNetV1, with HistoNet loaded
+        socket_path : str or None, optional
+            The path of the Unix socket to listen on, or None to listen on host:port instead
+        host : str, optional
+            The host to listen on
+        port : int, optional
+            The port to listen on (0 for any free port)
+        max_batch_size : int or None, optional
+            The maximum number of images segmented together (None for the batch size of hsn)
+        max_wait : float, optional
+            The maximum time in seconds to wait for more requests to batch with the first one
+        verbose : bool, optional
+            Whether to log each HTTP request
+        """
+
+        self.hsn = hsn
+        self.max_batch_size = hsn.batch_size if max_batch_size is None else max_batch_size
+        if type(self.max_batch_size) != int or self.max_batch_size < 1:
+            raise Exception('Maximum server batch size must be an integer of at least 1')
+        if max_wait < 0:
+            raise Exception('Maximum server batching wait must be at least 0')
+        self.max_wait = max_wait
+        self.verbose = verbose
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.is_shutting_down = False
+        self.socket_path = socket_path
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            self.http_server = ThreadingUnixHTTPServer(socket_path, SegmentationHandler)
+        else:
+            self.http_server = ThreadingHTTPServer((host, port), SegmentationHandler)
+        self.http_server.segmentation_server = self
+        self.is_running = False
+
+    def get_info(self):
+        return {'htt_mode': self.hsn.htt_mode, 'run_level': self.hsn.run_level, 'input_size': self.hsn.input_size,
+                'max_batch_size': self.max_batch_size, 'queued_requests': self.requests.qsize()}
+
+    def submit(self, images, run_level=None):
+        """Queue a batch of images to be segmented and block until it is done (called by the HTTP handlers)
+
+        Invalid requests are failed with status 400 and requests after shutdown() with status 503, without queueing.
+        """
+
+        request = SegmentationRequest(images, run_level)
+        if images.ndim != 4 or images.shape[-1] != 3 or images.dtype != np.uint8:
+            request.status = 400
+            request.error = 'Images of size ' + str(images.shape) + ' and type ' + str(images.dtype) + \
+                            ' are not a uint8 B x H x W x 3 batch'
+            return request
+        # Each image must be a single patch, as the dense CRF indexes its images by patch index
+        patch_size = tuple([round(x * self.hsn.down_fac) for x in self.hsn.input_size])
+        if images.shape[1:3] != patch_size:
+            request.status = 400
+            request.error = 'Images of size ' + str(images.shape[1:3]) + ' do not match the patch size ' + \
+                            str(patch_size) + ' (input_size x down_fac)'
+            return request
+        if run_level not in [None, 1, 2, 3]:
+            request.status = 400
+            request.error = 'Variable run_level ' + str(run_level) + ' is not in [1, 2, 3]'
+            return request
+        with self.lock:
+            if self.is_shutting_down:
+                request.status = 503
+                request.error = 'Segmentation server is shutting down'
+                return request
+            self.requests.put(request)
+        request.done.wait()
+        return request
+
+    def gather_requests(self):
+        """Get the next request and those that can be batched with it, waiting at most max_wait for more"""
+
+        requests = [self.requests.get()]
+        if requests[0] is None:
+            return []
+        num_images = requests[0].images.shape[0]
+        deadline = time.time() + self.max_wait
+        while num_images < self.max_batch_size:
+            try:
+                request = self.requests.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                break
+            if request is None:
+                self.requests.put(None)
+                break
+            requests.append(request)
+            num_images += request.images.shape[0]
+        return requests
+
+    def process_requests(self, requests):
+        """Segment requests batched by image size and run level, and hand each its own outputs"""
+
+        groups = {}
+        for request in requests:
+            groups.setdefault((request.images.shape[1:], request.run_level), []).append(request)
+        for (_, run_level), group in groups.items():
+            try:
+                outputs = self.hsn.segment_arrays(np.concatenate([x.images for x in group]), run_level=run_level)
+                # Each image is a single patch (cf. submit), so outputs are split by image ranges
+                start = 0
+                for request in group:
+                    end = start + request.images.shape[0]
+                    request.outputs = split_outputs(outputs, start, end)
+                    start = end
+            except Exception:
+                error = 'Segmentation failed:\n' + traceback.format_exc()
+                for request in group:
+                    request.status = 500
+                    request.error = error
+            for request in group:
+                request.done.set()
+
+    def serve_forever(self):
+        """Serve requests until shutdown() is called (segmentation runs in the calling thread)"""
+
+        http_thread = threading.Thread(target=self.http_server.serve_forever)
+        http_thread.daemon = True
+        http_thread.start()
+        self.is_running = True
+        if self.hsn.verbosity == 'NORMAL':
+            address = self.socket_path if self.socket_path is not None else '%s:%d' % self.http_server.server_address
+            print('Serving segmentation requests on ' + address)
+        try:
+            while True:
+                requests = self.gather_requests()
+                if len(requests) == 0:
+                    break
+                self.process_requests(requests)
+        finally:
+            self.is_running = False
+            with self.lock:
+                self.is_shutting_down = True
+            # Fail the requests still queued (if segmentation stopped early), so no handler waits forever
+            while True:
+                try:
+                    request = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is not None:
+                    request.status = 503
+                    request.error = 'Segmentation server stopped before the request was segmented'
+                    request.done.set()
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            if self.socket_path is not None and os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def shutdown(self):
+        """Stop serve_forever once the requests already queued are done, rejecting any later requests"""
+
+        with self.lock:
+            self.is_shutting_down = True
+            self.requests.put(None)
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """Class for an HTTP connection over a Unix socket"""
+
+    def __init__(self, socket_path, timeout=None):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+def segment_remote(images, run_level=None, socket_path=None, host='127.0.0.1', port=8000, timeout=None):
+    """Segment a batch of images with a running SegmentationServer
+
+    Parameters
+    ----------
+    images : numpy 4D array (size: B x H x W x 3), dtype uint8, where B = batch size
+        The images, in RGB format
+    run_level : int or None, optional
+        The run level (None for the server's)
+    socket_path : str or None, optional
+        The path of the server's Unix socket, or None to connect to host:port instead
+    host : str, optional
+        The host of the server
+    port : int, optional
+        The port of the server
+    timeout : float or None, optional
+        The connection timeout in seconds
+
+    Returns
+    -------
+    outputs : dict
+        The outputs, as returned by HistoSegNetV1.segment_arrays
+    """
+
+    if socket_path is not None:
+        connection = UnixHTTPConnection(socket_path, timeout=timeout)
+    else:
+        connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    f = io.BytesIO()
+    np.save(f, np.asarray(images, dtype='uint8'), allow_pickle=False)
+    path = '/segment' if run_level is None else '/segment?run_level=' + str(run_level)
+    try:
+        connection.request('POST', path, body=f.getvalue(), headers={'Content-Type': 'application/octet-stream'})
+        response = connection.getresponse()
+        body = response.read()
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise Exception('Segmentation server returned ' + str(response.status) + ': ' + body.decode())
+    return decode_outputs(body)
@@ -0,0 +1,256 @@
+import threading
+import numpy as np
+import h5py
+from .activations import SparseActivations
+
+class H5OutputStore:
+    """Class for storing segmentation outputs (confidence scores, Grad-CAMs and segmentation masks) in a single
+    chunked, compressed HDF5 file with an index, instead of one image file per output
+
+    Layout:
+        /files                                      input filenames, in order of first write
+        /<htt_class>/scores/{file_inds, class_inds, scores}
+        /<htt_class>/<tag>/<H>x<W>/{data, file_inds, class_inds}    (tag: 'gradcam' or 'gradcam_overlap')
+        /<htt_class>/masks/<tag>/<H>x<W>/{data, file_inds}
+    where data holds one chunk (activation map or class index mask) per row, and the index datasets give the file
+    (row in /files) and class of each row.
+    """
+
+    def __init__(self, path, mode='a', compression='gzip'):
+        """
+        Parameters
+        ----------
+        path : str
+            The file path of the HDF5 file
+        mode : str, optional
+            The h5py file mode ('a' to create or append, 'r' to read only)
+        compression : str or None, optional
+            The h5py compression filter of the data chunks
+        """
+
+        self.path = path
+        self.compression = compression
+        self.h5 = h5py.File(path, mode)
+        if 'files' not in self.h5 and mode != 'r':
+            self.h5.create_dataset('files', shape=(0,), maxshape=(None,), dtype=h5py.special_dtype(vlen=str))
+        self.file_inds = {}
+        if 'files' in self.h5:
+            # (newer h5py versions read variable-length strings back as bytes)
+            self.file_inds = dict([(x.decode() if isinstance(x, bytes) else x, i)
+                                   for i, x in enumerate(self.h5['files'][:])])
+        # Group path -> {(file index, class index): (size subgroup name, row)}, built lazily for random access
+        self.indices = {}
+        # Group path -> {file index: [class indices]}, built along with the row index
+        self.file_classes = {}
+        # Writes may come from concurrent pipeline stages (cf. HistoSegNetV1.run_batch_pipelined)
+        self.lock = threading.RLock()
+
+    def get_file_inds(self, files):
+        """Get the indices of filenames in /files, appending those not yet stored"""
+
+        with self.lock:
+            new_files = [x for x in files if x not in self.file_inds]
+            if len(new_files) > 0:
+                dataset = self.h5['files']
+                start = dataset.shape[0]
+                dataset.resize((start + len(new_files),))
+                dataset[start:] = new_files
+                for iter_file, file in enumerate(new_files):
+                    self.file_inds[file] = start + iter_file
+            return np.array([self.file_inds[x] for x in files], dtype='int64')
+
+    def append(self, group_path, data, **index):
+        """Append rows to the resizable datasets of a group, creating them on first use
+
+        Parameters
+        ----------
+        group_path : str
+            The path of the group
+        data : numpy array or None
+            The data rows, chunked one row per chunk, or None for an index-only group
+        index : numpy 1D arrays
+            The index datasets, one value per row
+        """
+
+        with self.lock:
+            group = self.h5.require_group(group_path)
+            datasets = dict(index)
+            if data is not None:
+                datasets['data'] = data
+            for name, values in datasets.items():
+                values = np.asarray(values)
+                if name not in group:
+                    group.create_dataset(name, shape=(0,) + values.shape[1:], maxshape=(None,) + values.shape[1:],
+                                         dtype=values.dtype,
+                                         chunks=(1,) + values.shape[1:] if values.ndim > 1 else True,
+                                         compression=self.compression if values.ndim > 1 else None,
+                                         shuffle=values.ndim > 1)
+                dataset = group[name]
+                start = dataset.shape[0]
+                dataset.resize((start + values.shape[0],) + values.shape[1:])
+                dataset[start:] = values
+            # Indices are cached per parent group of the per-size subgroups, so drop those of any enclosing group
+            for cached_path in [x for x in self.indices.keys() if group_path.startswith(x + '/') or group_path == x]:
+                self.indices.pop(cached_path)
+                self.file_classes.pop(cached_path)
+
+    def add_scores(self, image_inds, class_inds, scores, files, htt_class):
+        """Store the confidence scores of the predicted classes in a batch (cf. utilities.save_patchconfidence)
+
+        Parameters
+        ----------
+        image_inds : numpy 1D array (size: P), where P = number of predicted classes in batch
+            The image indices of the predicted classes in batch
+        class_inds : numpy 1D array (size: P)
+            The class indices of the predicted classes in batch
+        scores : numpy 1D array (size: P)
+            The class confidence scores of the predicted classes in batch
+        files : list of str (size: B), where B = batch size
+            The filenames of the images in the batch
+        htt_class : str
+            The type of segmentation set to solve
+        """
+
+        file_inds = self.get_file_inds(files)
+        self.append(htt_class + '/scores', None, file_inds=file_inds[np.asarray(image_inds, dtype='int64')],
+                    class_inds=np.asarray(class_inds, dtype='int64'), scores=np.asarray(scores, dtype='float32'))
+
+    def add_gradcam(self, X, files, htt_class, tag='gradcam'):
+        """Store the nonzero HTT-adjusted Grad-CAMs of a batch at full precision (cf. utilities.save_cs_gradcam)
+
+        Parameters
+        ----------
+        X : numpy 4D array (size: B x C x H x W), where B = batch size, C = number of classes, or
+            hsn_v1.activations.SparseActivations object
+            The HTT-adjusted Grad-CAMs in the current batch
+        files : list of str (size: B), where B = batch size
+            The filenames of the images in the batch
+        htt_class : str
+            The type of segmentation set to solve
+        tag : str, optional
+            The Grad-CAM type ('gradcam', or 'gradcam_overlap' for Grad-CAMs overlapped with neighbouring patches)
+        """
+
+        if not isinstance(X, SparseActivations):
+            X = SparseActivations.from_dense(X)
+        file_inds = self.get_file_inds(files)
+        rows = [(file_inds[i], x, X.planes[i][x]) for i in range(len(X)) for x in X.class_inds(i)
+                if np.sum(X.planes[i][x]) > 0]
+        if len(rows) == 0:
+            return
+        self.append(htt_class + '/' + tag + '/%dx%d' % X.size, np.stack([x[2] for x in rows]),
+                    file_inds=np.array([x[0] for x in rows], dtype='int64'),
+                    class_inds=np.array([x[1] for x in rows], dtype='int64'))
+
+    def add_masks(self, maxconf, files, htt_class, tag):
+        """Store the class index segmentation masks of a batch (cf. utilities.save_pred_segmasks)
+
+        Parameters
+        ----------
+        maxconf : numpy 3D array (size: B x H x W), where B = batch size
+            The predicted class indices
+        files : list of str (size: B), where B = batch size
+            The filenames of the images in the batch
+        htt_class : str
+            The type of segmentation set to solve
+        tag : str
+            The segmentation stage (e.g. 'GradCAM', 'Adjust', 'CRF')
+        """
+
+        self.append(htt_class + '/masks/' + tag + '/%dx%d' % maxconf.shape[1:], np.asarray(maxconf, dtype='uint8'),
+                    file_inds=self.get_file_inds(files))
+
+    def get_index(self, group_path):
+        """Get the row index of all (per-size) subgroups of a group, keyed by (file index, class index), along with
+        the sorted class indices stored for each file index"""
+
+        if group_path not in self.indices:
+            index = {}
+            file_classes = {}
+            if group_path in self.h5:
+                for size_name, subgroup in self.h5[group_path].items():
+                    file_inds = subgroup['file_inds'][:]
+                    class_inds = subgroup['class_inds'][:] if 'class_inds' in subgroup else np.zeros_like(file_inds)
+                    # Later rows overwrite earlier ones, e.g. from a rerun
+                    for row, key in enumerate(zip(file_inds, class_inds)):
+                        index[(int(key[0]), int(key[1]))] = (size_name, row)
+            for file_ind, class_ind in index.keys():
+                file_classes.setdefault(file_ind, []).append(class_ind)
+            for class_inds in file_classes.values():
+                class_inds.sort()
+            self.indices[group_path] = index
+            self.file_classes[group_path] = file_classes
+        return self.indices[group_path], self.file_classes[group_path]
+
+    def get_gradcam_classes(self, file, htt_class, tag='gradcam'):
+        """Get the indices of the classes with a stored Grad-CAM for a file"""
+
+        if file not in self.file_inds:
+            return []
+        return list(self.get_index(htt_class + '/' + tag)[1].get(self.file_inds[file], []))
+
+    def read_gradcam(self, file, htt_class, class_ind, tag='gradcam'):
+        """Read the stored Grad-CAM of a class for a file, or None if there is none"""
+
+        group_path = htt_class + '/' + tag
+        key = (self.file_inds.get(file, -1), class_ind)
+        index = self.get_index(group_path)[0]
+        if key not in index:
+            return None
+        size_name, row = index[key]
+        return self.h5[group_path][size_name]['data'][row]
+
+    def read_mask(self, file, htt_class, tag):
+        """Read the stored class index segmentation mask of a file at a segmentation stage, or None if there is none"""
+
+        group_path = htt_class + '/masks/' + tag
+        key = (self.file_inds.get(file, -1), 0)
+        index = self.get_index(group_path)[0]
+        if key not in index:
+            return None
+        size_name, row = index[key]
+        return self.h5[group_path][size_name]['data'][row]
+
+    def merge(self, path, max_rows=256):
+        """Append all outputs of another store (e.g. of a shard, cf. HistoSegNetV1.run_sharded) to this one
+
+        Parameters
+        ----------
+        path : str
+            The file path of the HDF5 file of the other store
+        max_rows : int, optional
+            The maximum number of rows copied at a time
+        """
+
+        other = H5OutputStore(path, mode='r')
+        try:
+            if 'files' not in other.h5:
+                return
+            files = [None] * len(other.file_inds)
+            for file, file_ind in other.file_inds.items():
+                files[file_ind] = file
+            file_map = self.get_file_inds(files)
+            # The groups holding rows are those with an index of file indices
+            group_paths = []
+
+            def find_group(name, obj):
+                if isinstance(obj, h5py.Group) and 'file_inds' in obj:
+                    group_paths.append(name)
+            other.h5.visititems(find_group)
+            for group_path in group_paths:
+                group = other.h5[group_path]
+                num_rows = group['file_inds'].shape[0]
+                for start in range(0, num_rows, max_rows):
+                    end = min(start + max_rows, num_rows)
+                    index = dict([(x, group[x][start:end]) for x in group.keys() if x != 'data'])
+                    index['file_inds'] = file_map[index['file_inds']]
+                    self.append(group_path, group['data'][start:end] if 'data' in group else None, **index)
+        finally:
+            other.close()
+
+    def flush(self):
+        with self.lock:
+            self.h5.flush()
+
+    def close(self):
+        self.h5.close()
@@ -1,12 +1,13 @@
 import numpy as np
 import cv2
-from tensorflow import keras
+from PIL import Image
 import os
 import matplotlib
 # matplotlib.use("TkAgg")
 import matplotlib.pyplot as plt
 from skimage import measure, filters
 import math
+from .activations import SparseActivations
 
 def mkdir_if_nexist(pth):
     """Create a directory if the path does not already exist
@@ -20,21 +21,147 @@ def mkdir_if_nexist(pth):
     if not os.path.exists(pth):
         os.makedirs(pth)
 
-def read_image(path):
+def write_image(path, image, writer=None):
+    """Write an image to file, either immediately or through an asynchronous writer
+
+    Parameters
+    ----------
+    path : str
+        The file path to write the image to
+    image : numpy 2D or 3D array
+        The image, as accepted by cv2.imwrite (not to be modified afterwards if a writer is given)
+    writer : hsn_v1.writer.ImageWriter object or None, optional
+        The writer to queue the image with (which also creates its directory), or None to write it now
+    """
+
+    if writer is None:
+        cv2.imwrite(path, image)
+    else:
+        writer.write(path, image)
+
+def get_reduce_fac(down_fac):
+    """Find the largest reduced-resolution decoding factor supported by OpenCV not exceeding the downsampling factor
+
+    Parameters
+    ----------
+    down_fac : float
+        The downsampling factor
+
+    Returns
+    -------
+    reduce_fac : int
+        The reduced-resolution decoding factor, one of {1, 2, 4, 8}
+    """
+
+    for reduce_fac in [8, 4, 2]:
+        if down_fac >= reduce_fac:
+            return reduce_fac
+    return 1
+
+def read_image(path, reduce_fac=1):
     """Read single image from path
 
     Parameters
     ----------
     path : str
         Filepath to image to be read
+    reduce_fac : int, optional
+        Reduced-resolution decoding factor, one of {1, 2, 4, 8}; the image is read at 1/reduce_fac of its native
+        resolution, without materializing it at native resolution for JPEGs (decoded at reduced scale by OpenCV) and
+        uncompressed BMPs such as the GlaS images (see read_bmp_reduced); other formats such as PNG are decoded at
+        native resolution and then resized by OpenCV
+
+    Returns
+    -------
+    y : numpy 3D array (size: H x W x 3), dtype uint8
+        The image in RGB format
+    """
+
+    flags = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4,
+             8: cv2.IMREAD_REDUCED_COLOR_8}
+    if reduce_fac not in flags:
+        raise Exception('Reduced-resolution decoding factor ' + str(reduce_fac) + ' is not in {1, 2, 4, 8}')
+    if reduce_fac > 1 and os.path.splitext(path)[1].lower() == '.bmp':
+        x = read_bmp_reduced(path, reduce_fac)
+        if x is not None:
+            return x
+    # Decode once, in BGR format, then convert to RGB in place
+    x = cv2.imread(path, flags[reduce_fac])
+    if x is None:
+        raise Exception('Could not read image ' + path)
+    return cv2.cvtColor(x, cv2.COLOR_BGR2RGB, dst=x)
+
+def read_bmp_reduced(path, reduce_fac, strip_rows=64):
+    """Read an uncompressed 24- or 32-bit BMP at 1/reduce_fac of its native resolution, averaging each reduce_fac x
+    reduce_fac block (as cv2.INTER_AREA does) a strip of rows at a time from the memory-mapped file, so that at most
+    strip_rows x reduce_fac native rows are in memory at once
+
+    Parameters
+    ----------
+    path : str
+        Filepath to the BMP image to be read
+    reduce_fac : int
+        The reduced-resolution decoding factor
+    strip_rows : int, optional
+        The number of reduced rows computed at a time
+
+    Returns
+    -------
+    y : numpy 3D array (size: H x W x 3), dtype uint8, or None
+        The image in RGB format, with H and W the native height and width divided by reduce_fac (rounded down, as
+        with cv2.IMREAD_REDUCED_*), or None if the BMP is of another kind (e.g. compressed or palette-based)
     """
 
-    # Read image in BGR format
-    x = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
-    img = keras.preprocessing.image.load_img(path, target_size=(x.shape[0], x.shape[1]))
-    y = keras.preprocessing.image.img_to_array(img)
+    with open(path, 'rb') as f:
+        header = f.read(34)
+    if len(header) < 34 or header[:2] != b'BM':
+        return None
+    data_offset = int.from_bytes(header[10:14], 'little')
+    width = int.from_bytes(header[18:22], 'little', signed=True)
+    height = int.from_bytes(header[22:26], 'little', signed=True)
+    bits = int.from_bytes(header[28:30], 'little')
+    compression = int.from_bytes(header[30:34], 'little')
+    if compression != 0 or bits not in [24, 32] or width <= 0 or height == 0:
+        return None
+    channels = bits // 8
+    is_bottom_up = height > 0
+    height = abs(height)
+    # (rows are padded to multiples of 4 bytes)
+    stride = (width * channels + 3) // 4 * 4
+    pixels = np.memmap(path, dtype='uint8', mode='r', offset=data_offset, shape=(height, stride))
+    out_size = (height // reduce_fac, width // reduce_fac)
+    y = np.empty(out_size + (3,), dtype='uint8')
+    for start in range(0, out_size[0], strip_rows):
+        end = min(start + strip_rows, out_size[0])
+        # Native rows of the strip, top to bottom
+        if is_bottom_up:
+            strip = pixels[height - end * reduce_fac:height - start * reduce_fac][::-1]
+        else:
+            strip = pixels[start * reduce_fac:end * reduce_fac]
+        strip = strip[:, :out_size[1] * reduce_fac * channels].reshape(end - start, reduce_fac, out_size[1],
+                                                                        reduce_fac, channels)
+        block_sums = strip[..., 2::-1].sum(axis=(1, 3), dtype='uint32')
+        y[start:end] = (block_sums + reduce_fac ** 2 // 2) // reduce_fac ** 2
+    del pixels
     return y
 
+def read_image_size(path):
+    """Read the native size of an image from its header, without decoding the pixels
+
+    Parameters
+    ----------
+    path : str
+        Filepath to image to be read
+
+    Returns
+    -------
+    size : tuple of int (size: 2)
+        The height and width of the image
+    """
+
+    with Image.open(path) as img:
+        return img.size[1], img.size[0]
+
 def crop_into_patches(image, down_fac, out_size):
     """Crop input image into patches compatible with the classification CNN field of view
 
@@ -80,7 +207,7 @@ def crop_into_patches(image, down_fac, out_size):
 
     # Extract patches from the original image
     total_crops = np.prod(np.array(num_crops))
-    patches = np.zeros((total_crops, out_size[0], out_size[1], 3))
+    patches = np.zeros((total_crops, out_size[0], out_size[1], 3), dtype=downsampled_image.dtype)
     iter_patch = 0
     for iter_row in range(num_crops[0]):
         if iter_row < num_crops[0] - 1:
@@ -136,8 +263,8 @@ def stitch_patch_activations(patch_activations, down_fac, out_size):
 
     # Resize the patch activations and add to original image size, then divide by overlap count array
     iter_patch = 0
-    G = np.zeros((1, num_classes, out_size_padded[0], out_size_padded[1]))
-    H = np.zeros((1, 1, out_size_padded[0], out_size_padded[1]))
+    G = np.zeros((1, num_classes, out_size_padded[0], out_size_padded[1]), dtype=patch_activations.dtype)
+    H = np.zeros((1, 1, out_size_padded[0], out_size_padded[1]), dtype=patch_activations.dtype)
     for iter_row in range(num_crops[0]):
         if iter_row < num_crops[0] - 1:
             start_i = iter_row * (upsampled_size[0] - crop_offset[0])
@@ -150,7 +277,8 @@ def stitch_patch_activations(patch_activations, down_fac, out_size):
             else:
                 start_j = out_size_padded[1] - upsampled_size[1]
             end_j = start_j + upsampled_size[1]
-            upsampled_activation = np.zeros((num_classes, upsampled_size[0], upsampled_size[1]))
+            upsampled_activation = np.zeros((num_classes, upsampled_size[0], upsampled_size[1]),
+                                            dtype=patch_activations.dtype)
             for iter_class in range(num_classes):
                 upsampled_activation[iter_class] = cv2.resize(patch_activations[iter_patch, iter_class],
                                                               dsize=(upsampled_size[1], upsampled_size[0]),
@@ -282,7 +410,8 @@ def cs_gradcam_to_class_inds(cs_gradcam):
 
     Parameters
     ----------
-    cs_gradcam : numpy 4D array (size: B x C x W x H), where B = batch size, C = number of classes
+    cs_gradcam : numpy 4D array (size: B x C x W x H), where B = batch size, C = number of classes, or
+                 hsn_v1.activations.SparseActivations object
         The class-specific Grad-CAM
 
     Returns
@@ -291,6 +420,9 @@ def cs_gradcam_to_class_inds(cs_gradcam):
         List of list of class names present in class-specific Grad-CAM
     """
 
+    if isinstance(cs_gradcam, SparseActivations):
+        return [[x for x in cs_gradcam.class_inds(i) if np.any(cs_gradcam.planes[i][x])]
+                for i in range(len(cs_gradcam))]
     is_class_present = np.any(np.any(cs_gradcam, axis=-2), axis=-1)
     class_inds = []
     for iter_input_image in range(is_class_present.shape[0]):
@@ -327,7 +459,8 @@ def gradcam_as_continuous(gradcam, colours, size):
 
     Parameters
     ----------
-    gradcam : numpy 4D array (size: B x C x W x H), where B = batch size, C = number of classes
+    gradcam : numpy 4D array (size: B x C x W x H), where B = batch size, C = number of classes, or
+              hsn_v1.activations.SparseActivations object
         The 4D continuous Grad-CAM
     colours : numpy 2D array (size: N x 3), where N = number of colours
         Valid colours used in the segmentation mask images
@@ -339,12 +472,15 @@ def gradcam_as_continuous(gradcam, colours, size):
     Y : numpy 4D array (size: B x W x H x 3), where B = batch size
         The 4D outputted continuous Grad-CAM
     """
-    num_input_images = gradcam.shape[0]
-    maxconf_gradcam = np.argmax(gradcam, axis=1)
+    if not isinstance(gradcam, SparseActivations):
+        gradcam = SparseActivations.from_dense(gradcam)
+    num_input_images = len(gradcam)
+    maxconf_gradcam = gradcam.argmax()
     Y = np.zeros((num_input_images, size[0], size[1], 3), dtype='uint8')
     for iter_input_image in range(num_input_images):
-        for iter_class in range(colours.shape[0]):
-            class_mask = np.array(np.ma.array(gradcam[iter_input_image, iter_class],
+        # Absent classes are all-zero, so they add nothing
+        for iter_class in gradcam.class_inds(iter_input_image):
+            class_mask = np.array(np.ma.array(gradcam.planes[iter_input_image][iter_class],
                                               mask=maxconf_gradcam[iter_input_image] != iter_class))
             Y[iter_input_image] += np.uint8(np.array(colours[iter_class]) * class_mask[:, :, None])
     return Y
@@ -390,7 +526,7 @@ def add_sidelabels(img, leftlabels, toplabels, addwidth, addheight, size):
     img3 = np.concatenate((np.concatenate((cornerpanel, leftpanel), axis=0), img2), axis=1)
     return img3
 
-def concat_to_grid(filename, X1, X2, X3, X4, X5, X6, X7, out_dir, layout, htt_class):
+def concat_to_grid(filename, X1, X2, X3, X4, X5, X6, X7, out_dir, layout, htt_class, writer=None):
     """Concatenate summary images in a grid arrangement
 
     Parameters
@@ -405,6 +541,8 @@ def concat_to_grid(filename, X1, X2, X3, X4, X5, X6, X7, out_dir, layout, htt_cl
         The direction of concatenation, either 'horizontal' or 'vertical'
     htt_class : str
         The type of segmentation set to solve
+    writer : hsn_v1.writer.ImageWriter object or None, optional
+        The writer to queue the image with, or None to write it now
     """
 
     type_labels = ['Morphological HTT', 'Functional HTT']
@@ -425,11 +563,11 @@ def concat_to_grid(filename, X1, X2, X3, X4, X5, X6, X7, out_dir, layout, htt_cl
 
     X = np.float32(np.concatenate((X1, X2, X3, X4, X5, X6, X7), axis=axis))
     X = add_sidelabels(X, left_labels, top_labels, text_width, text_height, size)
-    cv2.imwrite(os.path.join(out_dir, htt_class, layout, filename + '.png'), cv2.cvtColor(X, cv2.COLOR_RGB2BGR))
+    write_image(os.path.join(out_dir, htt_class, layout, filename + '.png'), cv2.cvtColor(X, cv2.COLOR_RGB2BGR), writer)
 
 def export_summary_image(input_files, input_images, out_dir, gt_legends, pred_legends, gt_segmask,
                          cs_gradcam_post_discrete, cs_gradcam_pre_discrete, cs_gradcam_pre_continuous, htt_class,
-                         layouts=['horizontal', 'vertical']):
+                         layouts=['horizontal', 'vertical'], writer=None):
     """Export summary image of segmentation for debugging purposes
 
     Parameters
@@ -456,6 +594,8 @@ def export_summary_image(input_files, input_images, out_dir, gt_legends, pred_le
         The type of segmentation set to solve
     layouts : list of str, optional
         The directions of concatenation, elements must be either 'horizontal' or 'vertical'
+    writer : hsn_v1.writer.ImageWriter object or None, optional
+        The writer to queue the images with, or None to write them now
     """
 
     gt_segmask_discrete_overlaid = mult_overlay_on_img(gt_segmask, input_images)
@@ -465,15 +605,16 @@ def export_summary_image(input_files, input_images, out_dir, gt_legends, pred_le
                                                              ratio=[0.75, 0.25])
 
     for layout in layouts:
-        mkdir_if_nexist(os.path.join(out_dir, htt_class, layout))
+        if writer is None:
+            mkdir_if_nexist(os.path.join(out_dir, htt_class, layout))
         for iter_input_image in range(input_images.shape[0]):
             concat_to_grid(input_files[iter_input_image], input_images[iter_input_image], gt_legends[iter_input_image],
                            gt_segmask_discrete_overlaid[iter_input_image], pred_legends[iter_input_image],
                            cs_gradcam_post_discrete_overlaid[iter_input_image],
                            cs_gradcam_pre_discrete_overlaid[iter_input_image],
-                           cs_gradcam_pre_continuous_overlaid[iter_input_image], out_dir, layout, htt_class)
+                           cs_gradcam_pre_continuous_overlaid[iter_input_image], out_dir, layout, htt_class, writer)
 
-def save_glas_bmps(input_files, pred, out_dir, htt_class, full_size):
+def save_glas_bmps(input_files, pred, out_dir, htt_class, full_size, writer=None):
     """Save GlaS segmentations as images
 
     Parameters
@@ -488,29 +629,31 @@ def save_glas_bmps(input_files, pred, out_dir, htt_class, full_size):
         The type of segmentation set to solve
     full_size : tuple of int
         Original size of the GlaS input image
+    writer : hsn_v1.writer.ImageWriter object or None, optional
+        The writer to queue the images with, or None to write them now
     """
 
     single_gland_out_dir = os.path.join(out_dir, htt_class, 'single_gland')
-    mkdir_if_nexist(single_gland_out_dir)
-
     multi_gland_out_dir = os.path.join(out_dir, htt_class, 'multi_gland')
-    mkdir_if_nexist(multi_gland_out_dir)
+    if writer is None:
+        mkdir_if_nexist(single_gland_out_dir)
+        mkdir_if_nexist(multi_gland_out_dir)
 
     for iter_input_image in range(len(input_files)):
         P = cv2.resize(pred[iter_input_image], (full_size[1], full_size[0]), interpolation=cv2.INTER_NEAREST)
         # Option 1: consider all predicted blobs as one gland object
         out_filename = input_files[iter_input_image].replace('.png', '.bmp')
         out_path = os.path.join(single_gland_out_dir, out_filename)
-        cv2.imwrite(out_path, P)
+        write_image(out_path, P, writer)
 
         # Option 2: consider each predicted blob as an individual gland object
         im = filters.gaussian(P, sigma=.5)
         im = im > np.average(im)
         lbl = measure.label(im)
         out_path = os.path.join(multi_gland_out_dir, out_filename)
-        cv2.imwrite(out_path, lbl)
+        write_image(out_path, lbl, writer)
 
-def save_patchconfidence(image_inds, class_inds, scores, size, out_dir, out_names, classes):
+def save_patchconfidence(image_inds, class_inds, scores, size, out_dir, out_names, classes, writer=None):
     """Save patch confidence scores as single-valued patch images
 
     Parameters
@@ -529,6 +672,8 @@ def save_patchconfidence(image_inds, class_inds, scores, size, out_dir, out_name
         The name of the original patch images in the batch
     classes : list of str (size: C), where C = number of classes
         The names of the segmentation classes
+    writer : hsn_v1.writer.ImageWriter object or None, optional
+        The writer to queue the images with, or None to write them now
     """
 
     if len(image_inds) != len(class_inds) or len(image_inds) != len(scores):
@@ -538,9 +683,9 @@ def save_patchconfidence(image_inds, class_inds, scores, size, out_dir, out_name
         Y = 255 * scores[iter_patchconfidence] * np.ones((size[0], size[1], 3))
         patch_conf_name = os.path.splitext(out_name)[0] + '_h' + classes[class_inds[iter_patchconfidence]] + '.png'
         patch_conf_path = os.path.join(out_dir, patch_conf_name)
-        cv2.imwrite(patch_conf_path, Y)
+        write_image(patch_conf_path, Y, writer)
 
-def save_pred_segmasks(X, out_dir, out_names):
+def save_pred_segmasks(X, out_dir, out_names, writer=None):
     """Save the predicted segmentation masks in the current batch to file
 
     Parameters
@@ -551,20 +696,23 @@ def save_pred_segmasks(X, out_dir, out_names):
          The directory to save the predicted segmentation masks to
     out_names : list of str (size: B), where B = batch size
         The name of the original patch images in the batch
+    writer : hsn_v1.writer.ImageWriter object or None, optional
+        The writer to queue the images with, or None to write them now
     """
 
     if X.shape[0] != len(out_names):
         raise Exception('Number of files in segmasks must equal number of file names!')
     for iter_image in range(X.shape[0]):
         out_path = os.path.join(out_dir, out_names[iter_image])
-        cv2.imwrite(out_path, cv2.cvtColor(X[iter_image].astype('uint8'), cv2.COLOR_RGB2BGR))
+        write_image(out_path, cv2.cvtColor(X[iter_image].astype('uint8'), cv2.COLOR_RGB2BGR), writer)
 
-def save_cs_gradcam(X, out_dir, out_names, classes):
+def save_cs_gradcam(X, out_dir, out_names, classes, writer=None):
     """Save the predicted HTT-adjusted segmentation masks in the current batch to file
 
     Parameters
     ----------
-    X : numpy 4D array (size: B x H x W x 3), where B = batch size
+    X : numpy 4D array (size: B x C x H x W), where B = batch size, C = number of classes, or
+        hsn_v1.activations.SparseActivations object
         The predicted HTT-adjusted segmentation masks in the current batch to save
     out_dir : str
          The directory to save the predicted segmentation masks to
@@ -572,18 +720,22 @@ def save_cs_gradcam(X, out_dir, out_names, classes):
         The name of the original patch images in the batch
     classes : list of str (size: C), where C = number of classes
         The names of the segmentation classes
+    writer : hsn_v1.writer.ImageWriter object or None, optional
+        The writer to queue the images with, or None to write them now
     """
 
+    if not isinstance(X, SparseActivations):
+        X = SparseActivations.from_dense(X)
     if X.shape[0] != len(out_names):
         raise Exception('Number of files in CS-Grad-CAMs must equal number of file names!')
     if X.shape[1] != len(classes):
         raise Exception('Number of classes in CS-Grad-CAMs must equal number of valid classes')
     for iter_image in range(X.shape[0]):
-        for iter_class in range(X.shape[1]):
-            if np.sum(X[iter_image, iter_class]) > 0:
+        for iter_class in X.class_inds(iter_image):
+            if np.sum(X.planes[iter_image][iter_class]) > 0:
                 out_path = os.path.join(out_dir, os.path.splitext(out_names[iter_image])[0] + '_h' + classes[iter_class] + \
                            os.path.splitext(out_names[iter_image])[1])
-                cv2.imwrite(out_path, 255 * X[iter_image, iter_class])
+                write_image(out_path, 255 * X.planes[iter_image][iter_class], writer)
 
 def show_values(pc, fmt="%.2f", **kw):
     '''
@@ -0,0 +1,101 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+
+class ImageWriter:
+    """Class for encoding and writing output images in background threads, off the segmentation critical path"""
+
+    def __init__(self, num_workers=4, max_backlog=64):
+        """
+        Parameters
+        ----------
+        num_workers : int, optional
+            The number of worker threads encoding images concurrently (0 to write synchronously in the calling thread)
+        max_backlog : int, optional
+            The maximum number of images waiting to be written before write() blocks
+        """
+
+        if type(num_workers) != int or num_workers < 0:
+            raise Exception('Number of writer workers must be an integer of at least 0')
+        if type(max_backlog) != int or max_backlog < 1:
+            raise Exception('Writer backlog must be an integer of at least 1')
+        self.num_workers = num_workers
+        self.executor = ThreadPoolExecutor(max_workers=num_workers) if num_workers > 0 else None
+        self.backlog = threading.BoundedSemaphore(max_backlog)
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.errors = []
+        # Directories already known to exist
+        self.dirs = set()
+
+    def make_dir(self, path):
+        """Create a directory (and its parents) if it was not already created through this writer"""
+
+        if path in self.dirs:
+            return
+        with self.lock:
+            if path not in self.dirs:
+                if not os.path.exists(path):
+                    os.makedirs(path, exist_ok=True)
+                self.dirs.add(path)
+
+    def write(self, path, image):
+        """Queue an image to be encoded (in the format given by the path extension, e.g. PNG or BMP) and written
+
+        The image must not be modified after being queued.
+
+        Parameters
+        ----------
+        path : str
+            The file path to write the image to (its directory is created if needed)
+        image : numpy 2D or 3D array
+            The image, as accepted by cv2.imwrite
+        """
+
+        self.make_dir(os.path.dirname(path))
+        if self.executor is None:
+            self.write_now(path, image)
+            return
+        self.backlog.acquire()
+        future = self.executor.submit(self.write_now, path, image)
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self.on_done)
+
+    def write_now(self, path, image):
+        """Encode and write an image in the current thread"""
+
+        if not cv2.imwrite(path, image):
+            raise Exception('Could not write image to ' + path)
+
+    def on_done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+            if future.exception() is not None:
+                self.errors.append(future.exception())
+        self.backlog.release()
+
+    def flush(self):
+        """Block until all queued images are written, raising the first error encountered, if any"""
+
+        while True:
+            with self.lock:
+                pending = list(self.pending)
+            if len(pending) == 0:
+                break
+            for future in pending:
+                future.exception()
+        with self.lock:
+            errors = self.errors
+            self.errors = []
+        if len(errors) > 0:
+            raise errors[0]
+
+    def close(self):
+        """Flush and shut down the worker threads (images written afterwards are written synchronously)"""
+
+        self.flush()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None